@@ -14,13 +14,29 @@ CREATE TABLE q4 (
 
 -- You may find it convenient to do this for each of the views
 -- that define your intermediate steps. (But give them better names!)
-DROP VIEW IF EXISTS IntermediateStep CASCADE;
-
--- Define views for your intermediate steps here:
-CREATE VIEW IntermediateStep AS ... ;
-
-
+DROP VIEW IF EXISTS MonthSales2024 CASCADE;
+DROP VIEW IF EXISTS MonthExtreme CASCADE;
+
+-- The sales value of every category in every month of 2024, 0 if it had no
+-- sales. CategoryMonthSales (see schema.ddl) keeps the totals per month, so
+-- this does not have to join Purchase, LineItem and Item over all history.
+CREATE VIEW MonthSales2024 AS
+SELECT to_char(m.month, 'MM') AS month, c.category,
+    COALESCE(s.sales_val, 0) AS sales_val
+FROM generate_series('2024-01-01'::DATE, '2024-12-01', '1 month') AS m(month)
+    CROSS JOIN (SELECT DISTINCT category FROM Item) c
+    LEFT JOIN CategoryMonthSales s
+        ON s.month = m.month AND s.category = c.category;
+
+-- The highest and the lowest sales value of each month.
+CREATE VIEW MonthExtreme AS
+SELECT month, MAX(sales_val) AS highest, MIN(sales_val) AS lowest
+FROM MonthSales2024
+GROUP BY month;
 
 -- Your query that answers the question goes below the "insert into" line:
 INSERT INTO q4
-
+SELECT e.month, h.category, e.highest, l.category, e.lowest
+FROM MonthExtreme e
+    JOIN MonthSales2024 h ON h.month = e.month AND h.sales_val = e.highest
+    JOIN MonthSales2024 l ON l.month = e.month AND l.sales_val = e.lowest;
@@ -4,13 +4,14 @@
 SET SEARCH_PATH TO Recommender;
 
 
--- Sale: 20% off only on items that have sold at least 10 units (total quantity).
+-- Sale: 20% off only on items that have sold at least 10 units (total
+-- quantity). ItemStats.units_sold is kept equal to SUM(quantity) over LineItem
+-- by triggers.
 UPDATE Item
 SET price = price * 0.8
 WHERE IID IN (
     SELECT IID
-    FROM LineItem
-    GROUP BY IID
-    HAVING SUM(quantity) >= 10
+    FROM ItemStats
+    WHERE units_sold >= 10
 );
 
@@ -6,7 +6,33 @@ SET SEARCH_PATH TO Recommender;
 
 -- You may find it convenient to do this for each of the views
 -- that define your intermediate steps. (But give them better names!)
-DROP VIEW IF EXISTS IntermediateStep CASCADE;
+DROP VIEW IF EXISTS RecentCardPurchase CASCADE;
+DROP VIEW IF EXISTS FraudulentPurchase CASCADE;
 
--- Define views for your intermediate steps here:
-CREATE VIEW IntermediateStep AS ... ;
+-- Each purchase of the last 24 hours, numbered in the order in which it was
+-- made among the purchases with the same card in that time. Only recent
+-- purchases are read, so that with partitioned.ddl only the partition of the
+-- current year is scanned.
+CREATE VIEW RecentCardPurchase AS
+SELECT PID, ROW_NUMBER() OVER (PARTITION BY card_pan
+                               ORDER BY checkout_time, PID) AS nth
+FROM Purchase
+WHERE checkout_time >= NOW() - INTERVAL '24 hours';
+
+-- The purchases made with a card after its fifth one in the last 24 hours.
+CREATE VIEW FraudulentPurchase AS
+SELECT PID FROM RecentCardPurchase WHERE nth > 5;
+
+-- With partitioned.ddl, deleting a purchase deletes its line items, in the
+-- partition of its checkout_time only, whereas deleting them by PID would
+-- look in every partition of LineItem. So they are only deleted here if
+-- LineItem is not partitioned; the test is done once, before any scan.
+DELETE FROM LineItem
+WHERE PID IN (SELECT PID FROM FraudulentPurchase)
+    AND (SELECT relkind FROM pg_class WHERE oid = 'LineItem'::regclass) <> 'p';
+
+-- Fraudulent purchases are recent, so only the partitions of Purchase that
+-- hold the last 24 hours are looked in.
+DELETE FROM Purchase
+WHERE PID IN (SELECT PID FROM FraudulentPurchase)
+    AND checkout_time >= NOW() - INTERVAL '24 hours';
@@ -10,9 +10,287 @@ All forms of distribution, whether as given or with any changes, are
 expressly prohibited.
 --------------------------------------------------------------------------------
 """
+import contextvars
+import importlib.util
 import psycopg2 as pg
 import psycopg2.extensions as pg_ext
-from typing import Optional
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+from typing import IO, Iterable, Iterator, Optional, Protocol, TYPE_CHECKING
+
+from connection_pool import ConnectionPool
+from export import copy_to, stream_rows
+from ingest import ingest
+from metrics import InstrumentedConnection, MetricsRegistry, \
+    instrumented, register_statements
+from prepared import PreparedStatement, PreparingConnection
+from result_cache import ResultCache
+from sqlite_backend import write_snapshot
+
+if TYPE_CHECKING:
+    from rating_matrix import RatingMatrix
+
+# The statements run by Recommender. They are shared with AsyncRecommender,
+# so that both always compute the same answers.
+
+# Locking the state row serializes concurrent repopulates.
+LOCK_SNAPSHOT_STATE = """
+    SELECT needs_full, version FROM SnapshotState FOR UPDATE;
+"""
+
+TAKE_DIRTY_CATEGORIES = "DELETE FROM DirtyCategory RETURNING category;"
+
+# Each repopulate builds a new Snapshot next to the published one, and
+# publishes it by pointing SnapshotState at it (see schema.ddl), so that
+# readers never wait for it or see it half built.
+NEW_SNAPSHOT = "INSERT INTO Snapshot DEFAULT VALUES RETURNING version;"
+
+# A sharded repopulate (see Recommender.repopulate_workers) commits its new
+# Snapshot before filling it from several connections, so the snapshot has
+# no built_at, i.e., is incomplete, until it is published.
+NEW_SHARDED_SNAPSHOT = """
+    INSERT INTO Snapshot (built_at) VALUES (NULL) RETURNING version;
+"""
+
+COMPLETE_SNAPSHOT = """
+    UPDATE Snapshot SET built_at = now() WHERE version = %(new)s;
+"""
+
+DROP_SNAPSHOT = "DELETE FROM Snapshot WHERE version = %(new)s;"
+
+# The number of items in each category to recompute, by which a sharded
+# repopulate balances its shards.
+CATEGORY_SIZES = """
+    SELECT category, COUNT(*) FROM ItemStats
+    WHERE %(all)s OR category = ANY(%(cats)s)
+    GROUP BY category;
+"""
+
+# The statements that fill snapshot %(new)s: the PopularItem and EliteRating
+# tuples of the items in categories %(cats)s, or of all items if %(all)s is
+# true, are recomputed, and those of the other categories are copied from
+# snapshot %(old)s. Popular items are ranked within their own category only,
+# so the tuples of the other categories are unaffected. Likewise, only the
+# AnalogousRater tuples of the customers who reviewed an item in %(cats)s,
+# or are in DirtyCustomer, are recomputed.
+COPY_CLEAN_CATEGORIES = (
+    """
+    INSERT INTO PopularItemVersion (version, IID, avg_rating)
+    SELECT %(new)s, p.IID, p.avg_rating
+    FROM PopularItemVersion p JOIN Item i ON i.IID = p.IID
+    WHERE p.version = %(old)s AND NOT %(all)s
+        AND i.category <> ALL(%(cats)s);
+    """,
+    """
+    INSERT INTO EliteRatingVersion (version, CID, IID, rating)
+    SELECT %(new)s, er.CID, er.IID, er.rating
+    FROM EliteRatingVersion er JOIN Item i ON i.IID = er.IID
+    WHERE er.version = %(old)s AND NOT %(all)s
+        AND i.category <> ALL(%(cats)s);
+    """,
+)
+
+RECOMPUTE_CATEGORIES = (
+    # The division matches AVG(rating) exactly, since both are done in
+    # NUMERIC.
+    """
+    INSERT INTO PopularItemVersion (version, IID, avg_rating)
+    SELECT %(new)s, IID, rating_sum::NUMERIC / NULLIF(rating_count, 0)
+    FROM (
+        SELECT IID, rating_sum, rating_count, DENSE_RANK() OVER (
+            PARTITION BY category ORDER BY units_sold DESC
+        ) AS sales_rank
+        FROM ItemStats
+        WHERE units_sold > 0 AND (%(all)s OR category = ANY(%(cats)s))
+    ) ranked
+    WHERE sales_rank <= 2;
+    """,
+    """
+    INSERT INTO EliteRatingVersion (version, CID, IID, rating)
+    SELECT %(new)s, r.CID, r.IID, r.rating
+    FROM Review r
+        JOIN EliteMember e ON e.CID = r.CID
+        JOIN PopularItemVersion p ON p.IID = r.IID AND p.version = %(new)s
+    WHERE %(all)s OR r.IID IN (
+        SELECT IID FROM Item WHERE category = ANY(%(cats)s));
+    """,
+)
+
+REFRESH_ANALOGOUS_RATERS = (
+    """
+    INSERT INTO AnalogousRaterVersion (version, CID, elite_cid, avg_diff)
+    SELECT %(new)s, a.CID, a.elite_cid, a.avg_diff
+    FROM AnalogousRaterVersion a
+    WHERE a.version = %(old)s AND NOT %(all)s
+        AND NOT EXISTS (SELECT 1 FROM DirtyCustomer d WHERE d.CID = a.CID)
+        AND NOT EXISTS (
+            SELECT 1 FROM Review r JOIN Item i ON i.IID = r.IID
+            WHERE r.CID = a.CID AND i.category = ANY(%(cats)s));
+    """,
+    # Customers marked dirty after the copy above may have been copied, so
+    # their tuples are overwritten.
+    """
+    WITH Taken AS (
+        DELETE FROM DirtyCustomer RETURNING CID
+    )
+    INSERT INTO AnalogousRaterVersion (version, CID, elite_cid, avg_diff)
+    SELECT %(new)s, a.CID, a.elite_cid, a.avg_diff
+    FROM analogous_raters(%(new)s) a
+    WHERE %(all)s OR a.CID IN (SELECT CID FROM Taken) OR EXISTS (
+        SELECT 1 FROM Review r JOIN Item i ON i.IID = r.IID
+        WHERE r.CID = a.CID AND i.category = ANY(%(cats)s))
+    ON CONFLICT (version, CID) DO UPDATE
+    SET elite_cid = EXCLUDED.elite_cid, avg_diff = EXCLUDED.avg_diff;
+    """,
+)
+
+REBUILD_CATEGORIES = (COPY_CLEAN_CATEGORIES + RECOMPUTE_CATEGORIES
+                      + REFRESH_ANALOGOUS_RATERS)
+
+# Make snapshot %(new)s the published one. If %(stale)s is true, the next
+# repopulate rebuilds everything, since the categories changed since that
+# snapshot was built are no longer recorded in DirtyCategory.
+PUBLISH_SNAPSHOT = """
+    UPDATE SnapshotState SET version = %(new)s, needs_full = %(stale)s
+    RETURNING version;
+"""
+
+# Drop every snapshot but %(new)s and the %(keep)s most recent complete
+# others.
+PRUNE_SNAPSHOTS = """
+    DELETE FROM Snapshot
+    WHERE version <> %(new)s AND version NOT IN (
+        SELECT version FROM Snapshot
+        WHERE version <> %(new)s AND built_at IS NOT NULL
+        ORDER BY version DESC
+        LIMIT %(keep)s);
+"""
+
+# The snapshot that rollback_snapshot publishes: snapshot %(version)s if it
+# is kept, or else, if %(version)s is NULL, the most recent one older than
+# the published snapshot %(current)s. Incomplete snapshots are never
+# published.
+PREVIOUS_SNAPSHOT = """
+    SELECT version FROM Snapshot
+    WHERE built_at IS NOT NULL AND (version = %(version)s
+        OR (%(version)s IS NULL AND version < %(current)s))
+    ORDER BY version DESC
+    LIMIT 1;
+"""
+
+# The version of the published snapshot. A cache miss reads it before its
+# answers, in the same transaction, and caches them under it.
+PUBLISHED_VERSION = "SELECT version FROM SnapshotState;"
+
+# The top %(k)s popular items.
+GENERIC_RECOMMENDATIONS = """
+    SELECT IID FROM PopularItem
+    ORDER BY avg_rating DESC NULLS LAST, IID
+    LIMIT %(k)s;
+"""
+
+# The top %(k)s items recommended to each customer in %(cids)s by their
+# elite analogous rater, as (CID, IID) pairs in order. Customers with no
+# such recommendation have no pairs. The analogous raters are looked up in
+# AnalogousRater, which repopulate precomputes.
+ELITE_RECOMMENDATIONS = """
+    WITH Requested AS (
+        SELECT unnest(%(cids)s::INT[]) AS CID
+    ), Candidate AS (
+        SELECT a.CID, r.IID, ROW_NUMBER() OVER (
+            PARTITION BY a.CID ORDER BY r.rating DESC, r.IID
+        ) AS position
+        FROM Requested q
+            JOIN AnalogousRater a ON a.CID = q.CID
+            JOIN Review r ON r.CID = a.elite_cid
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM Purchase p JOIN LineItem l ON l.PID = p.PID
+            WHERE p.CID = a.CID AND l.IID = r.IID)
+    )
+    SELECT CID, IID FROM Candidate
+    WHERE position <= %(k)s
+    ORDER BY CID, position;
+"""
+
+
+# The hot statements, which Recommender runs as prepared statements.
+_GENERIC_STATEMENT = PreparedStatement("recommend_generic",
+                                       GENERIC_RECOMMENDATIONS)
+_ELITE_STATEMENT = PreparedStatement("recommend_elite", ELITE_RECOMMENDATIONS)
+
+# The names under which a MetricsRegistry records the statements above. The
+# hot statements have the names they are prepared under, whether or not
+# they are run prepared.
+register_statements({
+    "LOCK_SNAPSHOT_STATE": LOCK_SNAPSHOT_STATE,
+    "TAKE_DIRTY_CATEGORIES": TAKE_DIRTY_CATEGORIES,
+    "NEW_SNAPSHOT": NEW_SNAPSHOT,
+    "NEW_SHARDED_SNAPSHOT": NEW_SHARDED_SNAPSHOT,
+    "COMPLETE_SNAPSHOT": COMPLETE_SNAPSHOT,
+    "DROP_SNAPSHOT": DROP_SNAPSHOT,
+    "CATEGORY_SIZES": CATEGORY_SIZES,
+    "COPY_CLEAN_CATEGORIES": COPY_CLEAN_CATEGORIES,
+    "RECOMPUTE_CATEGORIES": RECOMPUTE_CATEGORIES,
+    "REFRESH_ANALOGOUS_RATERS": REFRESH_ANALOGOUS_RATERS,
+    "PUBLISH_SNAPSHOT": PUBLISH_SNAPSHOT,
+    "PRUNE_SNAPSHOTS": PRUNE_SNAPSHOTS,
+    "PREVIOUS_SNAPSHOT": PREVIOUS_SNAPSHOT,
+    "PUBLISHED_VERSION": PUBLISHED_VERSION,
+    _GENERIC_STATEMENT.name: GENERIC_RECOMMENDATIONS,
+    _ELITE_STATEMENT.name: ELITE_RECOMMENDATIONS,
+})
+
+# The key of the answer of recommend_generic in Recommender.cache. Answers of
+# recommend are keyed by CID.
+_GENERIC_KEY = "generic"
+
+
+class Backend(Protocol):
+    """Something other than the PostgreSQL database that can answer the
+    queries of recommend and recommend_generic, e.g., an
+    sqlite_backend.SQLiteBackend. Both methods return None on an error.
+    """
+
+    def recommend_generic(self, k: int) -> Optional[list[int]]:
+        """Return the answer of GENERIC_RECOMMENDATIONS for <k>.
+        """
+
+    def recommend_elite(self, customers: list[int], k: int
+                        ) -> Optional[dict[int, list[int]]]:
+        """Return the answer of ELITE_RECOMMENDATIONS for <customers> and
+        <k>, by customer. Customers with no answer may be left out.
+        """
+
+
+def _shard(sizes: list[tuple[str, int]], n: int) -> list[list[str]]:
+    """Split the categories of <sizes>, pairs of a category and its number
+    of items, into <n> shards with about the same number of items each.
+    Some shards are empty if there are fewer than <n> categories.
+    """
+    shards = [[] for _ in range(n)]
+    loads = [0] * n
+    for category, size in sorted(sizes, key=lambda pair: (-pair[1], pair[0])):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(category)
+        loads[lightest] += size
+    return shards
+
+
+def _recompute_shard(conn: pg_ext.connection, params: dict) -> None:
+    """Recompute the PopularItem and EliteRating tuples of the categories
+    %(cats)s of <params> into snapshot %(new)s on <conn>, and commit.
+    """
+    try:
+        with conn.cursor() as cur:
+            for statement in RECOMPUTE_CATEGORIES:
+                cur.execute(statement, params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 
 class Recommender:
@@ -22,17 +300,121 @@ class Recommender:
     === Instance Attributes ===
     connection: Connection to a database of online purchases and product
         recommendations.
+    pool: Pool of connections to such a database, used instead of
+        <connection> after connect_pool. Each method call then checks out
+        its own connection, so one Recommender can serve many threads.
+    in_memory: Whether repopulate loads <rating_matrix>, so that recommend
+        is answered in memory instead of by the database.
+    rating_matrix: The in-memory snapshot used to answer recommend, or None
+        if recommend queries the database.
+    cache: The cache of answers of recommend and recommend_generic, or None
+        if answers are not cached. Its version is the SnapshotState version
+        seen last, by a repopulate or by a cache miss.
+    prepared: Whether recommend and recommend_generic run their statements
+        as server-side prepared statements, prepared once per connection.
+    metrics: The registry in which calls of the public methods, and the
+        statements they run, are recorded, or None if they are not.
+    backend: The backend that answers recommend and recommend_generic
+        instead of the database, or None if the database answers them.
+    keep_snapshots: The number of snapshots that repopulate keeps besides
+        the one it publishes, so that rollback_snapshot can go back to them.
+    repopulate_workers: The number of connections over which repopulate
+        splits the categories to recompute, or 1 to recompute them all on
+        the connection of the call.
+    matrix_path: The path to which every snapshot that is published is
+        saved as a RatingMatrix, or None if it is not.
 
     Representation invariants:
     - The database to which connection is established conforms to the schema
       in schema.sql.
     """
     connection: Optional[pg_ext.connection]
+    pool: Optional[ConnectionPool]
+    in_memory: bool
+    rating_matrix: Optional["RatingMatrix"]
+    cache: Optional[ResultCache]
+    prepared: bool
+    metrics: Optional[MetricsRegistry]
+    backend: Optional[Backend]
+    keep_snapshots: int
+    repopulate_workers: int
+    matrix_path: Optional[str]
+    _params: dict[str, str]
 
-    def __init__(self) -> None:
+    def __init__(self, in_memory: bool = False, cache_size: int = 0,
+                 cache_ttl: Optional[float] = None,
+                 prepared: bool = True,
+                 metrics: Optional[MetricsRegistry] = None,
+                 backend: Optional[Backend] = None,
+                 keep_snapshots: int = 0,
+                 repopulate_workers: int = 1,
+                 matrix_path: Optional[str] = None) -> None:
         """Initialize this Recommender, with no database connection yet.
+
+        If <in_memory> is True, every successful repopulate also loads the
+        derived tables into a RatingMatrix. This requires NumPy.
+
+        If <cache_size> is positive, the answers of recommend and
+        recommend_generic are cached, for up to <cache_size> customers, and
+        for at most <cache_ttl> seconds if that is not None. A repopulate
+        that changes the derived tables drops all the cached answers, and so
+        does the next cache miss after a repopulate through another
+        Recommender, since each miss reads the published version. An answer
+        for a customer can be dropped with invalidate_customer, e.g., after
+        they review or buy something. Note that other changes made through
+        other Recommenders are only seen once <cache_ttl> runs out.
+
+        If <prepared> is False, statements are sent in full on every call
+        instead of being executed by name, e.g., to compare the two.
+
+        If <metrics> is not None, the calls of the methods that query the
+        database, and each statement they run, are recorded in it (see
+        metrics.py). It must be given before connecting.
+
+        If <backend> is not None, recommend, recommend_many and
+        recommend_generic are answered by it, e.g., from an SQLite snapshot
+        (see sqlite_backend.py), and need no connection. The other methods
+        still need one.
+
+        repopulate keeps the <keep_snapshots> most recent snapshots it
+        replaced, besides the one it publishes, so that rollback_snapshot
+        can publish one of them again instantly, e.g., if a bad batch of
+        data made it into the latest one.
+
+        If <repopulate_workers> is more than 1, repopulate splits the
+        categories to recompute into that many shards, balanced by number
+        of items, and recomputes them at the same time on as many
+        connections of their own. The snapshot is still published at once.
+
+        If <matrix_path> is not None, every successful repopulate or
+        rollback_snapshot also saves the snapshot it published to a binary
+        file at <matrix_path> (see export_matrix), which serving processes
+        map with MappedBackend instead of querying the database. This
+        requires NumPy.
+
+        Raise ImportError if <in_memory> is True or <matrix_path> is not None,
+        but NumPy is not installed.
+
+        Precondition:
+            - <keep_snapshots> >= 0
+            - <repopulate_workers> >= 1
         """
         self.connection = None
+        self.pool = None
+        self.in_memory = in_memory
+        self.rating_matrix = None
+        self.cache = ResultCache(cache_size, cache_ttl) if cache_size > 0 \
+            else None
+        self.prepared = prepared
+        self.metrics = metrics
+        self.backend = backend
+        self.keep_snapshots = keep_snapshots
+        self.repopulate_workers = repopulate_workers
+        self.matrix_path = matrix_path
+        self._params = {}
+        if (in_memory or matrix_path is not None) \
+                and importlib.util.find_spec("numpy") is None:
+            raise ImportError("in_memory and matrix_path require NumPy")
 
     def connect(self, dbname: str, username: str, password: str) -> bool:
         """Establish a connection to the database <dbname> using the
@@ -52,20 +434,93 @@ class Recommender:
         >>> rec.connect("nonsense", "silly", "junk")
         False
         """
+        self._params = {"dbname": dbname, "user": username,
+                        "password": password,
+                        "options": "-c search_path=recommender,public"}
         try:
             self.connection = pg.connect(
-                dbname=dbname, user=username, password=password,
-                options="-c search_path=recommender,public"
+                **self._params, connection_factory=self._connection_factory()
+            )
+            return True
+        except pg.Error:
+            return False
+
+    def connect_pool(self, dbname: str, username: str, password: str,
+                     minconn: int = 1, maxconn: int = 64,
+                     timeout: Optional[float] = None) -> bool:
+        """Establish a pool of between <minconn> and <maxconn> connections to
+        the database <dbname>, set up like the one made by connect, and
+        assign it to the instance attribute <pool>.
+
+        From then on, each call to a method that queries the database checks
+        a connection out of the pool for its duration, waiting up to
+        <timeout> seconds (forever if None) if all of them are in use.
+        If no connection becomes free in time, the method fails as it would
+        on any other database error.
+
+        Return True if the pool was made successfully, False otherwise.
+        I.e., do NOT throw an error if making the connections fails.
+
+        Precondition:
+            - 0 <= <minconn> <= <maxconn>
+        """
+        self._params = {"dbname": dbname, "user": username,
+                        "password": password,
+                        "options": "-c search_path=recommender,public"}
+        try:
+            self.pool = ConnectionPool(
+                minconn, maxconn, timeout, **self._params,
+                connection_factory=self._connection_factory()
             )
             return True
         except pg.Error:
             return False
 
+    def pool_stats(self) -> Optional[dict[str, float]]:
+        """Return the statistics of <pool> (see ConnectionPool.stats), or
+        None if this Recommender is not using a pool.
+        """
+        return None if self.pool is None else self.pool.stats()
+
+    def metrics_stats(self) -> Optional[dict]:
+        """Return what <metrics> recorded (see MetricsRegistry.stats), or
+        None if this Recommender is not instrumented.
+        """
+        return None if self.metrics is None else self.metrics.stats()
+
+    def _connection_factory(self) -> type:
+        """Return the class of the connections to make: ones whose statements
+        are recorded if this Recommender has a registry.
+        """
+        return PreparingConnection if self.metrics is None \
+            else InstrumentedConnection
+
+    @contextmanager
+    def _connection(self) -> Iterator[pg_ext.connection]:
+        """Provide the connection to use for the duration of the with block:
+        one checked out of <pool> if there is one, or <connection>.
+
+        If an error is raised in the with block, the transaction is rolled
+        back before the error is propagated.
+        """
+        if self.pool is not None:
+            # The pool rolls back whatever is left open when it gets the
+            # connection back.
+            with self.pool.connection() as conn:
+                yield conn
+            return
+        try:
+            yield self.connection
+        except Exception:
+            self.connection.rollback()
+            raise
+
     def disconnect(self) -> bool:
         """Close the database connection.
 
         Return True if closing the connection was successful, False otherwise.
         I.e., do NOT throw an error if closing the connection failed.
+        This also closes all the connections of <pool>, if there is one.
 
         >>> rec = Recommender()
         >>> # This example will work for you if you change the arguments as
@@ -76,13 +531,16 @@ class Recommender:
         True
         """
         try:
-            if not self.connection.closed:
+            if self.connection is not None and not self.connection.closed:
                 self.connection.close()
+            if self.pool is not None:
+                self.pool.close()
             return True
         except pg.Error:
             return False
 
-    def repopulate(self) -> bool:
+    @instrumented
+    def repopulate(self, full: bool = False) -> bool:
         """Repopulate the database tables that store a snapshot of information
         derived from the base tables. To simplify your task, assume that table
         EliteMember has been populated correctly. You are required to populate
@@ -109,19 +567,197 @@ class Recommender:
             or PopularItem tables are empty, or if none of the elite members
             ever rated any item.
 
+        Incremental mode:
+            Unless <full> is True, only the categories recorded in
+            DirtyCategory (see the triggers in schema.ddl) are recomputed:
+            their PopularItem and EliteRating tuples are removed and rebuilt,
+            and all other tuples are kept. The result is identical to a full
+            rebuild. A full rebuild is done anyway if SnapshotState says one
+            is needed, e.g., before the first snapshot or after EliteMember
+            changed.
+
+        Snapshots:
+            The new tuples are built as a new snapshot, next to the one that
+            PopularItem and EliteRating show, and published in one step when
+            it is complete, so that readers are never blocked and never see
+            the tables empty or half built. Only the <keep_snapshots> most
+            recent replaced snapshots are kept.
+            With <repopulate_workers> above 1, the categories are
+            recomputed in shards, each on a connection of its own.
+
         Precondition:
            - Assume that EliteMember has been populated correctly.
         """
-        # TODO - complete this method
-
         try:
-            pass
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute(LOCK_SNAPSHOT_STATE)
+                needs_full, version = cur.fetchone()
+                cur.execute(TAKE_DIRTY_CATEGORIES)
+                dirty = [row[0] for row in cur.fetchall()]
+
+                if full or needs_full or dirty:
+                    params = {"old": version, "all": full or needs_full,
+                              "cats": dirty, "stale": False,
+                              "keep": self.keep_snapshots}
+                    if self.repopulate_workers > 1:
+                        params["new"] = self._rebuild_sharded(cur, params)
+                    else:
+                        cur.execute(NEW_SNAPSHOT)
+                        params["new"] = cur.fetchone()[0]
+                        for statement in REBUILD_CATEGORIES:
+                            cur.execute(statement, params)
+                    cur.execute(PUBLISH_SNAPSHOT, params)
+                    version = cur.fetchone()[0]
+                    cur.execute(PRUNE_SNAPSHOTS, params)
+                conn.commit()
         except pg.Error as ex:
             # You may find it helpful to uncomment this line while debugging,
             # as it will show you all the details of the error that occurred:
             # raise ex
             return False
+        return self._published(version)
+
+    def _rebuild_sharded(self, cur: pg_ext.cursor, params: dict) -> int:
+        """Build a new snapshot as repopulate does with <params>, except for
+        "new", recomputing the categories in <repopulate_workers> shards on
+        connections of their own, and return its version. It is complete but
+        not published once the transaction of <cur> commits.
+
+        The snapshot is committed as incomplete first, so that the shards
+        can refer to it. If building it fails, it is dropped, and the error
+        is propagated.
+        """
+        workers = []
+        try:
+            for _ in range(self.repopulate_workers):
+                workers.append(pg.connect(
+                    **self._params,
+                    connection_factory=self._connection_factory()))
+            with workers[0].cursor() as setup:
+                setup.execute(NEW_SHARDED_SNAPSHOT)
+                params = dict(params, new=setup.fetchone()[0])
+            workers[0].commit()
+            try:
+                cur.execute(CATEGORY_SIZES, params)
+                shards = _shard(cur.fetchall(), len(workers))
+                # Each shard runs in a copy of the current context, so that
+                # its statements are recorded as part of this call.
+                with ThreadPoolExecutor(len(workers)) as executor:
+                    filled = [executor.submit(contextvars.copy_context().run,
+                                              _recompute_shard, conn,
+                                              dict(params, all=False,
+                                                   cats=shard))
+                              for conn, shard in zip(workers, shards)
+                              if shard]
+                    # The clean categories are copied in the meantime.
+                    for statement in COPY_CLEAN_CATEGORIES:
+                        cur.execute(statement, params)
+                    for future in filled:
+                        future.result()
+                for statement in REFRESH_ANALOGOUS_RATERS:
+                    cur.execute(statement, params)
+                cur.execute(COMPLETE_SNAPSHOT, params)
+            except Exception:
+                # The rows inserted through <cur> lock the snapshot until
+                # its transaction ends.
+                cur.connection.rollback()
+                workers[0].rollback()
+                with workers[0].cursor() as cleanup:
+                    cleanup.execute(DROP_SNAPSHOT, params)
+                workers[0].commit()
+                raise
+        finally:
+            for conn in workers:
+                conn.close()
+        return params["new"]
+
+    @instrumented
+    def rollback_snapshot(self, version: Optional[int] = None) -> bool:
+        """Publish snapshot <version> of PopularItem and EliteRating again,
+        or, if <version> is None, the most recent kept snapshot older than
+        the published one. This only points SnapshotState at it, so it takes
+        no longer than a commit. The next repopulate does a full rebuild.
+
+        Return True if the snapshot was published, False otherwise, e.g., if
+        it was not kept. I.e., do NOT throw an error if an error occurs.
+        """
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute(LOCK_SNAPSHOT_STATE)
+                current = cur.fetchone()[1]
+                cur.execute(PREVIOUS_SNAPSHOT,
+                            {"version": version, "current": current})
+                row = cur.fetchone()
+                if row is None:
+                    conn.rollback()
+                    return False
+                cur.execute(PUBLISH_SNAPSHOT, {"new": row[0], "stale": True})
+                version = cur.fetchone()[0]
+                conn.commit()
+        except pg.Error as ex:
+            # raise ex
+            return False
+        return self._published(version)
+
+    def _published(self, version: int) -> bool:
+        """Bring everything derived from the published snapshot up to
+        <version>, which was just published: the cache, <rating_matrix> if
+        <in_memory> is True, and the file at <matrix_path> if there is one.
+
+        Return True if all of them were updated successfully.
+        """
+        if self.cache is not None:
+            self.cache.set_version(version)
+        if self.in_memory and not self.load_rating_matrix():
+            return False
+        return self.matrix_path is None \
+            or self.export_matrix(self.matrix_path) is not None
+
+    @instrumented
+    def load_rating_matrix(self) -> bool:
+        """Load the current contents of the derived tables, together with the
+        ratings and purchases that recommend depends on, into
+        <rating_matrix>. From then on, recommend and recommend_many are
+        answered from memory.
 
+        The matrix is a snapshot: reviews and purchases made after it was
+        loaded are not seen until the next load (which every successful
+        repopulate does when <in_memory> is True).
+
+        Return True if loading was successful, False otherwise. On failure,
+        <rating_matrix> is reset to None, so the database is queried again.
+        """
+        from rating_matrix import RatingMatrix
+        try:
+            with self._connection() as conn:
+                self.rating_matrix = RatingMatrix.load(conn)
+            return True
+        except pg.Error as ex:
+            # raise ex
+            self.rating_matrix = None
+            return False
+
+    @instrumented
+    def export_matrix(self, path: str) -> Optional[int]:
+        """Save the current contents of the derived tables, as
+        load_rating_matrix loads them, to a binary file at <path> (see
+        RatingMatrix.save), replacing any file there at once, and return
+        the SnapshotState version saved. MappedBackend serves recommend
+        from such a file. This requires NumPy.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        from rating_matrix import RatingMatrix
+        try:
+            with self._connection() as conn:
+                matrix = RatingMatrix.load(conn)
+            matrix.save(path)
+            return matrix.version
+        except (pg.Error, OSError) as ex:
+            # raise ex
+            return None
+
+    @instrumented
     def recommend_generic(self, k: int) -> Optional[list[int]]:
         """Return the item IDs of the <k> recommended items.
 
@@ -147,16 +783,252 @@ class Recommender:
               It also means that you can get full credit for this method even if
               you didn't implement Recommender.repopulate.
         """
-        # TODO - complete this method
+        if self.cache is not None:
+            recommended = self.cache.get(_GENERIC_KEY, k)
+            if recommended is not None:
+                return recommended
+        if self.backend is not None:
+            version = self._cache_version()
+            recommended = self.backend.recommend_generic(k)
+            if recommended is None:
+                return None
+        else:
+            try:
+                with self._connection() as conn, conn.cursor() as cur:
+                    version = self._cache_version(cur)
+                    _GENERIC_STATEMENT.execute(cur, {"k": k}, self.prepared)
+                    recommended = [row[0] for row in cur.fetchall()]
+                    conn.commit()
+            except pg.Error as ex:
+                # You may find it helpful to uncomment this line while
+                # debugging, as it will show you all the details of the
+                # error that occurred:
+                # raise ex
+                return None
+        if self.cache is not None:
+            self.cache.put(_GENERIC_KEY, k, recommended, version)
+        return recommended
+
+    def _cache_version(self, cur: Optional[pg_ext.cursor] = None
+                       ) -> Optional[int]:
+        """Return the snapshot version under which to cache answers about to
+        be computed, or None if answers are not cached.
+
+        If <cur> is given, the answers are computed by the database in its
+        transaction: the published version is read there first, so that no
+        answer is older than its version, and it becomes the version of
+        <cache> if it differs, e.g., after a repopulate through another
+        Recommender. Otherwise, the version of <cache> is kept.
+        """
+        if self.cache is None:
+            return None
+        if cur is None:
+            return self.cache.version
+        cur.execute(PUBLISHED_VERSION)
+        version = cur.fetchone()[0]
+        self.cache.set_version(version)
+        return version
+
+    def invalidate_customer(self, cust: int) -> None:
+        """Drop the cached recommendations for customer <cust>, if any.
+        Call this when <cust> reviews or buys something.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(cust)
+
+    def cache_stats(self) -> Optional[dict[str, int]]:
+        """Return the counters of <cache> (see ResultCache.stats), or None if
+        answers are not cached.
+        """
+        return None if self.cache is None else self.cache.stats()
+
+    @instrumented
+    def check_item_stats(self) -> Optional[list[int]]:
+        """Return the IDs of the items whose ItemStats counters disagree with
+        a fresh aggregation over LineItem and Review, in increasing order.
+        An empty list means that the counters are consistent.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT IID FROM ItemStatsDiscrepancy "
+                            "ORDER BY IID;")
+                mismatched = [row[0] for row in cur.fetchall()]
+                conn.commit()
+            return mismatched
+        except pg.Error as ex:
+            # You may find it helpful to uncomment this line while debugging,
+            # as it will show you all the details of the error that occurred:
+            # raise ex
+            return None
+
+    @instrumented
+    def check_analogous_raters(self) -> Optional[list[int]]:
+        """Return the IDs of the customers whose AnalogousRater tuple
+        disagrees with computing their elite analogous rater on the fly from
+        the published snapshot, in increasing order. An empty list means
+        that the table is consistent.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT CID FROM AnalogousRaterDiscrepancy "
+                            "ORDER BY CID;")
+                mismatched = [row[0] for row in cur.fetchall()]
+                conn.commit()
+            return mismatched
+        except pg.Error as ex:
+            # raise ex
+            return None
+
+    @instrumented
+    def check_category_sales(self) -> Optional[list[tuple]]:
+        """Return the (month, category) pairs whose CategoryMonthSales
+        tuple disagrees with a fresh aggregation over Purchase, LineItem and
+        Item, in increasing order. An empty list means that the rollup is
+        consistent.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT month, category "
+                            "FROM CategoryMonthSalesDiscrepancy "
+                            "ORDER BY month, category;")
+                mismatched = cur.fetchall()
+                conn.commit()
+            return mismatched
+        except pg.Error as ex:
+            # You may find it helpful to uncomment this line while debugging,
+            # as it will show you all the details of the error that occurred:
+            # raise ex
+            return None
+
+    @instrumented
+    def bulk_ingest(self, table: str, rows: Iterable[tuple],
+                    chunk_size: int = 10000,
+                    merge: bool = False) -> Optional[dict[str, float]]:
+        """Load <rows> into <table>, which is Purchase, LineItem or Review,
+        with COPY, <chunk_size> rows at a time, in a single transaction.
+        Each row is a tuple of the values of the columns of <table>, in the
+        order of schema.ddl.
+
+        Rows are checked on the client before they are sent (see
+        ingest.IngestTable.check); a row that breaks a rule raises
+        ValueError, and nothing is loaded.
+
+        If <merge> is True, rows whose key is already in <table> are
+        skipped instead of making the load fail, so that a load can be
+        replayed.
+
+        Return the number of rows given and inserted, the number of chunks,
+        the seconds taken and the rows loaded per second. Return None if a
+        database error occurs, e.g., a foreign key is violated, in which
+        case nothing is loaded.
+        """
+        start = perf_counter()
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                report = ingest(cur, table, rows, chunk_size, merge)
+                conn.commit()
+        except pg.Error as ex:
+            # You may find it helpful to uncomment this line while debugging,
+            # as it will show you all the details of the error that occurred:
+            # raise ex
+            return None
+        seconds = perf_counter() - start
+        return dict(report, seconds=seconds,
+                    rows_per_s=report["rows"] / seconds if seconds else 0.0)
+
+    @instrumented
+    def export_rows(self, table: str,
+                    itersize: int = 2000) -> Optional[Iterator[tuple]]:
+        """Return an iterator over the rows of <table>, which is one of the
+        tables of results of part 1 (q1 to q6), PopularItem, EliteRating or
+        a report view of reports.ddl (see export.EXPORTABLE).
+
+        Unlike fetchall, rows are read from a server-side cursor <itersize>
+        rows at a time, so memory use does not grow with the size of
+        <table>. The iterator holds a connection (of <pool>, if there is
+        one) until it is exhausted or closed, so it should be consumed
+        promptly; no other method may use <connection> meanwhile.
+
+        Raise ValueError if <table> cannot be exported. Return None if an
+        error occurs when the query is sent, e.g., <table> does not exist.
+        An error while reading rows is raised by the iterator.
+
+        Precondition:
+            - <itersize> > 0
+        """
+        rows = self._export_rows(table, itersize)
+        try:
+            next(rows)
+        except pg.Error as ex:
+            # You may find it helpful to uncomment this line while debugging,
+            # as it will show you all the details of the error that occurred:
+            # raise ex
+            return None
+        return rows
+
+    def _export_rows(self, table: str, itersize: int) -> Iterator[tuple]:
+        """Yield None once the query for the rows of <table> is sent, then
+        the rows themselves (see export_rows).
+        """
+        with self._connection() as conn:
+            try:
+                rows = stream_rows(conn, table, itersize)
+                yield None
+                yield from rows
+            finally:
+                # Nothing was changed, and ending the transaction drops the
+                # cursor, even if the rows were not all read.
+                conn.rollback()
+
+    @instrumented
+    def export_file(self, table: str, file: IO, fmt: str = "csv",
+                    header: bool = True) -> Optional[int]:
+        """Write the rows of <table> (see export_rows) to <file> with COPY,
+        in the format <fmt>: "csv" (with a header line if <header> is
+        True), "text" or "binary". <file> must be opened in binary mode for
+        "binary" and in text mode otherwise. Rows are written as they
+        arrive, so memory use does not grow with the size of <table>.
 
+        Return the number of rows written. Raise ValueError if <table>
+        cannot be exported or <fmt> is unknown. Return None if a database
+        error occurs.
+        """
         try:
-            pass
+            with self._connection() as conn, conn.cursor() as cur:
+                written = copy_to(cur, table, file, fmt, header)
+                conn.commit()
+            return written
         except pg.Error as ex:
             # You may find it helpful to uncomment this line while debugging,
             # as it will show you all the details of the error that occurred:
             # raise ex
             return None
 
+    @instrumented
+    def export_sqlite(self, path: str) -> Optional[dict[str, int]]:
+        """Write the tables that recommend and recommend_generic read, from
+        one consistent snapshot, to a new SQLite database at <path>, for a
+        Recommender whose backend is sqlite_backend.SQLiteBackend(<path>).
+
+        Return the number of rows written to each table, or None if an error
+        occurs i.e., do NOT throw an error.
+        """
+        try:
+            with self._connection() as conn:
+                return write_snapshot(conn, path)
+        except (pg.Error, sqlite3.Error, OSError) as ex:
+            # You may find it helpful to uncomment this line while debugging,
+            # as it will show you all the details of the error that occurred:
+            # raise ex
+            return None
+
+    @instrumented
     def recommend(self, cust: int, k: int) -> Optional[list[int]]:
         """Return the item IDs of the <k> recommended items for customer <cust>
         based on the algorithm outlined below.
@@ -210,15 +1082,97 @@ class Recommender:
               It also means that you can get full credit for this method even if
               you didn't implement Recommender.repopulate.
         """
-        # TODO - complete this method
+        recommended = self.recommend_many([cust], k)
+        return None if recommended is None else recommended[cust]
 
-        try:
-            pass
-        except pg.Error as ex:
-            # You may find it helpful to uncomment this line while debugging,
-            # as it will show you all the details of the error that occurred:
-            # raise ex
-            return None
+    @instrumented
+    def recommend_many(self, cids: Iterable[int], k: int,
+                       chunk_size: int = 10000
+                       ) -> Optional[dict[int, list[int]]]:
+        """Return a dictionary mapping each customer ID in <cids> to the item
+        IDs of the <k> items recommended for them, exactly as
+        Recommender.recommend would.
+
+        Instead of one round trip per customer, the elite analogous raters
+        and their top-rated items are found for <chunk_size> customers at a
+        time in a single query. Customers with no elite-based recommendation
+        all share one lookup of the generic recommendations.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+
+        Preconditions:
+            - <k> > 0
+            - <chunk_size> > 0
+            - Every customer in <cids> satisfies the preconditions of
+              Recommender.recommend.
+        """
+        if self.cache is None:
+            answer = self._recommend_uncached(list(dict.fromkeys(cids)), k,
+                                              chunk_size)
+            return None if answer is None else answer[0]
+
+        recommended = {cust: self.cache.get(cust, k) for cust in cids}
+        missing = [cust for cust, items in recommended.items()
+                   if items is None]
+        if missing:
+            answer = self._recommend_uncached(missing, k, chunk_size)
+            if answer is None:
+                return None
+            computed, version = answer
+            for cust, items in computed.items():
+                recommended[cust] = items
+                self.cache.put(cust, k, items, version)
+        return recommended
+
+    def _recommend_uncached(self, customers: list[int], k: int,
+                            chunk_size: int
+                            ) -> Optional[tuple[dict[int, list[int]],
+                                                Optional[int]]]:
+        """Return recommend_many(<customers>, <k>, <chunk_size>), computed
+        without consulting <cache>, and the snapshot version under which to
+        cache it (see _cache_version). The IDs in <customers> must be
+        distinct.
+        """
+        if self.rating_matrix is not None:
+            return {cust: self.rating_matrix.recommend(cust, k)
+                    for cust in customers}, self._cache_version()
+
+        recommended = {cust: [] for cust in customers}
+        if self.backend is not None:
+            version = self._cache_version()
+            for start in range(0, len(customers), chunk_size):
+                elite = self.backend.recommend_elite(
+                    customers[start:start + chunk_size], k)
+                if elite is None:
+                    return None
+                recommended.update(elite)
+        else:
+            try:
+                with self._connection() as conn, conn.cursor() as cur:
+                    version = self._cache_version(cur)
+                    for start in range(0, len(customers), chunk_size):
+                        _ELITE_STATEMENT.execute(cur, {
+                            "cids": customers[start:start + chunk_size],
+                            "k": k
+                        }, self.prepared)
+                        for cust, item in cur.fetchall():
+                            recommended[cust].append(item)
+                    conn.commit()
+            except pg.Error as ex:
+                # You may find it helpful to uncomment this line while
+                # debugging, as it will show you all the details of the
+                # error that occurred:
+                # raise ex
+                return None
+
+        if not all(recommended.values()):
+            generic = self.recommend_generic(k)
+            if generic is None:
+                return None
+            for cust, items in recommended.items():
+                if not items:
+                    recommended[cust] = list(generic)
+        return recommended, version
 
 
 if __name__ == "__main__":
@@ -0,0 +1,272 @@
+"""
+Part3 of csc343 A2: an asyncio version of the recommender.
+
+AsyncRecommender has the same contract as Recommender, but its methods are
+coroutines. It drives psycopg2 connections in asynchronous mode from the
+event loop, so no thread is blocked while a query runs, and many calls can
+be in flight at once over a small set of connections.
+"""
+import asyncio
+from typing import Iterable, Optional
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+from a2 import (ELITE_RECOMMENDATIONS, GENERIC_RECOMMENDATIONS,
+                LOCK_SNAPSHOT_STATE, NEW_SNAPSHOT, PRUNE_SNAPSHOTS,
+                PUBLISH_SNAPSHOT, REBUILD_CATEGORIES, TAKE_DIRTY_CATEGORIES)
+
+
+class AsyncRecommender:
+    """A recommender like Recommender, for use from asyncio code.
+
+    === Instance Attributes ===
+    size: The number of connections used to serve concurrent calls.
+    keep_snapshots: The number of snapshots that repopulate keeps besides
+        the one it publishes, as Recommender.keep_snapshots.
+
+    Representation invariants:
+    - The database that the connections are made to conforms to the schema
+      in schema.sql.
+    - Each connection in _idle is open and not executing a query, or is
+      None if it has to be reopened before it is used.
+    """
+    size: int
+    keep_snapshots: int
+    _params: dict[str, str]
+    _idle: Optional[asyncio.Queue]
+    _connections: list[pg_ext.connection]
+
+    def __init__(self, size: int = 4, keep_snapshots: int = 0) -> None:
+        """Initialize this AsyncRecommender, with no database connections
+        yet. Up to <size> calls will run queries at the same time.
+        repopulate keeps <keep_snapshots> replaced snapshots, as
+        Recommender's does.
+        """
+        self.size = size
+        self.keep_snapshots = keep_snapshots
+        self._params = {}
+        self._idle = None
+        self._connections = []
+
+    async def connect(self, dbname: str, username: str,
+                      password: str) -> bool:
+        """Establish <size> connections to the database <dbname> using the
+        username <username> and password <password>, with the search path
+        set to recommender.
+
+        Return True if the connections were made successfully, False
+        otherwise. I.e., do NOT throw an error if making them fails.
+        """
+        self._params = {"dbname": dbname, "user": username,
+                        "password": password,
+                        "options": "-c search_path=recommender,public"}
+        self._idle = asyncio.Queue()
+        try:
+            for _ in range(self.size):
+                self._idle.put_nowait(await self._open())
+            return True
+        except pg.Error:
+            await self.disconnect()
+            return False
+
+    async def disconnect(self) -> bool:
+        """Close all the database connections.
+
+        Return True if closing the connections was successful, False
+        otherwise. I.e., do NOT throw an error if closing them failed.
+        """
+        try:
+            for conn in self._connections:
+                if not conn.closed:
+                    conn.close()
+            self._connections = []
+            return True
+        except pg.Error:
+            return False
+
+    async def repopulate(self, full: bool = False) -> bool:
+        """Repopulate PopularItem and EliteRating, as Recommender.repopulate
+        does.
+
+        Return True if the repopulation was successful, False otherwise.
+        I.e., do NOT throw an error if an error occurs.
+        """
+        conn = await self._checkout()
+        try:
+            # Asynchronous connections are always in autocommit mode, so
+            # the transaction has to be managed explicitly.
+            await self._execute(conn, "BEGIN;")
+            try:
+                rows = await self._execute(conn, LOCK_SNAPSHOT_STATE)
+                needs_full, version = rows[0]
+                dirty = [row[0] for row in
+                         await self._execute(conn, TAKE_DIRTY_CATEGORIES)]
+                if full or needs_full or dirty:
+                    rows = await self._execute(conn, NEW_SNAPSHOT)
+                    params = {"old": version, "new": rows[0][0],
+                              "all": full or needs_full, "cats": dirty,
+                              "stale": False, "keep": self.keep_snapshots}
+                    for statement in REBUILD_CATEGORIES:
+                        await self._execute(conn, statement, params)
+                    await self._execute(conn, PUBLISH_SNAPSHOT, params)
+                    await self._execute(conn, PRUNE_SNAPSHOTS, params)
+                await self._execute(conn, "COMMIT;")
+            except pg.Error:
+                await self._execute(conn, "ROLLBACK;")
+                raise
+            return True
+        except pg.Error as ex:
+            # raise ex
+            return False
+        finally:
+            self._checkin(conn)
+
+    async def recommend_generic(self, k: int) -> Optional[list[int]]:
+        """Return the item IDs of the <k> recommended items, as
+        Recommender.recommend_generic does.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        conn = await self._checkout()
+        try:
+            rows = await self._execute(conn, GENERIC_RECOMMENDATIONS,
+                                       {"k": k})
+            return [row[0] for row in rows]
+        except pg.Error as ex:
+            # raise ex
+            return None
+        finally:
+            self._checkin(conn)
+
+    async def recommend(self, cust: int, k: int) -> Optional[list[int]]:
+        """Return the item IDs of the <k> recommended items for customer
+        <cust>, as Recommender.recommend does.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        recommended = await self.recommend_many([cust], k)
+        return None if recommended is None else recommended[cust]
+
+    async def recommend_many(self, cids: Iterable[int], k: int,
+                             chunk_size: int = 10000
+                             ) -> Optional[dict[int, list[int]]]:
+        """Return a dictionary mapping each customer ID in <cids> to the item
+        IDs of the <k> items recommended for them, as
+        Recommender.recommend_many does.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        recommended = {cust: [] for cust in cids}
+        customers = list(recommended)
+        conn = await self._checkout()
+        try:
+            for start in range(0, len(customers), chunk_size):
+                rows = await self._execute(conn, ELITE_RECOMMENDATIONS, {
+                    "cids": customers[start:start + chunk_size], "k": k})
+                for cust, item in rows:
+                    recommended[cust].append(item)
+        except pg.Error as ex:
+            # raise ex
+            return None
+        finally:
+            self._checkin(conn)
+
+        if not all(recommended.values()):
+            generic = await self.recommend_generic(k)
+            if generic is None:
+                return None
+            for cust, items in recommended.items():
+                if not items:
+                    recommended[cust] = list(generic)
+        return recommended
+
+    async def _open(self) -> pg_ext.connection:
+        """Return a new asynchronous connection, once it is ready for use.
+        """
+        conn = pg.connect(async_=1, **self._params)
+        self._connections.append(conn)
+        try:
+            await _wait(conn)
+        except pg.Error:
+            conn.close()
+            self._connections.remove(conn)
+            raise
+        return conn
+
+    async def _checkout(self) -> Optional[pg_ext.connection]:
+        """Wait for an idle connection and return it, reopening it first if
+        it was discarded. Return None if it cannot be reopened.
+        """
+        conn = await self._idle.get()
+        if conn is None:
+            try:
+                conn = await self._open()
+            except pg.Error:
+                self._idle.put_nowait(None)
+                return None
+        return conn
+
+    def _checkin(self, conn: Optional[pg_ext.connection]) -> None:
+        """Make <conn> available to other calls again. A connection that is
+        broken, or still busy because its call was cancelled, is closed and
+        will be reopened when it is next checked out.
+        """
+        if conn is not None and (conn.closed or conn.isexecuting()):
+            if not conn.closed:
+                conn.close()
+            self._connections.remove(conn)
+            conn = None
+        self._idle.put_nowait(conn)
+
+    async def _execute(self, conn: Optional[pg_ext.connection], query: str,
+                       params: Optional[dict] = None) -> list[tuple]:
+        """Run <query> with <params> on <conn> and return the rows it
+        produces, if any.
+
+        Raise a psycopg2.Error if <conn> is None or the query fails.
+        """
+        if conn is None:
+            raise pg.InterfaceError("no database connection available")
+        cur = conn.cursor()
+        try:
+            cur.execute(query, params)
+            await _wait(conn)
+            return cur.fetchall() if cur.description is not None else []
+        finally:
+            cur.close()
+
+
+async def _wait(conn: pg_ext.connection) -> None:
+    """Return once the operation in progress on the asynchronous connection
+    <conn> has completed, yielding to the event loop while it is waiting
+    for the server.
+
+    Raise a psycopg2.Error if the operation failed.
+    """
+    loop = asyncio.get_running_loop()
+    fd = conn.fileno()
+    while True:
+        state = conn.poll()
+        if state == pg_ext.POLL_OK:
+            return
+        ready = loop.create_future()
+        if state == pg_ext.POLL_READ:
+            loop.add_reader(fd, _resolve, ready)
+            remove = loop.remove_reader
+        elif state == pg_ext.POLL_WRITE:
+            loop.add_writer(fd, _resolve, ready)
+            remove = loop.remove_writer
+        else:
+            raise pg.OperationalError(f"unexpected poll state {state}")
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+def _resolve(future: asyncio.Future) -> None:
+    """Mark <future> as done, unless it already is.
+    """
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,232 @@
+"""
+Part3 of csc343 A2: compare the year-scoped reports on the plain layout of
+Purchase and LineItem with the partitioned one (see partitioned.ddl).
+
+A synthetic dataset spanning several years (see datagen.py) is loaded with
+schema.ddl, the workloads are measured, the tables are migrated with
+partitioned.ddl, and the workloads are measured again. For each, the median
+execution time, the rows read by scans, the buffers touched and the number
+of tables (or partitions) scanned are reported, from EXPLAIN ANALYZE. The
+scripts (u2, as a whole) are run the same way on both layouts, and for each,
+the median wall time and the rows read and tables read from, from
+pg_stat_xact_user_tables, are reported.
+
+Usage:
+    python bench_partitions.py csc343h-username username "" \\
+        --rows 1000000 --years 12 --out partitions.json
+"""
+import argparse
+import json
+import statistics
+import sys
+from time import perf_counter
+from typing import Any
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+from datagen import DataConfig, load
+
+# Make the 20 latest purchases of the dataset with the same card, so that u2
+# has 15 fraudulent purchases to delete.
+_CARD_BURST = """
+    UPDATE Purchase SET card_pan = '4000000000000000'
+    WHERE PID IN (SELECT PID FROM Purchase
+                  ORDER BY checkout_time DESC LIMIT 20);
+"""
+
+# The scripts, by name, with the statement that sets up their data, run
+# unchanged on both layouts, except that NOW() is the time of the latest
+# purchase of the dataset.
+SCRIPTS = {
+    "u2 (last 24 hours)": ("../part2/u2.sql", _CARD_BURST),
+}
+
+# The workloads, by name, as run on the plain layout and on the partitioned
+# one. Since the plain LineItem does not record when it was bought, the
+# plain versions of the year-scoped reports filter Purchase only.
+WORKLOADS = {
+    "q5 (one year)": ("""
+        WITH Units AS (
+            SELECT p.CID, SUM(li.quantity) AS items,
+                DENSE_RANK() OVER (ORDER BY SUM(li.quantity) DESC) AS place
+            FROM Purchase p JOIN LineItem li ON li.PID = p.PID
+            WHERE p.checkout_time >= make_date(%(year)s, 1, 1)
+                AND p.checkout_time < make_date(%(year)s + 1, 1, 1)
+            GROUP BY p.CID
+        )
+        SELECT %(year)s::VARCHAR(4), c.first_name || ' ' || c.last_name,
+            c.email, u.items
+        FROM Units u JOIN Customer c ON c.CID = u.CID
+        WHERE u.place <= 5;
+    """, "SELECT * FROM hyperconsumers(%(year)s);"),
+    "q6 (two years)": ("""
+        WITH Units AS (
+            SELECT li.IID,
+                SUM(li.quantity) FILTER (
+                    WHERE p.checkout_time < make_date(%(year)s, 1, 1))
+                    AS units1,
+                SUM(li.quantity) FILTER (
+                    WHERE p.checkout_time >= make_date(%(year)s, 1, 1))
+                    AS units2
+            FROM Purchase p JOIN LineItem li ON li.PID = p.PID
+            WHERE p.checkout_time >= make_date(%(year)s - 1, 1, 1)
+                AND p.checkout_time < make_date(%(year)s + 1, 1, 1)
+            GROUP BY li.IID
+        )
+        SELECT i.IID, COALESCE(u.units1, 0)::FLOAT / 12,
+            COALESCE(u.units2, 0)::FLOAT / 12
+        FROM Item i LEFT JOIN Units u ON u.IID = i.IID;
+    """, "SELECT * FROM year_over_year(%(year)s - 1);"),
+}
+
+
+def _scans(plan: dict[str, Any]) -> list[dict[str, Any]]:
+    """Return the scan nodes of <plan> and of all the plans below it.
+    """
+    nodes = [plan] if "Relation Name" in plan else []
+    for child in plan.get("Plans", []):
+        nodes.extend(_scans(child))
+    return nodes
+
+
+def explain(cur: pg_ext.cursor, query: str, params: dict[str, Any],
+            repeats: int) -> dict[str, Any]:
+    """Run <query> with <params> <repeats> times under EXPLAIN ANALYZE, and
+    return its median execution time, and the rows read, buffers touched
+    and relations scanned by its last run.
+    """
+    times = []
+    for _ in range(repeats):
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query,
+                    params)
+        result = cur.fetchone()[0][0]
+        times.append(result["Execution Time"])
+    plan = result["Plan"]
+    scans = _scans(plan)
+    return {
+        "ms": statistics.median(times),
+        "rows_scanned": sum((node["Actual Rows"]
+                             + node.get("Rows Removed by Filter", 0))
+                            * node["Actual Loops"] for node in scans),
+        "buffers": plan.get("Shared Hit Blocks", 0)
+        + plan.get("Shared Read Blocks", 0),
+        "relations": len({node["Relation Name"] for node in scans
+                          if node["Actual Loops"]}),
+    }
+
+
+def _table_reads(cur: pg_ext.cursor) -> dict[str, int]:
+    """Return the rows read so far, by table, as counted by
+    pg_stat_xact_user_tables.
+    """
+    cur.execute("SELECT relname, seq_tup_read + COALESCE(idx_tup_fetch, 0) "
+                "FROM pg_stat_xact_user_tables;")
+    return dict(cur.fetchall())
+
+
+def run_script(cur: pg_ext.cursor, script: str, setup: str,
+               params: dict[str, Any], repeats: int) -> dict[str, Any]:
+    """Run the statements of <script>, with NOW() replaced by <params>["now"],
+    after those of <setup>, <repeats> times, each time undoing their changes,
+    and return its median wall time, and the rows read and tables read from
+    by its last run.
+
+    A table counts only if rows were read from it: a sequential scan is
+    counted as soon as it is set up, even if it is never run.
+    """
+    script = script.replace("NOW()", "%(now)s::TIMESTAMP")
+    times = []
+    for _ in range(repeats):
+        cur.execute("SAVEPOINT script;")
+        cur.execute(setup)
+        before = _table_reads(cur)
+        start = perf_counter()
+        cur.execute(script, params)
+        times.append((perf_counter() - start) * 1000)
+        after = _table_reads(cur)
+        cur.execute("ROLLBACK TO SAVEPOINT script;")
+    read = [rows - before.get(name, 0) for name, rows in after.items()]
+    return {
+        "ms": statistics.median(times),
+        "rows_scanned": sum(read),
+        "relations": sum(1 for rows in read if rows),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare year-scoped reports on plain and partitioned "
+                    "Purchase and LineItem tables.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--schema", default="../schema.ddl")
+    parser.add_argument("--partitioned", default="../partitioned.ddl")
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--years", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--out", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    conn = pg.connect(dbname=args.dbname, user=args.user,
+                      password=args.password,
+                      options="-c search_path=recommender,public")
+    try:
+        with conn.cursor() as cur, open(args.schema) as schema:
+            cur.execute(schema.read())
+        conn.commit()
+        config = DataConfig.scaled(args.rows, seed=args.seed,
+                                   years=args.years)
+        loaded = load(conn, config)
+        with conn.cursor() as cur:
+            cur.execute("SELECT MAX(checkout_time) FROM Purchase;")
+            latest = cur.fetchone()[0]
+        conn.commit()
+        params = {"now": latest, "year": latest.year}
+
+        results = {"rows": sum(loaded.values()), "years": args.years,
+                   "workloads": {}}
+        for layout in ("plain", "partitioned"):
+            if layout == "partitioned":
+                start = perf_counter()
+                with conn.cursor() as cur, open(args.partitioned) as ddl:
+                    cur.execute(ddl.read())
+                conn.commit()
+                results["migration_s"] = perf_counter() - start
+            with conn.cursor() as cur:
+                for name, queries in WORKLOADS.items():
+                    query = queries[layout == "partitioned"]
+                    measured = explain(cur, query, params, args.repeats)
+                    results["workloads"].setdefault(name, {})[layout] = \
+                        measured
+                for name, (path, setup) in SCRIPTS.items():
+                    with open(path) as script:
+                        measured = run_script(cur, script.read(), setup,
+                                              params, args.repeats)
+                    results["workloads"].setdefault(name, {})[layout] = \
+                        measured
+            conn.rollback()
+    finally:
+        conn.close()
+
+    print(f"{results['rows']:,} rows over {args.years} years; migration "
+          f"took {results['migration_s']:.1f} s", file=sys.stderr)
+    for name, layouts in results["workloads"].items():
+        plain, partitioned = layouts["plain"], layouts["partitioned"]
+        print(f"{name:20} {plain['ms']:9.2f} -> {partitioned['ms']:8.2f} ms"
+              f"  rows {plain['rows_scanned']:>10,} -> "
+              f"{partitioned['rows_scanned']:>9,}"
+              + (f"  buffers {plain['buffers']:>7,} -> "
+                 f"{partitioned['buffers']:>6,}" if "buffers" in plain
+                 else "")
+              + f"  relations {plain['relations']} -> "
+              f"{partitioned['relations']}", file=sys.stderr)
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Part3 of csc343 A2: compare the per-call latency of recommend and
+recommend_generic with and without server-side prepared statements.
+
+Run it against a database that has already been loaded and repopulated:
+
+    python bench_prepared.py csc343h-username username "" --calls 2000
+"""
+import argparse
+import statistics
+from time import perf_counter
+from typing import Callable
+
+from a2 import Recommender
+
+
+def time_calls(call: Callable[[int], object], calls: int) -> list[float]:
+    """Return the latency in milliseconds of each of <calls> calls to
+    <call>, which is passed the number of the call.
+    """
+    latencies = []
+    for i in range(calls):
+        start = perf_counter()
+        call(i)
+        latencies.append((perf_counter() - start) * 1000)
+    return latencies
+
+
+def summarize(latencies: list[float]) -> str:
+    """Return a one-line summary of <latencies>, in milliseconds.
+    """
+    cuts = statistics.quantiles(latencies, n=100)
+    return f"mean {statistics.fmean(latencies):7.3f}  " \
+        f"p50 {cuts[49]:7.3f}  p95 {cuts[94]:7.3f}  p99 {cuts[98]:7.3f}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--calls", type=int, default=1000,
+                        help="calls per method and setting")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    probe = Recommender()
+    if not probe.connect(args.dbname, args.user, args.password):
+        raise SystemExit("Could not connect to the database.")
+    with probe.connection.cursor() as cur:
+        cur.execute("SELECT CID FROM Customer "
+                    "WHERE CID NOT IN (SELECT CID FROM EliteMember) "
+                    "ORDER BY CID;")
+        customers = [row[0] for row in cur.fetchall()]
+    probe.disconnect()
+    if not customers:
+        raise SystemExit("There are no non-elite customers to recommend to.")
+
+    for prepared in (False, True):
+        rec = Recommender(prepared=prepared)
+        rec.connect(args.dbname, args.user, args.password)
+        try:
+            # Warm up, so that preparing is not part of the measurements.
+            rec.recommend_generic(args.k)
+            rec.recommend(customers[0], args.k)
+            generic = time_calls(lambda i: rec.recommend_generic(args.k),
+                                 args.calls)
+            recommend = time_calls(
+                lambda i: rec.recommend(customers[i % len(customers)],
+                                        args.k), args.calls)
+        finally:
+            rec.disconnect()
+        label = "prepared  " if prepared else "unprepared"
+        print(f"{label} recommend_generic  {summarize(generic)}")
+        print(f"{label} recommend          {summarize(recommend)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Part3 of csc343 A2: measure the speedup of a sharded repopulate (see
+Recommender.repopulate_workers) over the number of categories and workers.
+
+For each number of categories, a synthetic dataset (see datagen.py) is
+loaded with schema.ddl, and a full repopulate is timed with each number of
+workers. The median time of each, and its speedup over 1 worker, are
+reported, together with the number of cores of this machine: the shards
+only run at the same time if the server has cores to spare.
+
+Usage:
+    python bench_repopulate.py csc343h-username username "" \\
+        --rows 1000000 --categories 5 50 500 --workers 1 2 4 8
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+from time import perf_counter
+
+import psycopg2 as pg
+
+from a2 import Recommender
+from datagen import DataConfig, load
+
+
+def time_repopulate(rec: Recommender, repeats: int) -> float:
+    """Return the median time, in seconds, of <repeats> full repopulates by
+    <rec>. Raise RuntimeError if one fails.
+    """
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        if not rec.repopulate(full=True):
+            raise RuntimeError("repopulate failed")
+        times.append(perf_counter() - start)
+    return statistics.median(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure the speedup of a sharded repopulate.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--schema", default="../schema.ddl")
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--categories", type=int, nargs="+",
+                        default=[5, 50, 500])
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--out", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    results = {"rows": args.rows, "cores": os.cpu_count(), "runs": []}
+    for categories in args.categories:
+        conn = pg.connect(dbname=args.dbname, user=args.user,
+                          password=args.password,
+                          options="-c search_path=recommender,public")
+        try:
+            with conn.cursor() as cur, open(args.schema) as schema:
+                cur.execute(schema.read())
+            conn.commit()
+            config = DataConfig.scaled(args.rows, seed=args.seed,
+                                       categories=categories)
+            load(conn, config)
+        finally:
+            conn.close()
+
+        baseline = None
+        for workers in args.workers:
+            rec = Recommender(repopulate_workers=workers)
+            if not rec.connect(args.dbname, args.user, args.password):
+                raise RuntimeError(f"cannot connect to {args.dbname}")
+            try:
+                seconds = time_repopulate(rec, args.repeats)
+            finally:
+                rec.disconnect()
+            baseline = baseline or seconds
+            results["runs"].append({
+                "categories": config.categories, "workers": workers,
+                "seconds": seconds, "speedup": baseline / seconds})
+
+    print(f"{results['rows']:,} rows on {results['cores']} cores",
+          file=sys.stderr)
+    for run in results["runs"]:
+        print(f"{run['categories']:>5} categories  {run['workers']:>2} "
+              f"workers  {run['seconds'] * 1000:9.1f} ms  "
+              f"x{run['speedup']:.2f}", file=sys.stderr)
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Part3 of csc343 A2: a benchmark of Recommender across data scales.
+
+For each scale, the schema is reloaded, a synthetic dataset of about that
+many rows is generated (see datagen.py), and the following are timed:
+    - repopulate (a full rebuild),
+    - recommend_generic(k) for each k, and
+    - recommend(cust, k) for each k, over a sample of non-elite customers.
+
+For each of them, the p50/p95/p99 latency, the throughput and the number of
+rows the server scanned are reported, and all results are written as JSON.
+Given the JSON of an earlier run as a baseline, the run fails if any p95
+latency got worse by more than the threshold.
+
+Usage:
+    python benchmark.py csc343h-username username "" \\
+        --scales 10000 100000 --out bench.json --baseline old.json
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Any, Callable
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+from a2 import Recommender
+from datagen import DataConfig, load
+
+# The metric compared against the baseline to detect regressions.
+REGRESSION_METRIC = "p95_ms"
+
+
+def latency_summary(latencies: list[float], elapsed: float) -> dict[str, Any]:
+    """Return the percentiles, in milliseconds, of <latencies>, which are in
+    seconds, and the throughput of making the calls in <elapsed> seconds.
+    """
+    ms = sorted(latency * 1000 for latency in latencies)
+    if len(ms) > 1:
+        cuts = statistics.quantiles(ms, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = ms[0]
+    return {"calls": len(ms), "mean_ms": statistics.fmean(ms),
+            "p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "max_ms": ms[-1],
+            "throughput_per_s": len(ms) / elapsed if elapsed else None}
+
+
+def rows_scanned(connection: pg_ext.connection) -> int:
+    """Return the number of rows read so far from the tables of the
+    recommender schema, by sequential and index scans, as counted by the
+    statistics collector.
+    """
+    with connection.cursor() as cur:
+        cur.execute("SELECT pg_stat_clear_snapshot();")
+        cur.execute("""
+            SELECT COALESCE(SUM(COALESCE(seq_tup_read, 0)
+                                + COALESCE(idx_tup_fetch, 0)), 0)
+            FROM pg_stat_user_tables WHERE schemaname = 'recommender';
+        """)
+        scanned = int(cur.fetchone()[0])
+    connection.commit()
+    return scanned
+
+
+def flush_stats(connection: pg_ext.connection) -> None:
+    """Make the statistics of the session of <connection> visible to other
+    sessions right away, if the server supports it (PostgreSQL 15+).
+    """
+    with connection.cursor() as cur:
+        try:
+            cur.execute("SELECT pg_stat_force_next_flush();")
+        except pg.Error:
+            pass
+    connection.rollback()
+
+
+def measure(rec: Recommender, observer: pg_ext.connection,
+            call: Callable[[int], Any], calls: int) -> dict[str, Any]:
+    """Return the latency summary of <calls> calls to <call>, which is
+    passed the number of the call, made through <rec>, and the number of
+    rows scanned by them as seen from <observer>.
+
+    The first call is made once beforehand, untimed, so that connecting and
+    preparing statements are not part of the measurements.
+
+    Raise RuntimeError if a call fails.
+    """
+    call(0)
+    before = rows_scanned(observer)
+    latencies = []
+    start = perf_counter()
+    for i in range(calls):
+        call_start = perf_counter()
+        result = call(i)
+        latencies.append(perf_counter() - call_start)
+        if result is None or result is False:
+            raise RuntimeError("a Recommender call failed")
+    elapsed = perf_counter() - start
+    flush_stats(rec.connection)
+    summary = latency_summary(latencies, elapsed)
+    summary["rows_scanned"] = rows_scanned(observer) - before
+    return summary
+
+
+def run_scale(args: argparse.Namespace, scale: int) -> list[dict[str, Any]]:
+    """Load a dataset of about <scale> rows and return the results of
+    benchmarking it.
+    """
+    observer = pg.connect(dbname=args.dbname, user=args.user,
+                          password=args.password,
+                          options="-c search_path=recommender,public")
+    rec = Recommender()
+    try:
+        with observer.cursor() as cur, open(args.schema) as schema:
+            cur.execute(schema.read())
+        observer.commit()
+        config = DataConfig.scaled(scale, seed=args.seed)
+        loaded = load(observer, config)
+        if not rec.connect(args.dbname, args.user, args.password):
+            raise RuntimeError("could not connect to the database")
+
+        with observer.cursor() as cur:
+            cur.execute("SELECT CID FROM Customer "
+                        "WHERE CID NOT IN (SELECT CID FROM EliteMember);")
+            customers = sorted(row[0] for row in cur.fetchall())
+        observer.commit()
+        sample = random.Random(args.seed).sample(
+            customers, min(args.customers, len(customers)))
+
+        results = []
+
+        def record(name: str, k: Any, summary: dict[str, Any]) -> None:
+            results.append(dict(summary, scale=scale,
+                                rows=sum(loaded.values()), name=name, k=k))
+            print(f"{scale:>10} {name:18} k={str(k):4} "
+                  f"p50 {summary['p50_ms']:9.3f} ms  "
+                  f"p95 {summary['p95_ms']:9.3f} ms  "
+                  f"p99 {summary['p99_ms']:9.3f} ms  "
+                  f"{summary['throughput_per_s']:9.1f}/s  "
+                  f"{summary['rows_scanned']:>12,} rows", file=sys.stderr)
+
+        record("repopulate", None, measure(
+            rec, observer, lambda i: rec.repopulate(full=True),
+            args.repeats))
+        for k in args.ks:
+            record("recommend_generic", k, measure(
+                rec, observer, lambda i: rec.recommend_generic(k),
+                args.calls))
+        for k in args.ks:
+            record("recommend", k, measure(
+                rec, observer, lambda i: rec.recommend(sample[i % len(sample)],
+                                                       k), len(sample)))
+        return results
+    finally:
+        rec.disconnect()
+        observer.close()
+
+
+def find_regressions(baseline: dict[str, Any], current: dict[str, Any],
+                     threshold: float) -> list[str]:
+    """Return a description of each result in <current> whose
+    REGRESSION_METRIC is more than <threshold> (a fraction) worse than that
+    of the result for the same scale, method and k in <baseline>.
+    """
+    def key(result: dict[str, Any]) -> tuple:
+        return result["scale"], result["name"], result["k"]
+
+    before = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = before.get(key(result))
+        if old is None or not old[REGRESSION_METRIC]:
+            continue
+        change = result[REGRESSION_METRIC] / old[REGRESSION_METRIC] - 1
+        if change > threshold:
+            scale, name, k = key(result)
+            regressions.append(
+                f"{name} (scale {scale}, k={k}): {REGRESSION_METRIC} "
+                f"{old[REGRESSION_METRIC]:.3f} -> "
+                f"{result[REGRESSION_METRIC]:.3f} ({change:+.0%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark Recommender across data scales.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--schema", default="../schema.ddl")
+    parser.add_argument("--scales", type=int, nargs="+",
+                        default=[10000, 100000])
+    parser.add_argument("--ks", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--calls", type=int, default=200,
+                        help="calls to recommend_generic per k")
+    parser.add_argument("--customers", type=int, default=200,
+                        help="customers sampled for recommend")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="calls to repopulate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="file to write the JSON results to")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="largest allowed slowdown, as a fraction")
+    args = parser.parse_args()
+
+    with pg.connect(dbname=args.dbname, user=args.user,
+                    password=args.password) as conn:
+        server_version = conn.server_version
+    conn.close()
+    report = {"created": datetime.now(timezone.utc).isoformat(),
+              "server_version": server_version,
+              "seed": args.seed, "results": []}
+    for scale in args.scales:
+        report["results"].extend(run_scale(args, scale))
+
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(report, out, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = find_regressions(json.load(baseline), report,
+                                           args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Part3 of csc343 A2: a connection pool for serving the recommender from many
+threads at once.
+"""
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterator, Optional
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+import psycopg2.pool as pg_pool
+
+
+class ConnectionPool:
+    """A thread-safe pool of between <minconn> and <maxconn> connections.
+
+    Connections are opened as they are needed, up to <maxconn>, and kept
+    open once returned, so that each one is only opened once, and keeps its
+    prepared statements. Unlike psycopg2's ThreadedConnectionPool, which
+    closes returned connections beyond <minconn> and raises PoolError as
+    soon as all connections are in use, checking out a connection waits
+    until one is returned to the pool.
+
+    === Instance Attributes ===
+    minconn: The number of connections opened up front.
+    maxconn: The maximum number of connections open at once.
+    timeout: The number of seconds to wait for a free connection before
+        giving up, or None to wait forever.
+    closed: Whether close was called.
+
+    Representation invariants:
+    - 0 <= minconn <= maxconn
+    - len(_idle) + the number of connections checked out <= maxconn
+    """
+    minconn: int
+    maxconn: int
+    timeout: Optional[float]
+    closed: bool
+    _kwargs: dict
+    _idle: list[pg_ext.connection]
+    _slots: threading.BoundedSemaphore
+    _lock: threading.Lock
+    _stats: dict[str, float]
+
+    def __init__(self, minconn: int, maxconn: int,
+                 timeout: Optional[float] = None, **kwargs) -> None:
+        """Initialize this pool and open its first <minconn> connections,
+        passing <kwargs> to psycopg2.connect.
+
+        Raise a psycopg2.Error if a connection cannot be made.
+        """
+        self.minconn, self.maxconn, self.timeout = minconn, maxconn, timeout
+        self.closed = False
+        self._kwargs = kwargs
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._stats = {"checkouts": 0, "in_use": 0, "waiting": 0,
+                       "max_in_use": 0, "opened": 0, "total_wait": 0.0,
+                       "max_wait": 0.0, "total_checkout": 0.0,
+                       "max_checkout": 0.0}
+        try:
+            for _ in range(minconn):
+                self._idle.append(self._open())
+        except pg.Error:
+            self.close()
+            raise
+
+    def _open(self) -> pg_ext.connection:
+        """Open a new connection, and count it.
+        """
+        conn = pg.connect(**self._kwargs)
+        with self._lock:
+            self._stats["opened"] += 1
+        return conn
+
+    def _get(self) -> pg_ext.connection:
+        """Return an idle connection, or a new one if there is none.
+        """
+        with self._lock:
+            if self.closed:
+                raise pg_pool.PoolError("connection pool is closed")
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def _put(self, conn: pg_ext.connection) -> None:
+        """Return <conn> to the idle connections, rolling back the
+        transaction it left open. Close it instead if it is broken, or if
+        this pool is closed.
+        """
+        if not conn.closed:
+            status = conn.info.transaction_status
+            if status == pg_ext.TRANSACTION_STATUS_UNKNOWN:
+                conn.close()
+            elif status != pg_ext.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except pg.Error:
+                    conn.close()
+        with self._lock:
+            if not conn.closed and not self.closed:
+                self._idle.append(conn)
+                return
+        if not conn.closed:
+            conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[pg_ext.connection]:
+        """Check out a connection for the duration of the with block, waiting
+        for one to be returned if all <maxconn> are in use.
+
+        A transaction left open by the with block is rolled back when the
+        connection is returned. Raise psycopg2.pool.PoolError if no
+        connection becomes free within <timeout> seconds.
+        """
+        start = perf_counter()
+        with self._lock:
+            self._stats["waiting"] += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = perf_counter() - start
+        with self._lock:
+            self._stats["waiting"] -= 1
+        if not acquired:
+            raise pg_pool.PoolError("timed out waiting for a connection")
+
+        try:
+            conn = self._get()
+        except Exception:
+            self._slots.release()
+            raise
+        checkout = perf_counter() - start
+        with self._lock:
+            stats = self._stats
+            stats["checkouts"] += 1
+            stats["in_use"] += 1
+            stats["max_in_use"] = max(stats["max_in_use"], stats["in_use"])
+            stats["total_wait"] += waited
+            stats["max_wait"] = max(stats["max_wait"], waited)
+            stats["total_checkout"] += checkout
+            stats["max_checkout"] = max(stats["max_checkout"], checkout)
+
+        try:
+            yield conn
+        finally:
+            self._put(conn)
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def stats(self) -> dict[str, float]:
+        """Return a snapshot of the statistics of this pool.
+
+        Times are in seconds. <checkouts> counts every successful checkout,
+        <waiting> is the number of threads currently waiting for a
+        connection, <opened> counts the connections ever opened, <wait> is
+        the time spent waiting for a free connection, and <checkout> is that
+        plus the time to get (and maybe open) it.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        checkouts = max(stats["checkouts"], 1)
+        stats["minconn"], stats["maxconn"] = self.minconn, self.maxconn
+        stats["avg_wait"] = stats["total_wait"] / checkouts
+        stats["avg_checkout"] = stats["total_checkout"] / checkouts
+        return stats
+
+    def close(self) -> None:
+        """Close all the idle connections of this pool, and the others once
+        they are returned.
+        """
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
@@ -0,0 +1,391 @@
+"""
+Part3 of csc343 A2: a synthetic data generator for the schema in schema.ddl.
+
+The generator produces Item, Customer, Purchase, LineItem, Review,
+Helpfulness and EliteMember rows at any scale, and streams them into the
+database with COPY (or into files in COPY text format). Rows are produced
+lazily in blocks, each from its own random generator seeded from the seed
+and the block number, so:
+    - memory use does not grow with the number of rows,
+    - the same seed always produces the same data, and
+    - a table that depends on another (Helpfulness on Review) can derive the
+      rows it refers to again instead of remembering them.
+
+Every constraint in schema.ddl holds, including the ones only stated in
+comments: each Purchase has at least one LineItem.
+
+Usage:
+    python datagen.py csc343h-username username "" --rows 1000000 \\
+        --schema ../schema.ddl
+"""
+import argparse
+import bisect
+import itertools
+import math
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Iterator
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+from ingest import CopyStream, copy_line
+
+# The number of entities (items, customers, purchases) in one block.
+_BLOCK = 10000
+
+# The tables in the order in which they must be loaded.
+TABLES = ("Item", "Customer", "Purchase", "LineItem", "Review", "Helpfulness",
+          "EliteMember")
+
+_FIRST_NAMES = ("Hermione", "Harry", "Ron", "Albus", "Luna", "Neville",
+                "Ginny", "Minerva", "Severus", "Rubeus", "Cho", "Cedric")
+_LAST_NAMES = ("Granger", "Potter", "Weasley", "Dumbledore", "Lovegood",
+               "Longbottom", "McGonagall", "Snape", "Hagrid", "Chang")
+_TITLES = ("Ms", "Mr", "Mx", "Dr.", "Professor", "Customer")
+_CARD_TYPES = ("Visa", "Mastercard", "Amex")
+
+
+class DataConfig:
+    """The sizes and distributions of a synthetic dataset.
+
+    === Instance Attributes ===
+    seed: The seed from which all the data is derived.
+    items, customers, categories: The number of each.
+    purchases_per_customer: The mean number of purchases per customer.
+    items_per_purchase: The mean number of line items per purchase (>= 1).
+    reviews_per_customer: The mean number of reviews written per customer,
+        i.e., the review density.
+    votes_per_review: The mean number of helpfulness votes per review.
+    helpful_ratio: The fraction of helpfulness votes that are positive.
+    item_skew: The Zipf exponent of item popularity, for both purchases and
+        reviews. 0 is uniform.
+    category_skew: The Zipf exponent of the number of items per category.
+    start_year, years: Purchases are made from January 1st of <start_year>
+        for <years> years.
+    yearly_growth: The ratio of the number of purchases in a year to the
+        number in the year before.
+    elite_fraction: The fraction of customers who are elite members.
+    """
+    seed: int
+    items: int
+    customers: int
+    categories: int
+    purchases_per_customer: float
+    items_per_purchase: float
+    reviews_per_customer: float
+    votes_per_review: float
+    helpful_ratio: float
+    item_skew: float
+    category_skew: float
+    start_year: int
+    years: int
+    yearly_growth: float
+    elite_fraction: float
+
+    def __init__(self, seed: int = 0, items: int = 1000,
+                 customers: int = 5000, categories: int = 20,
+                 purchases_per_customer: float = 4.0,
+                 items_per_purchase: float = 2.5,
+                 reviews_per_customer: float = 2.0,
+                 votes_per_review: float = 1.5, helpful_ratio: float = 0.7,
+                 item_skew: float = 1.0, category_skew: float = 0.5,
+                 start_year: int = 2015, years: int = 10,
+                 yearly_growth: float = 1.2,
+                 elite_fraction: float = 0.01) -> None:
+        """Initialize this configuration.
+
+        Preconditions:
+            - <items>, <customers>, <categories> and <years> are positive.
+            - <items_per_purchase> >= 1
+            - 0 <= <helpful_ratio> <= 1 and 0 <= <elite_fraction> <= 1
+        """
+        self.seed, self.items, self.customers = seed, items, customers
+        self.categories = categories
+        self.purchases_per_customer = purchases_per_customer
+        self.items_per_purchase = items_per_purchase
+        self.reviews_per_customer = reviews_per_customer
+        self.votes_per_review = votes_per_review
+        self.helpful_ratio = helpful_ratio
+        self.item_skew, self.category_skew = item_skew, category_skew
+        self.start_year, self.years = start_year, years
+        self.yearly_growth = yearly_growth
+        self.elite_fraction = elite_fraction
+
+    @classmethod
+    def scaled(cls, rows: int, seed: int = 0, **kwargs) -> "DataConfig":
+        """Return a configuration of about <rows> rows in total, with
+        <kwargs> overriding the defaults of the distributions.
+        """
+        config = cls(seed=seed, **kwargs)
+        per_customer = 1 + config.purchases_per_customer * (
+            1 + config.items_per_purchase) + config.reviews_per_customer * (
+            1 + config.votes_per_review) + config.elite_fraction
+        config.customers = max(10, round(rows / per_customer))
+        config.items = max(10, config.customers // 10)
+        config.categories = max(1, min(config.categories, config.items))
+        return config
+
+    @property
+    def purchases(self) -> int:
+        """The number of purchases.
+        """
+        return round(self.customers * self.purchases_per_customer)
+
+
+class DataGenerator:
+    """A generator of the rows of every table for a DataConfig.
+
+    Only the popularity order of the items is kept in memory. Rows are
+    generated on demand.
+
+    === Instance Attributes ===
+    config: The configuration of the data.
+    """
+    config: DataConfig
+    _item_cumulative: list[float]
+    _item_by_rank: list[int]
+    _year_cumulative: list[float]
+
+    def __init__(self, config: DataConfig) -> None:
+        """Initialize a generator for <config>.
+        """
+        self.config = config
+        rng = self._rng("setup", 0)
+        self._item_cumulative = zipf_cumulative(config.items,
+                                                config.item_skew)
+        self._item_by_rank = list(range(1, config.items + 1))
+        rng.shuffle(self._item_by_rank)
+        weights = [config.yearly_growth ** year
+                   for year in range(config.years)]
+        self._year_cumulative = list(itertools.accumulate(weights))
+
+    def rows(self, table: str) -> Iterator[tuple]:
+        """Yield the rows of <table>, one of TABLES, in order.
+        """
+        return getattr(self, f"_{table.lower()}_rows")()
+
+    def _rng(self, table: str, block: int) -> random.Random:
+        """Return the random generator for block <block> of <table>.
+        """
+        return random.Random(f"{self.config.seed}:{table}:{block}")
+
+    def _blocks(self, table: str, count: int
+                ) -> Iterator[tuple[random.Random, range]]:
+        """Yield the random generator and the IDs (from 1 to <count>) of
+        each block of <table>.
+        """
+        for block, start in enumerate(range(1, count + 1, _BLOCK)):
+            yield self._rng(table, block), range(
+                start, min(start + _BLOCK, count + 1))
+
+    def _popular_items(self, rng: random.Random, count: int) -> list[int]:
+        """Return <count> distinct item IDs, drawn by popularity.
+        """
+        count = min(count, self.config.items)
+        chosen = set()
+        while len(chosen) < count:
+            ranks = rng.choices(range(self.config.items),
+                                cum_weights=self._item_cumulative,
+                                k=count - len(chosen))
+            chosen.update(self._item_by_rank[rank] for rank in ranks)
+        return sorted(chosen)
+
+    def _item_rows(self) -> Iterator[tuple]:
+        config = self.config
+        category_cumulative = zipf_cumulative(config.categories,
+                                              config.category_skew)
+        for rng, iids in self._blocks("item", config.items):
+            categories = rng.choices(range(1, config.categories + 1),
+                                     cum_weights=category_cumulative,
+                                     k=len(iids))
+            for iid, category in zip(iids, categories):
+                price = round(rng.lognormvariate(3, 1), 2)
+                yield iid, f"Category {category:04d}", f"Item {iid}", price
+
+    def _customer_rows(self) -> Iterator[tuple]:
+        for rng, cids in self._blocks("customer", self.config.customers):
+            for cid in cids:
+                yield (cid, f"customer{cid}@example.com",
+                       rng.choice(_LAST_NAMES), rng.choice(_FIRST_NAMES),
+                       rng.choice(_TITLES))
+
+    def _purchase_rows(self) -> Iterator[tuple]:
+        config = self.config
+        start = datetime(config.start_year, 1, 1)
+        total = self._year_cumulative[-1]
+        previous = None
+        for rng, pids in self._blocks("purchase", config.purchases):
+            for pid in pids:
+                # Timestamps increase with the PID, so no customer has two
+                # purchases at the same time.
+                position = (pid - 1 + rng.random()) / config.purchases * total
+                year = bisect.bisect_right(self._year_cumulative, position)
+                year = min(year, config.years - 1)
+                before = self._year_cumulative[year - 1] if year else 0.0
+                fraction = (position - before) / (
+                    self._year_cumulative[year] - before)
+                year_start = start.replace(year=config.start_year + year)
+                year_length = year_start.replace(
+                    year=year_start.year + 1) - year_start
+                checkout = year_start + fraction * year_length
+                if previous is not None and checkout <= previous:
+                    checkout = previous + timedelta(microseconds=1)
+                previous = checkout
+                yield (pid, rng.randint(1, config.customers), checkout,
+                       f"{rng.randrange(10 ** 15, 10 ** 16)}",
+                       rng.choice(_CARD_TYPES))
+
+    def _lineitem_rows(self) -> Iterator[tuple]:
+        extra = self.config.items_per_purchase - 1
+        for rng, pids in self._blocks("lineitem", self.config.purchases):
+            for pid in pids:
+                count = 1 + _count(rng, extra)
+                for iid in self._popular_items(rng, count):
+                    yield pid, iid, 1 + int(rng.expovariate(1.0))
+
+    def _reviews(self, table: str
+                 ) -> Iterator[tuple[random.Random, int, list[int]]]:
+        """Yield, for each customer, their CID, the IDs of the items they
+        reviewed, and the random generator of <table> for their block.
+
+        The reviews are drawn from their own generators, so they are the
+        same whatever the caller draws from the generator of <table>.
+        """
+        mean = self.config.reviews_per_customer
+        for (rng, cids), (other, _) in zip(
+                self._blocks("review", self.config.customers),
+                self._blocks(table, self.config.customers)):
+            for cid in cids:
+                count = _count(rng, mean)
+                yield other, cid, self._popular_items(rng, count)
+
+    def _review_rows(self) -> Iterator[tuple]:
+        for rng, cid, iids in self._reviews("rating"):
+            for iid in iids:
+                rating = rng.choices((1, 2, 3, 4, 5),
+                                     cum_weights=(5, 15, 35, 65, 100))[0]
+                comment = f"Rated {rating}." if rng.random() < 0.3 else None
+                yield cid, iid, rating, comment
+
+    def _helpfulness_rows(self) -> Iterator[tuple]:
+        config = self.config
+        mean = config.votes_per_review
+        for rng, cid, iids in self._reviews("helpfulness"):
+            for iid in iids:
+                count = _count(rng, mean)
+                observers = rng.sample(range(1, config.customers + 1),
+                                       min(count, config.customers))
+                for observer in sorted(observers):
+                    yield (cid, iid, observer,
+                           rng.random() < config.helpful_ratio)
+
+    def _elitemember_rows(self) -> Iterator[tuple]:
+        for rng, cids in self._blocks("elite", self.config.customers):
+            for cid in cids:
+                if rng.random() < self.config.elite_fraction:
+                    yield cid,
+
+
+def _count(rng: random.Random, mean: float) -> int:
+    """Return a count drawn from the geometric distribution with mean <mean>.
+    """
+    if mean <= 0:
+        return 0
+    return int(rng.expovariate(math.log(1 + 1 / mean)))
+
+
+def zipf_cumulative(n: int, skew: float) -> list[float]:
+    """Return the cumulative weights of ranks 1 to <n> under a Zipf
+    distribution with exponent <skew>.
+    """
+    return list(itertools.accumulate(1 / rank ** skew
+                                     for rank in range(1, n + 1)))
+
+
+def load(connection: pg_ext.connection, config: DataConfig,
+         tables: tuple[str, ...] = TABLES) -> dict[str, int]:
+    """Stream the rows of <tables> for <config> into the database that
+    <connection> is connected to, with COPY, and commit.
+
+    The tables are expected to be empty. Return the number of rows loaded
+    into each table.
+    """
+    generator = DataGenerator(config)
+    counts = {}
+    with connection.cursor() as cur:
+        for table in tables:
+            cur.copy_expert(f"COPY {table} FROM STDIN",
+                            CopyStream(generator.rows(table)),
+                            size=1 << 16)
+            counts[table] = cur.rowcount
+        cur.execute("ANALYZE;")
+    connection.commit()
+    return counts
+
+
+def write_files(directory: str, config: DataConfig,
+                tables: tuple[str, ...] = TABLES) -> dict[str, int]:
+    """Write the rows of <tables> for <config> into <directory>, one file
+    per table named after it, in COPY text format. Return the number of
+    rows written for each table.
+    """
+    generator = DataGenerator(config)
+    counts = {}
+    for table in tables:
+        counts[table] = 0
+        with open(os.path.join(directory, f"{table}.tsv"), "w") as out:
+            for row in generator.rows(table):
+                out.write(copy_line(row))
+                counts[table] += 1
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate synthetic data "
+                                                 "for the A2 schema.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--rows", type=int, default=100000,
+                        help="approximate total number of rows")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--schema", help="schema file to load first, e.g., "
+                                         "../schema.ddl")
+    parser.add_argument("--out", help="write COPY files to this directory "
+                                      "instead of loading the database")
+    for option, default in (("item-skew", 1.0), ("category-skew", 0.5),
+                            ("reviews-per-customer", 2.0),
+                            ("helpful-ratio", 0.7), ("years", 10),
+                            ("yearly-growth", 1.2)):
+        parser.add_argument(f"--{option}", type=type(default),
+                            default=default)
+    args = parser.parse_args()
+    config = DataConfig.scaled(
+        args.rows, args.seed, item_skew=args.item_skew,
+        category_skew=args.category_skew,
+        reviews_per_customer=args.reviews_per_customer,
+        helpful_ratio=args.helpful_ratio, years=args.years,
+        yearly_growth=args.yearly_growth)
+
+    if args.out:
+        counts = write_files(args.out, config)
+    else:
+        connection = pg.connect(
+            dbname=args.dbname, user=args.user, password=args.password,
+            options="-c search_path=recommender,public")
+        try:
+            if args.schema:
+                with open(args.schema) as schema, connection.cursor() as cur:
+                    cur.execute(schema.read())
+            counts = load(connection, config)
+        finally:
+            connection.close()
+    for table, count in counts.items():
+        print(f"{table:12} {count:>12,}")
+    print(f"{'total':12} {sum(counts.values()):>12,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Part3 of csc343 A2: streaming export of the report and snapshot tables.
+
+Rows are read through a named (server-side) cursor, <itersize> rows per
+round trip, so that only that many rows are held in memory at a time,
+however large the table. Whole tables can also be written to a file with
+COPY ... TO STDOUT, in CSV, text or PostgreSQL's binary format, which
+psycopg2 streams to the file as it arrives.
+"""
+import itertools
+from typing import IO, Iterator
+
+import psycopg2.extensions as pg_ext
+from psycopg2 import sql
+
+from reports import REPORTS
+
+# The tables (and views) that can be exported: the results of the queries of
+# part 1, the snapshot tables filled by Recommender.repopulate, and the
+# report views of reports.ddl.
+EXPORTABLE = ("q1", "q2", "q3", "q4", "q5", "q6", "PopularItem",
+              "EliteRating") + tuple(REPORTS.values())
+
+# The formats of COPY that export_file supports.
+FORMATS = ("csv", "text", "binary")
+
+# Distinguishes the names of the cursors opened by stream_rows.
+_cursor_ids = itertools.count()
+
+
+def export_query(table: str) -> sql.Composed:
+    """Return a query for all the rows of <table>, one of EXPORTABLE (in any
+    case). Raise ValueError if <table> cannot be exported.
+    """
+    names = {name.lower(): name for name in EXPORTABLE}
+    if table.lower() not in names:
+        raise ValueError(f"cannot export {table}; expected one of "
+                         f"{', '.join(EXPORTABLE)}")
+    return sql.SQL("SELECT * FROM {}").format(sql.Identifier(table.lower()))
+
+
+def stream_rows(conn: pg_ext.connection, table: str,
+                itersize: int = 2000) -> Iterator[tuple]:
+    """Return an iterator over the rows of <table> on <conn>, read through a
+    server-side cursor <itersize> rows at a time.
+
+    The query is sent before returning, so that a table that does not exist
+    raises psycopg2.Error here. The cursor lives in the current transaction,
+    which must stay open until the iterator is exhausted or closed.
+    Raise ValueError if <table> cannot be exported.
+
+    Precondition:
+        - <itersize> > 0
+    """
+    query = export_query(table)
+    cur = conn.cursor(name=f"export_{next(_cursor_ids)}")
+    cur.itersize = itersize
+    cur.execute(query)
+    return _fetch(cur)
+
+
+def _fetch(cur: pg_ext.cursor) -> Iterator[tuple]:
+    """Yield the rows of the named cursor <cur>, and close it at the end.
+    """
+    try:
+        yield from cur
+    finally:
+        if not cur.connection.closed:
+            cur.close()
+
+
+def copy_to(cur: pg_ext.cursor, table: str, file: IO, fmt: str = "csv",
+            header: bool = True) -> int:
+    """Write the rows of <table> to <file> with COPY ... TO STDOUT, in the
+    format <fmt>, with a header line of column names if <header> is True
+    (CSV only), and return the number of rows written.
+
+    <file> must be opened in binary mode for the binary format, and in text
+    mode otherwise. Raise ValueError if <table> cannot be exported or <fmt>
+    is not one of FORMATS.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt}; expected one of "
+                         f"{', '.join(FORMATS)}")
+    options = sql.SQL("FORMAT {}").format(sql.SQL(fmt))
+    if header and fmt == "csv":
+        options = sql.SQL("{}, HEADER").format(options)
+    copy = sql.SQL("COPY ({}) TO STDOUT WITH ({})").format(
+        export_query(table), options)
+    cur.copy_expert(copy.as_string(cur), file, size=1 << 16)
+    return cur.rowcount
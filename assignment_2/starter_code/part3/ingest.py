@@ -0,0 +1,188 @@
+"""
+Part3 of csc343 A2: bulk loading of base tables with COPY.
+
+Rows are checked against the rules of the schema on the client, then
+streamed to the server with COPY FROM STDIN, a chunk at a time, so that
+memory use does not grow with the number of rows.
+"""
+import itertools
+from datetime import datetime
+from typing import Any, Iterable, Iterator, Optional
+
+import psycopg2.extensions as pg_ext
+from psycopg2 import sql
+
+# Characters that must be escaped in PostgreSQL's COPY text format.
+_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n",
+                          "\r": "\\r"})
+
+
+class IngestTable:
+    """A base table that bulk_ingest can load, with the rules a row must
+    follow to be sent.
+
+    === Instance Attributes ===
+    name: The name of the table.
+    columns: The names of its columns, in the order of the values of a row.
+    nullable: The columns that may be NULL (None).
+    lengths: The maximum length of each VARCHAR column.
+    """
+    name: str
+    columns: tuple[str, ...]
+    nullable: frozenset[str]
+    lengths: dict[str, int]
+
+    def __init__(self, name: str, columns: tuple[str, ...],
+                 nullable: Iterable[str] = (),
+                 lengths: Optional[dict[str, int]] = None) -> None:
+        self.name, self.columns = name, columns
+        self.nullable = frozenset(nullable)
+        self.lengths = lengths or {}
+
+    def check(self, row: tuple, number: int) -> None:
+        """Raise ValueError if <row>, the <number>th row given, breaks a rule
+        of this table that can be checked without the database: the number
+        of values, NOT NULL, the type of the IDs, the RATING domain, the
+        range of quantity, and the length of VARCHARs.
+        """
+        if len(row) != len(self.columns):
+            raise ValueError(f"{self.name} row {number}: expected "
+                             f"{len(self.columns)} values, got {len(row)}")
+        for column, value in zip(self.columns, row):
+            if value is None:
+                if column not in self.nullable:
+                    raise ValueError(f"{self.name} row {number}: {column} "
+                                     f"may not be NULL")
+            elif column in ("PID", "CID", "IID", "quantity", "rating") \
+                    and (not isinstance(value, int)
+                         or isinstance(value, bool)):
+                raise ValueError(f"{self.name} row {number}: {column} must "
+                                 f"be an integer, got {value!r}")
+            elif column == "quantity" and value <= 0:
+                raise ValueError(f"{self.name} row {number}: quantity must "
+                                 f"be positive, got {value}")
+            elif column == "rating" and not 1 <= value <= 5:
+                raise ValueError(f"{self.name} row {number}: rating must be "
+                                 f"between 1 and 5, got {value}")
+            elif column == "checkout_time" \
+                    and not isinstance(value, (datetime, str)):
+                raise ValueError(f"{self.name} row {number}: checkout_time "
+                                 f"must be a timestamp, got {value!r}")
+            elif column in self.lengths \
+                    and len(str(value)) > self.lengths[column]:
+                raise ValueError(f"{self.name} row {number}: {column} is "
+                                 f"longer than {self.lengths[column]}")
+
+
+# The tables that can be bulk loaded, by lower-case name.
+TABLES = {table.name.lower(): table for table in (
+    IngestTable("Purchase",
+                ("PID", "CID", "checkout_time", "card_pan", "card_type"),
+                lengths={"card_pan": 20, "card_type": 15}),
+    IngestTable("LineItem", ("PID", "IID", "quantity")),
+    IngestTable("Review", ("CID", "IID", "rating", "comment"),
+                nullable=("comment",)),
+)}
+
+
+def copy_line(row: tuple) -> str:
+    """Return <row> as a line in PostgreSQL's COPY text format.
+    """
+    return "\t".join("\\N" if value is None
+                     else str(value).translate(_ESCAPES)
+                     for value in row) + "\n"
+
+
+class CopyStream:
+    """A file-like object that reads the COPY lines of some rows, for
+    cursor.copy_expert. Rows are only converted as they are read.
+    """
+    _lines: Iterator[str]
+    _buffer: str
+
+    def __init__(self, rows: Iterable[tuple]) -> None:
+        self._lines = map(copy_line, rows)
+        self._buffer = ""
+
+    def read(self, size: Optional[int] = -1) -> str:
+        if size is None or size < 0:
+            return self._buffer + "".join(self._lines)
+        while len(self._buffer) < size:
+            chunk = "".join(itertools.islice(self._lines, 1000))
+            if not chunk:
+                break
+            self._buffer += chunk
+        result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+
+def ingest(cur: pg_ext.cursor, table: str, rows: Iterable[tuple],
+           chunk_size: int = 10000, merge: bool = False) -> dict[str, Any]:
+    """Load <rows> into <table> on <cur>, <chunk_size> rows at a time,
+    within the current transaction, which the caller ends.
+
+    Each chunk is checked with IngestTable.check before any of it is sent.
+    If <merge> is True, each chunk is copied into a temporary table first and
+    then inserted with ON CONFLICT DO NOTHING, so that rows that are already
+    in <table> (by any key) are skipped, and a load can safely be replayed.
+    LineItem rows always go through the temporary table in the partitioned
+    layout, to add the checkout_time of their purchase.
+
+    Return the number of rows given and of rows inserted, and the number of
+    chunks. Raise ValueError if <table> cannot be bulk loaded or a row
+    breaks a rule, and psycopg2.Error if the database rejects a chunk.
+    """
+    spec = TABLES.get(table.lower())
+    if spec is None:
+        raise ValueError(f"cannot bulk load {table}; expected one of "
+                         f"{', '.join(t.name for t in TABLES.values())}")
+    target = sql.Identifier(spec.name.lower())
+    names = [column.lower() for column in spec.columns]
+    columns = sql.SQL(", ").join(map(sql.Identifier, names))
+    # In the partitioned layout (see partitioned.ddl), LineItem also stores
+    # the checkout_time of its purchase, which is looked up while merging.
+    timed = False
+    if spec.name == "LineItem":
+        cur.execute("SELECT 1 FROM information_schema.columns "
+                    "WHERE table_schema = 'recommender' "
+                    "AND table_name = 'lineitem' "
+                    "AND column_name = 'checkout_time';")
+        timed = cur.fetchone() is not None
+    if merge or timed:
+        destination = sql.Identifier("staging_" + spec.name.lower())
+        cur.execute(sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {} "
+                            "ON COMMIT DROP AS SELECT {} FROM {} "
+                            "WITH NO DATA;")
+                    .format(destination, columns, target))
+        staged = sql.SQL(", ").join(sql.Identifier("s", name)
+                                    for name in names)
+        source = sql.SQL("{} s").format(destination)
+        if timed:
+            columns = sql.SQL("{}, checkout_time").format(columns)
+            staged = sql.SQL("{}, p.checkout_time").format(staged)
+            source = sql.SQL("{} LEFT JOIN purchase p ON p.pid = s.pid") \
+                .format(source)
+        merge_chunk = sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}{};") \
+            .format(target, columns, staged, source,
+                    sql.SQL(" ON CONFLICT DO NOTHING" if merge else ""))
+    else:
+        destination, merge_chunk = target, None
+    copy = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        destination, sql.SQL(", ").join(map(sql.Identifier, names))) \
+        .as_string(cur)
+
+    given, inserted, chunks = 0, 0, 0
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        for number, row in enumerate(chunk, start=given + 1):
+            spec.check(row, number)
+        given += len(chunk)
+        chunks += 1
+        cur.copy_expert(copy, CopyStream(chunk), size=1 << 16)
+        if merge_chunk is None:
+            inserted += cur.rowcount
+            continue
+        cur.execute(merge_chunk)
+        inserted += cur.rowcount
+        cur.execute(sql.SQL("TRUNCATE {};").format(destination))
+    return {"rows": given, "inserted": inserted, "chunks": chunks}
@@ -0,0 +1,451 @@
+"""
+Part3 of csc343 A2: a closed-loop load generator for Recommender.
+
+<processes> processes of <threads> threads each call recommend and
+recommend_generic back to back for <duration> seconds, each thread making
+its next call as soon as the last one returns (a closed loop). The calls are
+picked according to a mix, and customers are drawn from a Zipf distribution
+over the non-elite customers, so that a few of them are hot. Meanwhile,
+repopulate can be run every few seconds, to measure how much it disturbs
+the other calls.
+
+For each kind of call, the throughput, the error rate and a histogram of
+its latencies are reported. For each interval of the run, the calls, the
+errors, the p99 latency, whether repopulate was running and the number of
+connections to the database by state are reported too. The results are
+written as JSON and summarized on the terminal.
+
+Usage:
+    python loadgen.py csc343h-username username "" --processes 4 \\
+        --threads 8 --duration 30 --mix recommend=0.9 recommend_generic=0.1 \\
+        --repopulate-every 10 --out load.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import random
+import sys
+import threading
+import time
+from typing import Any, Optional
+
+import psycopg2 as pg
+
+from a2 import Recommender
+from datagen import zipf_cumulative
+
+# The calls that the load is made of.
+CALLS = ("recommend", "recommend_generic")
+
+# The percentiles reported for each call, as (name, percentile).
+PERCENTILES = (("p50_ms", 50), ("p90_ms", 90), ("p99_ms", 99),
+               ("p999_ms", 99.9))
+
+# Each power of two of microseconds is split into 2 ** _SUB_BITS buckets,
+# i.e., latencies are recorded to within about 3% of their value.
+_SUB_BITS = 5
+_SUB_BUCKETS = 1 << _SUB_BITS
+
+# The connections to the database, by state, other than that of the query.
+_CONNECTIONS = """
+    SELECT COALESCE(state, 'unknown'), COUNT(*)
+    FROM pg_stat_activity
+    WHERE datname = current_database() AND pid <> pg_backend_pid()
+    GROUP BY 1;
+"""
+
+
+class LatencyHistogram:
+    """A histogram of latencies with log-linear buckets, as HdrHistogram
+    keeps them: latencies are counted in microseconds, one per bucket up to
+    _SUB_BUCKETS, and then with each power of two split into _SUB_BUCKETS
+    buckets. Its percentiles are as precise as its buckets however many
+    latencies it holds, and histograms can be merged.
+
+    === Instance Attributes ===
+    counts: The number of latencies in each non-empty bucket, by index.
+    total: The number of latencies recorded.
+    max_us: The largest latency recorded, in microseconds.
+    """
+    counts: dict[int, int]
+    total: int
+    max_us: int
+
+    def __init__(self) -> None:
+        """Initialize this histogram, with no latencies.
+        """
+        self.counts = {}
+        self.total = 0
+        self.max_us = 0
+
+    def record(self, seconds: float) -> None:
+        """Record a latency of <seconds>.
+        """
+        us = max(int(seconds * 1e6), 0)
+        index = _bucket(us)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.max_us = max(self.max_us, us)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        """Add the latencies of <other> to this histogram.
+        """
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.max_us = max(self.max_us, other.max_us)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """Return the latency, in milliseconds, below which <percentile>
+        percent of the latencies lie, to the precision of the buckets, or
+        None if there are no latencies.
+        """
+        if self.total == 0:
+            return None
+        rank = max(1, round(self.total * percentile / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(_upper(index), self.max_us) / 1000
+        return self.max_us / 1000
+
+    def buckets(self) -> dict[str, int]:
+        """Return the non-empty buckets, keyed by their upper bound in
+        milliseconds, in increasing order.
+        """
+        return {f"{_upper(index) / 1000:g}": self.counts[index]
+                for index in sorted(self.counts)}
+
+
+def _bucket(us: int) -> int:
+    """Return the index of the bucket of a latency of <us> microseconds.
+    """
+    if us < _SUB_BUCKETS:
+        return us
+    shift = us.bit_length() - 1 - _SUB_BITS
+    return _SUB_BUCKETS * (shift + 1) + (us >> shift) - _SUB_BUCKETS
+
+
+def _upper(index: int) -> int:
+    """Return the smallest latency, in microseconds, above the bucket with
+    <index>.
+    """
+    if index < _SUB_BUCKETS:
+        return index + 1
+    shift, sub = divmod(index - _SUB_BUCKETS, _SUB_BUCKETS)
+    return (_SUB_BUCKETS + sub + 1) << shift
+
+
+def _drive(config: dict[str, Any], customers: list[int], thread: int,
+           start: float, intervals: dict[int, dict[str, list]]) -> None:
+    """Make calls through the Recommender of <config>["rec"] until the end of
+    the run that began at time <start>, and record them in <intervals>, by
+    interval and then by call, as a LatencyHistogram and a count of errors.
+    """
+    rng = random.Random(config["seed"] * 1000 + thread)
+    calls, weights = zip(*config["mix"].items())
+    cumulative = zipf_cumulative(len(customers), config["skew"])
+    rec, k = config["rec"], config["k"]
+    end = start + config["duration"]
+    while (now := time.time()) < end:
+        call = rng.choices(calls, weights=weights)[0]
+        call_start = time.perf_counter()
+        try:
+            if call == "recommend":
+                cust = rng.choices(customers, cum_weights=cumulative)[0]
+                result = rec.recommend(cust, k)
+            else:
+                result = rec.recommend_generic(k)
+        except Exception:
+            result = None
+        latency = time.perf_counter() - call_start
+        interval = intervals.setdefault(
+            int((now - start) / config["interval"]), {})
+        recorded = interval.setdefault(call, [LatencyHistogram(), 0])
+        if result is None:
+            recorded[1] += 1
+        else:
+            recorded[0].record(latency)
+
+
+def _process(config: dict[str, Any], customers: list[int], process: int,
+             ready: Any, go: Any, start: Any, results: Any) -> None:
+    """Run <config>["threads"] threads of calls in this process, once <go>
+    is set, from time <start>, and put what they recorded on <results>.
+    """
+    rec = Recommender()
+    if not rec.connect_pool(config["dbname"], config["user"],
+                            config["password"], 1, config["threads"]):
+        ready.put(f"process {process} could not connect")
+        return
+    ready.put(None)
+    go.wait()
+    config = dict(config, rec=rec, seed=config["seed"] * 100 + process)
+    recorded = [{} for _ in range(config["threads"])]
+    threads = [threading.Thread(target=_drive,
+                                args=(config, customers, i, start.value,
+                                      recorded[i]))
+               for i in range(config["threads"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rec.disconnect()
+    results.put(recorded)
+
+
+def _monitor(config: dict[str, Any], start: float, stop: threading.Event,
+             samples: list[dict[str, Any]]) -> None:
+    """Count the connections to the database, by state, once per interval
+    from time <start> until <stop> is set, and append them to <samples>.
+    """
+    conn = pg.connect(dbname=config["dbname"], user=config["user"],
+                      password=config["password"])
+    conn.autocommit = True
+    try:
+        while not stop.wait(max(0.0, start + config["interval"]
+                                * (len(samples) + 0.5) - time.time())):
+            with conn.cursor() as cur:
+                cur.execute(_CONNECTIONS)
+                samples.append({"t_s": round(time.time() - start, 3),
+                                "connections": dict(cur.fetchall())})
+    finally:
+        conn.close()
+
+
+def _repopulate(config: dict[str, Any], start: float, stop: threading.Event,
+                runs: list[dict[str, Any]]) -> None:
+    """Run a full repopulate every <config>["repopulate_every"] seconds
+    from time <start> until <stop> is set, and append when each started,
+    how long it took and whether it succeeded to <runs>.
+    """
+    rec = Recommender()
+    if not rec.connect(config["dbname"], config["user"], config["password"]):
+        runs.append({"start_s": 0.0, "seconds": 0.0, "ok": False})
+        return
+    try:
+        while not stop.wait(max(0.0, start + config["repopulate_every"]
+                                * (len(runs) + 1) - time.time())):
+            began = time.time()
+            ok = rec.repopulate(full=True)
+            runs.append({"start_s": round(began - start, 3),
+                         "seconds": time.time() - began, "ok": ok})
+    finally:
+        rec.disconnect()
+
+
+def summarize(histogram: LatencyHistogram, errors: int,
+              seconds: float) -> dict[str, Any]:
+    """Return the throughput, error rate and percentiles of the calls whose
+    latencies are in <histogram>, <errors> more of which failed, made over
+    <seconds> seconds.
+    """
+    calls = histogram.total + errors
+    summary = {"calls": calls, "errors": errors,
+               "error_rate": errors / calls if calls else 0.0,
+               "throughput_per_s": histogram.total / seconds}
+    for name, percentile in PERCENTILES:
+        summary[name] = histogram.percentile(percentile)
+    summary["max_ms"] = histogram.max_us / 1000 if histogram.total else None
+    return summary
+
+
+def run(dbname: str, user: str, password: str, processes: int = 2,
+        threads: int = 4, duration: float = 10.0,
+        mix: Optional[dict[str, float]] = None, k: int = 5,
+        skew: float = 1.0, interval: float = 1.0,
+        repopulate_every: Optional[float] = None,
+        seed: int = 0) -> dict[str, Any]:
+    """Drive the database <dbname> with <processes> x <threads> closed-loop
+    callers for <duration> seconds, as described at the top of this module,
+    and return the results.
+
+    <mix> maps each of CALLS to its relative weight (by default, only
+    recommend). recommend and recommend_generic are called with <k>, and
+    customers are drawn with a Zipf exponent of <skew>. The timeline is
+    split into intervals of <interval> seconds. If <repopulate_every> is not
+    None, a full repopulate is started that many seconds into the run, and
+    again that long after each one began, or as soon as it ends if it takes
+    longer.
+
+    Raise RuntimeError if a process cannot connect, or if there are no
+    non-elite customers to recommend to.
+    """
+    mix = mix or {"recommend": 1.0}
+    config = {"dbname": dbname, "user": user, "password": password,
+              "threads": threads, "duration": duration, "mix": mix, "k": k,
+              "skew": skew, "interval": interval,
+              "repopulate_every": repopulate_every, "seed": seed}
+    conn = pg.connect(dbname=dbname, user=user, password=password,
+                      options="-c search_path=recommender,public")
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT CID FROM Customer "
+                        "WHERE CID NOT IN (SELECT CID FROM EliteMember) "
+                        "ORDER BY CID;")
+            customers = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+    if not customers:
+        raise RuntimeError(f"{dbname} has no non-elite customers")
+    # Which customers are hot should not depend on their IDs.
+    random.Random(seed).shuffle(customers)
+
+    # Processes are spawned rather than forked, so that they share no
+    # connection with this one.
+    context = mp.get_context("spawn")
+    ready, results = context.Queue(), context.Queue()
+    go, start = context.Event(), context.Value("d", 0.0)
+    workers = [context.Process(target=_process,
+                               args=(config, customers, i, ready, go, start,
+                                     results))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        failures = [error for error in (ready.get() for _ in workers)
+                    if error is not None]
+        if failures:
+            raise RuntimeError("; ".join(failures))
+
+        start.value = time.time()
+        go.set()
+        stop = threading.Event()
+        samples, repopulates = [], []
+        helpers = [threading.Thread(target=_monitor,
+                                    args=(config, start.value, stop,
+                                          samples))]
+        if repopulate_every is not None:
+            helpers.append(threading.Thread(
+                target=_repopulate,
+                args=(config, start.value, stop, repopulates)))
+        for helper in helpers:
+            helper.start()
+        recorded = [thread for _ in workers for thread in results.get()]
+        stop.set()
+        for helper in helpers:
+            helper.join()
+    finally:
+        go.set()
+        for worker in workers:
+            worker.join()
+    return _report(config, processes, len(customers), recorded, samples,
+                   repopulates)
+
+
+def _report(config: dict[str, Any], processes: int, customers: int,
+            recorded: list[dict[int, dict[str, list]]],
+            samples: list[dict[str, Any]],
+            repopulates: list[dict[str, Any]]) -> dict[str, Any]:
+    """Return the results of a run with <config>, from what each thread
+    <recorded>, the connection <samples> and the <repopulates>.
+    """
+    interval = config["interval"]
+    totals = {call: [LatencyHistogram(), 0] for call in config["mix"]}
+    timeline = []
+    last = max((i for thread in recorded for i in thread), default=-1)
+    for i in range(last + 1):
+        merged, errors = LatencyHistogram(), 0
+        calls = {}
+        for thread in recorded:
+            for call, (histogram, failed) in thread.get(i, {}).items():
+                totals[call][0].merge(histogram)
+                totals[call][1] += failed
+                merged.merge(histogram)
+                errors += failed
+                calls[call] = calls.get(call, 0) + histogram.total + failed
+        begin, end = i * interval, (i + 1) * interval
+        connections = [sample["connections"] for sample in samples
+                       if begin <= sample["t_s"] < end]
+        timeline.append({
+            "t_s": begin, "calls": calls, "errors": errors,
+            "p99_ms": merged.percentile(99),
+            "repopulating": any(run["start_s"] < end
+                                and run["start_s"] + run["seconds"] > begin
+                                for run in repopulates),
+            "connections": connections[-1] if connections else {}})
+
+    config = {key: value for key, value in config.items()
+              if key != "password"}
+    report = {"config": dict(config, processes=processes),
+              "customers": customers, "calls": {}, "timeline": timeline,
+              "repopulates": repopulates}
+    for call, (histogram, errors) in totals.items():
+        report["calls"][call] = dict(
+            summarize(histogram, errors, config["duration"]),
+            histogram=histogram.buckets())
+    return report
+
+
+def print_summary(report: dict[str, Any]) -> None:
+    """Print a summary of <report>, as returned by run, to stderr.
+    """
+    config = report["config"]
+    print(f"{config['processes']} processes x {config['threads']} threads "
+          f"for {config['duration']:g} s over {report['customers']:,} "
+          f"customers (Zipf {config['skew']:g})", file=sys.stderr)
+    for call, summary in report["calls"].items():
+        percentiles = "  ".join(
+            f"{name[:-3]} {summary[name]:8.3f}" if summary[name] is not None
+            else f"{name[:-3]} {'-':>8}" for name, _ in PERCENTILES)
+        print(f"{call:18} {summary['throughput_per_s']:9.1f}/s  "
+              f"errors {summary['error_rate']:6.2%}  {percentiles}  "
+              f"max {summary['max_ms'] or 0:8.3f} ms", file=sys.stderr)
+    for point in report["timeline"]:
+        calls = sum(point["calls"].values())
+        p99 = point["p99_ms"]
+        print(f"  t={point['t_s']:6.1f} s {calls / config['interval']:9.1f}"
+              f"/s  p99 {p99 if p99 is not None else 0:8.3f} ms  "
+              f"errors {point['errors']:4}  connections "
+              f"{sum(point['connections'].values()):3}"
+              f"{'  repopulating' if point['repopulating'] else ''}",
+              file=sys.stderr)
+    for run in report["repopulates"]:
+        print(f"repopulate at {run['start_s']:6.1f} s took "
+              f"{run['seconds'] * 1000:9.1f} ms"
+              f"{'' if run['ok'] else ' (failed)'}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Drive Recommender with closed-loop load.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4,
+                        help="threads per process")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds")
+    parser.add_argument("--mix", nargs="+", default=["recommend=1"],
+                        help="call=weight for each call to make")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--skew", type=float, default=1.0,
+                        help="Zipf exponent of the customers")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds per point of the timeline")
+    parser.add_argument("--repopulate-every", type=float,
+                        help="seconds between full repopulates")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    mix = {}
+    for item in args.mix:
+        call, _, weight = item.partition("=")
+        if call not in CALLS:
+            parser.error(f"unknown call {call}; expected one of "
+                         f"{', '.join(CALLS)}")
+        mix[call] = float(weight or 1)
+    report = run(args.dbname, args.user, args.password, args.processes,
+                 args.threads, args.duration, mix, args.k, args.skew,
+                 args.interval, args.repopulate_every, args.seed)
+    print_summary(report)
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
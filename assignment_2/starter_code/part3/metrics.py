@@ -0,0 +1,443 @@
+"""
+Part3 of csc343 A2: instrumentation of the recommender's queries.
+
+A MetricsRegistry given to Recommender records, for every call of a public
+method and for every statement run on its behalf, the time taken, the time
+spent waiting on the database, the number of round trips and the number of
+rows returned or changed. Errors are counted, and the last one of each
+statement kept, even though the methods themselves only return False or
+None. Statements slower than a threshold can have their plans captured
+with EXPLAIN (ANALYZE, BUFFERS), for a sample of their runs.
+
+The registry can be read as a dictionary, with stats, or in the Prometheus
+text format, with prometheus.
+"""
+import functools
+import random
+import re
+import threading
+from collections import deque
+from contextvars import ContextVar
+from time import perf_counter, time
+from typing import Any, Callable, Optional, TypeVar
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+from psycopg2 import sql
+
+from prepared import PreparingConnection
+
+# The upper bounds, in seconds, of the buckets of the histogram of the time
+# taken by method calls.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+# The names under which statements are recorded, by their text with its
+# whitespace collapsed (see register_statements).
+_names: dict[str, str] = {}
+
+# Statements whose plan EXPLAIN can show.
+_EXPLAINABLE = re.compile(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE|VALUES|"
+                          r"EXECUTE)\b", re.IGNORECASE)
+
+# A statement run by name or prepared, e.g., by prepared.PreparedStatement.
+_NAMED = re.compile(r"\s*(EXECUTE|PREPARE)\s+(\w+)", re.IGNORECASE)
+
+# The kind of a statement, and the first relation it names, if any.
+_KIND = re.compile(r"\s*(\w+)")
+_RELATION = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN|TABLE|COPY)\s+"
+                       r"(?:ONLY\s+)?(\w+)", re.IGNORECASE)
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+
+
+class _Call:
+    """The statements run so far by a call of an instrumented method.
+
+    === Instance Attributes ===
+    registry: The registry the call is recorded in.
+    method: The name of the method.
+    db_seconds: The time spent waiting on the database.
+    round_trips: The number of statements, commits and rollbacks sent.
+    rows: The number of rows returned or changed by the statements.
+    errors: The number of statements that failed.
+    """
+    registry: "MetricsRegistry"
+    method: str
+    db_seconds: float
+    round_trips: int
+    rows: int
+    errors: int
+
+    def __init__(self, registry: "MetricsRegistry", method: str) -> None:
+        self.registry, self.method = registry, method
+        self.db_seconds, self.round_trips, self.rows, self.errors = \
+            0.0, 0, 0, 0
+
+
+# The innermost instrumented method call in progress in this thread (or
+# task), if any, or in the thread that started this one with a copy of its
+# context. Statements run outside of one are not recorded.
+_current: ContextVar[Optional[_Call]] = ContextVar("current_call",
+                                                   default=None)
+
+
+class MetricsRegistry:
+    """A thread-safe record of the calls of the methods of a Recommender and
+    of the statements they ran, with the plans of some slow statements.
+
+    === Instance Attributes ===
+    explain_threshold: Statements that take at least this many seconds may
+        have their plan captured, or none do if this is None.
+    explain_rate: The fraction of the runs of such statements whose plan is
+        captured.
+    plans: The plans captured, oldest first, as dictionaries with the
+        method, statement, seconds and time of the run and the plan.
+    """
+    explain_threshold: Optional[float]
+    explain_rate: float
+    plans: deque
+    _lock: threading.Lock
+    _methods: dict[str, dict[str, Any]]
+    _statements: dict[str, dict[str, Any]]
+    _random: random.Random
+
+    def __init__(self, explain_threshold: Optional[float] = None,
+                 explain_rate: float = 1.0, max_plans: int = 100,
+                 seed: Optional[int] = None) -> None:
+        """Initialize this registry with nothing recorded, keeping up to
+        <max_plans> plans. <seed> seeds the sampling of the runs to explain.
+
+        Preconditions:
+            - 0 <= <explain_rate> <= 1
+            - <max_plans> > 0
+        """
+        self.explain_threshold, self.explain_rate = \
+            explain_threshold, explain_rate
+        self.plans = deque(maxlen=max_plans)
+        self._lock = threading.Lock()
+        self._methods, self._statements = {}, {}
+        self._random = random.Random(seed)
+
+    def record_call(self, call: _Call, seconds: float) -> None:
+        """Record that <call> ended after <seconds> seconds.
+        """
+        with self._lock:
+            stats = self._methods.get(call.method)
+            if stats is None:
+                stats = self._methods[call.method] = {
+                    "calls": 0, "errors": 0, "seconds": 0.0,
+                    "max_seconds": 0.0, "db_seconds": 0.0, "round_trips": 0,
+                    "rows": 0, "buckets": [0] * len(BUCKETS)}
+            stats["calls"] += 1
+            stats["errors"] += call.errors > 0
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["db_seconds"] += call.db_seconds
+            stats["round_trips"] += call.round_trips
+            stats["rows"] += call.rows
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+                    break
+
+    def record_statement(self, call: _Call, statement: str, seconds: float,
+                         rows: int, error: Optional[Exception] = None
+                         ) -> None:
+        """Record that <statement> took <seconds> seconds and returned or
+        changed <rows> rows, or failed with <error>, during <call>.
+        """
+        with self._lock:
+            # The statements of one call may run on several threads, e.g.,
+            # the shards of a repopulate.
+            call.db_seconds += seconds
+            call.round_trips += 1
+            call.rows += rows
+            call.errors += error is not None
+            stats = self._statements.get(statement)
+            if stats is None:
+                stats = self._statements[statement] = {
+                    "calls": 0, "errors": 0, "seconds": 0.0,
+                    "max_seconds": 0.0, "rows": 0, "last_error": None}
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["rows"] += rows
+            if error is not None:
+                stats["errors"] += 1
+                stats["last_error"] = str(error).strip()
+
+    def should_explain(self, seconds: float) -> bool:
+        """Return whether to capture the plan of a statement that took
+        <seconds> seconds.
+        """
+        if self.explain_threshold is None \
+                or seconds < self.explain_threshold:
+            return False
+        with self._lock:
+            return self._random.random() < self.explain_rate
+
+    def stats(self) -> dict[str, Any]:
+        """Return a copy of what was recorded: the counters of each method
+        and of each statement, by name, and the number of plans captured.
+        """
+        with self._lock:
+            return {
+                "methods": {name: dict(stats, buckets=list(stats["buckets"]))
+                            for name, stats in self._methods.items()},
+                "statements": {text: dict(stats)
+                               for text, stats in self._statements.items()},
+                "plans": len(self.plans),
+            }
+
+    def prometheus(self) -> str:
+        """Return what was recorded in the Prometheus text format.
+        """
+        stats = self.stats()
+        lines = []
+
+        def family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP recommender_{name} {help_text}")
+            lines.append(f"# TYPE recommender_{name} {kind}")
+
+        def sample(name: str, labels: dict[str, str], value: float) -> None:
+            text = ",".join(f'{key}="{_escape(label)}"'
+                            for key, label in labels.items())
+            lines.append(f"recommender_{name}{{{text}}} {value!r}")
+
+        methods = stats["methods"]
+        for name, key, kind, help_text in (
+                ("method_calls_total", "calls", "counter",
+                 "Calls of each method."),
+                ("method_errors_total", "errors", "counter",
+                 "Calls in which a statement failed."),
+                ("method_db_seconds_total", "db_seconds", "counter",
+                 "Time spent waiting on the database."),
+                ("method_round_trips_total", "round_trips", "counter",
+                 "Statements, commits and rollbacks sent."),
+                ("method_rows_total", "rows", "counter",
+                 "Rows returned or changed by the statements."),
+                ("method_max_seconds", "max_seconds", "gauge",
+                 "Time taken by the slowest call.")):
+            family(name, kind, help_text)
+            for method, counters in sorted(methods.items()):
+                sample(name, {"method": method}, counters[key])
+
+        family("method_seconds", "histogram", "Time taken by each call.")
+        for method, counters in sorted(methods.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, counters["buckets"]):
+                cumulative += count
+                sample("method_seconds_bucket",
+                       {"method": method, "le": repr(bound)}, cumulative)
+            sample("method_seconds_bucket", {"method": method, "le": "+Inf"},
+                   counters["calls"])
+            sample("method_seconds_sum", {"method": method},
+                   counters["seconds"])
+            sample("method_seconds_count", {"method": method},
+                   counters["calls"])
+
+        statements = stats["statements"]
+        for name, key, kind, help_text in (
+                ("statement_calls_total", "calls", "counter",
+                 "Runs of each statement."),
+                ("statement_errors_total", "errors", "counter",
+                 "Runs of each statement that failed."),
+                ("statement_seconds_total", "seconds", "counter",
+                 "Time taken by each statement."),
+                ("statement_max_seconds", "max_seconds", "gauge",
+                 "Time taken by the slowest run of each statement."),
+                ("statement_rows_total", "rows", "counter",
+                 "Rows returned or changed by each statement.")):
+            family(name, kind, help_text)
+            for text, counters in sorted(statements.items()):
+                sample(name, {"statement": text}, counters[key])
+
+        family("plans_captured", "gauge", "Plans of slow statements kept.")
+        lines.append(f"recommender_plans_captured {stats['plans']}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    """Return <value> escaped for use as a Prometheus label value.
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def register_statements(statements: dict[str, Any]) -> None:
+    """Record the statements of the registries under the names that
+    <statements> gives them. A value of <statements> is either a statement
+    or a tuple of statements, which are named by their position, e.g.,
+    RECOMPUTE_CATEGORIES[1].
+    """
+    for name, statement in statements.items():
+        if isinstance(statement, tuple):
+            for i, part in enumerate(statement):
+                _names[" ".join(part.split())] = f"{name}[{i}]"
+        else:
+            _names[" ".join(statement.split())] = name
+
+
+def statement_label(query: str) -> str:
+    """Return the name under which <query> is recorded: the name of the
+    prepared statement it runs or prepares, or the name it was registered
+    under (see register_statements), or else its kind and the first
+    relation it names, e.g., "SELECT itemstatsdiscrepancy", so that there
+    are only so many labels, however many statements are run.
+    """
+    named = _NAMED.match(query)
+    if named is not None:
+        return named.group(2) if named.group(1).upper() == "EXECUTE" \
+            else f"PREPARE {named.group(2)}"
+    name = _names.get(" ".join(query.split()))
+    if name is not None:
+        return name
+    kind = _KIND.match(query)
+    relation = _RELATION.search(query)
+    label = kind.group(1).upper() if kind is not None else "UNKNOWN"
+    return label if relation is None \
+        else f"{label} {relation.group(1).lower()}"
+
+
+class InstrumentedCursor(pg_ext.cursor):
+    """A psycopg2 cursor that records the statements it runs in the registry
+    of the instrumented method call in progress, if any.
+    """
+
+    def execute(self, query: Any, vars: Any = None) -> None:
+        call = _current.get()
+        if call is None:
+            return super().execute(query, vars)
+        if isinstance(query, sql.Composable):
+            query = query.as_string(self)
+        self._timed(call, query, super().execute, query, vars)
+        if call.registry.should_explain(self._seconds) \
+                and _EXPLAINABLE.match(query):
+            self._explain(call, query, vars)
+
+    def executemany(self, query: Any, vars_list: Any) -> None:
+        call = _current.get()
+        if call is None:
+            return super().executemany(query, vars_list)
+        if isinstance(query, sql.Composable):
+            query = query.as_string(self)
+        self._timed(call, query, super().executemany, query, vars_list)
+
+    def copy_expert(self, sql: Any, file: Any, size: int = 8192) -> None:
+        call = _current.get()
+        if call is None:
+            return super().copy_expert(sql, file, size)
+        self._timed(call, sql, super().copy_expert, sql, file, size)
+
+    def _timed(self, call: _Call, query: str, run: Callable,
+               *args: Any) -> None:
+        """Run <run>(*<args>), which sends <query>, and record it in <call>.
+        """
+        start = perf_counter()
+        try:
+            run(*args)
+        except pg.Error as ex:
+            call.registry.record_statement(call, statement_label(query),
+                                           perf_counter() - start, 0, ex)
+            raise
+        self._seconds = perf_counter() - start
+        call.registry.record_statement(call, statement_label(query),
+                                       self._seconds, max(self.rowcount, 0))
+
+    def _explain(self, call: _Call, query: str, vars: Any) -> None:
+        """Capture the plan of <query> with <vars>, which was just run, in
+        the registry of <call>.
+
+        The statement is run again, under EXPLAIN ANALYZE, in a savepoint
+        that is rolled back, so that it changes nothing. This cursor keeps
+        the results of the original run. Statements that fail the second time
+        are not captured.
+        """
+        conn = self.connection
+        if conn.autocommit:
+            return
+        with pg_ext.cursor(conn) as cur:
+            try:
+                cur.execute("SAVEPOINT explain_capture;")
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, vars)
+                plan = "\n".join(row[0] for row in cur.fetchall())
+                cur.execute("ROLLBACK TO SAVEPOINT explain_capture;")
+                cur.execute("RELEASE SAVEPOINT explain_capture;")
+            except pg.Error:
+                # The statement fails when run twice, e.g., it inserts keys
+                # it just inserted; give up on this plan, but not on the
+                # transaction.
+                cur.execute("ROLLBACK TO SAVEPOINT explain_capture;")
+                cur.execute("RELEASE SAVEPOINT explain_capture;")
+                return
+        call.registry.plans.append({
+            "method": call.method, "statement": statement_label(query),
+            "seconds": self._seconds, "at": time(), "plan": plan})
+
+
+class InstrumentedConnection(PreparingConnection):
+    """A PreparingConnection whose cursors are InstrumentedCursors, and whose
+    commits and rollbacks are recorded like statements. Pass it as the
+    connection_factory of psycopg2.connect.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+
+    def commit(self) -> None:
+        self._timed("COMMIT", super().commit)
+
+    def rollback(self) -> None:
+        self._timed("ROLLBACK", super().rollback)
+
+    def _timed(self, statement: str, run: Callable[[], None]) -> None:
+        """Run <run>, which sends <statement>, and record it in the
+        instrumented method call in progress, if any.
+        """
+        call = _current.get()
+        if call is None:
+            return run()
+        start = perf_counter()
+        try:
+            run()
+        except pg.Error as ex:
+            call.registry.record_statement(call, statement,
+                                           perf_counter() - start, 0, ex)
+            raise
+        call.registry.record_statement(call, statement,
+                                       perf_counter() - start, 0)
+
+
+def instrumented(method: _F) -> _F:
+    """Decorate <method>, a method of Recommender, so that its calls are
+    recorded in the registry of the Recommender, if it has one.
+
+    A call made from another instrumented call is recorded as a call of its
+    own, and also counts towards the time, round trips and rows of the
+    outer one.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        registry = self.metrics
+        if registry is None:
+            return method(self, *args, **kwargs)
+        call = _Call(registry, name)
+        token = _current.set(call)
+        start = perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            registry.record_call(call, perf_counter() - start)
+            _current.reset(token)
+            outer = _current.get()
+            if outer is not None:
+                outer.db_seconds += call.db_seconds
+                outer.round_trips += call.round_trips
+                outer.rows += call.rows
+                outer.errors += call.errors
+
+    return wrapper
@@ -0,0 +1,424 @@
+"""
+Part3 of csc343 A2: snapshots of the plans of the queries, to catch plan
+regressions.
+
+capture plans every statement of the scripts of parts 1 and 2 (see
+run_scripts.py) and every statement that Recommender runs, with
+EXPLAIN (FORMAT JSON), and keeps a normalized tree of each plan: the kind
+of each node, the relation and index it reads, and its estimated cost and
+rows. Each statement is run once it is planned, so that the statements after
+it are planned against what it did, but nothing is committed.
+
+compare then flags the plans of a later capture that got worse than those
+of a snapshot: a cost or row estimate that blew up, a new sequential scan
+of a large table, or a join done with a different strategy, e.g., a hash
+join that became a nested loop. Such a change is often harmless on the
+small sample data, and only hurts at scale, so the plans are captured on a
+generated dataset of a given size (see datagen.py).
+
+test_plan_snapshots fails if a change regresses the plans of PLANS_FILE.
+After a change that is meant to alter the plans, update the snapshot with
+--update. Without it, the plans are compared with the snapshot, and the
+exit status is 1 if any regressed.
+
+Usage:
+    python plan_snapshots.py csc343h-username username "" --update
+    python plan_snapshots.py csc343h-username username "" --rows 200000 \\
+        --snapshot plans_200k.json
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from collections import Counter
+from typing import Any, Iterator, Optional
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+from psycopg2 import sql
+
+from a2 import (COPY_CLEAN_CATEGORIES, ELITE_RECOMMENDATIONS,
+                GENERIC_RECOMMENDATIONS, LOCK_SNAPSHOT_STATE, NEW_SNAPSHOT,
+                PRUNE_SNAPSHOTS, PUBLISH_SNAPSHOT, RECOMPUTE_CATEGORIES,
+                REFRESH_ANALOGOUS_RATERS, TAKE_DIRTY_CATEGORIES)
+from datagen import DataConfig, load
+from run_scripts import SCRIPTS, Catalog, Script
+
+# The snapshot that test_plan_snapshots compares the plans with.
+PLANS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "plans.json")
+
+# The statements of a repopulate, in the order it runs them, by name.
+REPOPULATE_STATEMENTS = (
+    [("LOCK_SNAPSHOT_STATE", LOCK_SNAPSHOT_STATE),
+     ("TAKE_DIRTY_CATEGORIES", TAKE_DIRTY_CATEGORIES),
+     ("NEW_SNAPSHOT", NEW_SNAPSHOT)]
+    + [(f"{name}[{i}]", statement)
+       for name, statements in (
+           ("COPY_CLEAN_CATEGORIES", COPY_CLEAN_CATEGORIES),
+           ("RECOMPUTE_CATEGORIES", RECOMPUTE_CATEGORIES),
+           ("REFRESH_ANALOGOUS_RATERS", REFRESH_ANALOGOUS_RATERS))
+       for i, statement in enumerate(statements)]
+    + [("PUBLISH_SNAPSHOT", PUBLISH_SNAPSHOT),
+       ("PRUNE_SNAPSHOTS", PRUNE_SNAPSHOTS)])
+
+# The kinds of plan nodes that join their children.
+JOINS = ("Nested Loop", "Hash Join", "Merge Join")
+
+# The statements that EXPLAIN can plan.
+_PLANNABLE = re.compile(r"\s*(?:SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b",
+                        re.IGNORECASE)
+
+# A string, a quoted identifier, a dollar-quoted string, a semicolon, or
+# anything else up to the next of those.
+_TOKEN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|"
+                    r"\$(\w*)\$.*?\$\1\$|;|[^'\";$]+|.", re.DOTALL)
+
+# The number of rows of each table of Recommender, as of its last ANALYZE.
+_TABLE_ROWS = """
+    SELECT c.relname, c.reltuples::BIGINT
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'recommender' AND c.relkind = 'r';
+"""
+
+
+def split_statements(text: str) -> list[str]:
+    """Return the statements of the SQL <text>, which has no comments,
+    without their semicolons. Empty statements are left out.
+    """
+    statements, current = [], []
+    for match in _TOKEN.finditer(text):
+        if match.group() == ";":
+            statements.append("".join(current).strip())
+            current = []
+        else:
+            current.append(match.group())
+    statements.append("".join(current).strip())
+    return [statement for statement in statements if statement]
+
+
+def normalize(node: dict[str, Any]) -> dict[str, Any]:
+    """Return the tree of the plan <node>, a "Plan" of EXPLAIN (FORMAT JSON),
+    with only what compare looks at: the kind of each node (with its
+    strategy, e.g., "Hashed Aggregate"), the relation and index it reads, if
+    any, the kind of join it does, if any, and its total cost and rows, as
+    estimated.
+    """
+    tree = {"node": node["Node Type"]}
+    if "Strategy" in node and node["Strategy"] != "Plain":
+        tree["node"] = f"{node['Strategy']} {node['Node Type']}"
+    for key, name in (("Relation Name", "relation"), ("Index Name", "index"),
+                      ("Join Type", "join")):
+        if key in node:
+            tree[name] = node[key]
+    tree["cost"] = node["Total Cost"]
+    tree["rows"] = node["Plan Rows"]
+    if "Plans" in node:
+        tree["children"] = [normalize(child) for child in node["Plans"]]
+    return tree
+
+
+def _plan(cur: pg_ext.cursor, statement: str,
+          params: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+    """Return the normalized plan of <statement> with <params> on <cur>, and
+    then run it. Return a summary of the statement and its plan.
+    """
+    cur.execute("EXPLAIN (FORMAT JSON) " + statement, params)
+    tree = normalize(cur.fetchone()[0][0]["Plan"])
+    cur.execute(statement, params)
+    return {"statement": " ".join(statement.split())[:72],
+            "cost": tree["cost"], "rows": tree["rows"], "tree": tree}
+
+
+def _capture_scripts(cur: pg_ext.cursor, paths: list[str],
+                     plans: dict[str, Any], errors: dict[str, str]) -> None:
+    """Add the plans of the statements of the scripts at <paths> to <plans>,
+    by script and position, e.g., q1[5]. Each script runs in a schema of its
+    own, as run_scripts does, and is then undone. Add the error of each
+    script that fails to <errors>.
+    """
+    catalog = Catalog(cur.connection)
+    for path in paths:
+        script = Script(path, catalog)
+        schema = f"plans_{os.getpid()}_{script.name}"
+        cur.execute("SAVEPOINT script;")
+        try:
+            cur.execute(sql.SQL("CREATE SCHEMA {0}; "
+                                "SET LOCAL search_path TO {0}, recommender;"
+                                ).format(sql.Identifier(schema)))
+            for i, statement in enumerate(split_statements(
+                    script.isolated(schema))):
+                if _PLANNABLE.match(statement):
+                    plans[f"{script.name}[{i}]"] = _plan(cur, statement)
+                else:
+                    cur.execute(statement)
+        except pg.Error as ex:
+            errors[script.name] = str(ex).strip().splitlines()[0]
+        cur.execute("ROLLBACK TO SAVEPOINT script;")
+
+
+def _repopulate(cur: pg_ext.cursor, params: dict[str, Any],
+                plans: Optional[dict[str, Any]] = None,
+                prefix: str = "") -> None:
+    """Run the statements of a repopulate with <params>, except for "old"
+    and "new", on <cur>. Unless <plans> is None, add the plan of each to
+    <plans>, by <prefix> and the name of the statement.
+    """
+    params = dict(params)
+    for name, statement in REPOPULATE_STATEMENTS:
+        if plans is None:
+            cur.execute(statement, params)
+        else:
+            plans[prefix + name] = _plan(cur, statement, params)
+        if name == "LOCK_SNAPSHOT_STATE":
+            params["old"] = cur.fetchone()[1]
+        elif name == "NEW_SNAPSHOT":
+            params["new"] = cur.fetchone()[0]
+
+
+def _capture_recommender(cur: pg_ext.cursor,
+                         plans: dict[str, Any]) -> None:
+    """Add the plans of the statements of Recommender to <plans>: those of
+    recommend_generic, of recommend for one customer and for many, and of
+    a full and an incremental repopulate, which are undone.
+    """
+    cur.execute("SELECT CID FROM Customer "
+                "WHERE CID NOT IN (SELECT CID FROM EliteMember) "
+                "ORDER BY CID LIMIT 1000;")
+    customers = [row[0] for row in cur.fetchall()]
+    cur.execute("SELECT category FROM Item "
+                "GROUP BY category ORDER BY COUNT(*) DESC, category LIMIT 1;")
+    category = [row[0] for row in cur.fetchall()]
+
+    plans["recommend_generic"] = _plan(cur, GENERIC_RECOMMENDATIONS,
+                                       {"k": 5})
+    plans["recommend"] = _plan(cur, ELITE_RECOMMENDATIONS,
+                               {"cids": customers[:1], "k": 5})
+    plans["recommend_many"] = _plan(cur, ELITE_RECOMMENDATIONS,
+                                    {"cids": customers, "k": 5})
+    for mode, full in (("full", True), ("incremental", False)):
+        cur.execute("SAVEPOINT repopulate;")
+        _repopulate(cur, {"all": full, "cats": [] if full else category,
+                          "stale": False, "keep": 0},
+                    plans, f"repopulate_{mode}.")
+        cur.execute("ROLLBACK TO SAVEPOINT repopulate;")
+
+
+def prepare(connection: pg_ext.connection, config: DataConfig) -> None:
+    """Load the dataset of <config> into the database that <connection> is
+    connected to, whose tables are empty, and publish a snapshot of it, as
+    a full repopulate does. Commit, VACUUM and ANALYZE the tables, and turn
+    autovacuum off for them.
+
+    The plans depend on the statistics and the size of the tables, which the
+    statements that capture runs and undoes change, e.g., with the rows
+    that they leave dead, and which autovacuum would change at any time:
+    plans are only comparable if each capture runs on a database freshly
+    prepared with the same <config>.
+    """
+    load(connection, config)
+    with connection.cursor() as cur:
+        _repopulate(cur, {"all": True, "cats": [], "stale": False,
+                          "keep": 0})
+        cur.execute(_TABLE_ROWS)
+        tables = [sql.Identifier("recommender", table)
+                  for table, _ in cur.fetchall()]
+        cur.execute(sql.SQL(" ").join(
+            sql.SQL("ALTER TABLE {} SET (autovacuum_enabled = false);")
+            .format(table) for table in tables))
+    connection.commit()
+    autocommit = connection.autocommit
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cur:
+            cur.execute(sql.SQL("VACUUM ANALYZE {};").format(
+                sql.SQL(", ").join(tables)))
+    finally:
+        connection.autocommit = autocommit
+
+
+def capture(connection: pg_ext.connection,
+            paths: Optional[list[str]] = None) -> dict[str, Any]:
+    """Return the plans of the statements of the scripts at <paths> (by
+    default, SCRIPTS) and of Recommender on the database that <connection>
+    is connected to, with the version of the server, the number of rows of
+    each table, and the error of each script that failed. Nothing is
+    committed.
+    """
+    plans, errors = {}, {}
+    try:
+        with connection.cursor() as cur:
+            cur.execute(_TABLE_ROWS)
+            tables = dict(cur.fetchall())
+            _capture_scripts(cur, list(SCRIPTS if paths is None else paths),
+                             plans, errors)
+            _capture_recommender(cur, plans)
+    finally:
+        connection.rollback()
+    return {"server_version": connection.server_version, "tables": tables,
+            "plans": plans, "errors": errors}
+
+
+def major_version(snapshot: dict[str, Any]) -> Optional[int]:
+    """Return the major version of the server that <snapshot>, returned by
+    capture, was captured on, e.g., 16, or None if it does not say.
+    """
+    version = snapshot.get("server_version")
+    return None if version is None else version // 10000
+
+
+def _nodes(tree: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    """Yield the nodes of <tree>, parents first.
+    """
+    yield tree
+    for child in tree.get("children", ()):
+        yield from _nodes(child)
+
+
+def _joins(tree: dict[str, Any]) -> dict[tuple[str, ...], str]:
+    """Return the kind of each join in <tree>, by the relations it joins,
+    i.e., those read beneath it.
+    """
+    joins = {}
+    for node in _nodes(tree):
+        if node["node"] in JOINS:
+            relations = tuple(sorted(below["relation"]
+                                     for below in _nodes(node)
+                                     if "relation" in below))
+            joins[relations] = node["node"]
+    return joins
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any],
+            cost_ratio: float = 2.0, rows_ratio: float = 10.0,
+            large_rows: int = 1000) -> list[str]:
+    """Return a description of each regression of the plans of <current>
+    from those of <baseline>, both returned by capture:
+        - a statement of <baseline> that is no longer planned, e.g., because
+          its script fails;
+        - an estimated cost more than <cost_ratio> times that of <baseline>,
+          or an estimated number of rows more than <rows_ratio> times it;
+        - a sequential scan of a table of at least <large_rows> rows that
+          <baseline> did not scan sequentially;
+        - a join of the same relations done with a different strategy, or,
+          if the joins are of different relations, different strategies.
+    Statements that only <current> plans are not regressions.
+
+    Raise ValueError if <baseline> and <current> were captured on servers of
+    different major versions, whose plans differ anyway.
+    """
+    if major_version(baseline) != major_version(current):
+        raise ValueError(
+            f"the plans were captured on PostgreSQL "
+            f"{major_version(current)}, but the snapshot on PostgreSQL "
+            f"{major_version(baseline)}; update the snapshot with a server "
+            f"of the same version")
+    regressions = []
+    for name, old in baseline["plans"].items():
+        new = current["plans"].get(name)
+        if new is None:
+            script = name.split("[")[0]
+            reason = current["errors"].get(script, "not planned")
+            regressions.append(f"{name}: no longer planned ({reason})")
+            continue
+        if new["cost"] > cost_ratio * max(old["cost"], 1.0):
+            regressions.append(f"{name}: cost {old['cost']:.2f} -> "
+                               f"{new['cost']:.2f} "
+                               f"(x{new['cost'] / max(old['cost'], 1.0):.1f})")
+        if new["rows"] > rows_ratio * max(old["rows"], 1):
+            regressions.append(f"{name}: rows {old['rows']} -> "
+                               f"{new['rows']}")
+
+        scanned = {node["relation"] for node in _nodes(old["tree"])
+                   if node["node"] == "Seq Scan"}
+        for node in _nodes(new["tree"]):
+            relation = node.get("relation")
+            if node["node"] == "Seq Scan" and relation not in scanned \
+                    and current["tables"].get(relation, 0) >= large_rows:
+                scanned.add(relation)
+                regressions.append(
+                    f"{name}: new Seq Scan on {relation} "
+                    f"({current['tables'][relation]:,} rows)")
+
+        before, after = _joins(old["tree"]), _joins(new["tree"])
+        changed = [f"{before[key]} -> {after[key]} joining "
+                   f"{', '.join(key)}"
+                   for key in before.keys() & after.keys()
+                   if before[key] != after[key]]
+        if not changed and Counter(before.values()) \
+                != Counter(after.values()):
+            changed = [f"joins {dict(Counter(before.values()))} -> "
+                       f"{dict(Counter(after.values()))}"]
+        regressions.extend(f"{name}: {change}" for change in sorted(changed))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Snapshot the plans of the queries, or compare them "
+                    "with a snapshot.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--schema", default="../schema.ddl")
+    parser.add_argument("--snapshot", default=PLANS_FILE)
+    parser.add_argument("--rows", type=int,
+                        help="rows of the generated dataset (default: as in "
+                             "the snapshot, or 50000)")
+    parser.add_argument("--seed", type=int,
+                        help="seed of the generated dataset (default: as in "
+                             "the snapshot, or 0)")
+    parser.add_argument("--update", action="store_true",
+                        help="write the plans to the snapshot instead of "
+                             "comparing them with it")
+    parser.add_argument("--cost-ratio", type=float, default=2.0)
+    parser.add_argument("--rows-ratio", type=float, default=10.0)
+    parser.add_argument("--large-rows", type=int, default=1000,
+                        help="rows from which a new Seq Scan is flagged")
+    args = parser.parse_args()
+
+    baseline = None
+    if os.path.exists(args.snapshot):
+        with open(args.snapshot) as file:
+            baseline = json.load(file)
+    elif not args.update:
+        parser.error(f"no snapshot at {args.snapshot}; run with --update")
+    rows = args.rows or (baseline or {}).get("rows", 50000)
+    seed = args.seed if args.seed is not None \
+        else (baseline or {}).get("seed", 0)
+
+    conn = pg.connect(dbname=args.dbname, user=args.user,
+                      password=args.password,
+                      options="-c search_path=recommender,public")
+    try:
+        with conn.cursor() as cur, open(args.schema) as schema:
+            cur.execute(schema.read())
+        conn.commit()
+        prepare(conn, DataConfig.scaled(rows, seed=seed))
+        current = dict(capture(conn), rows=rows, seed=seed)
+    finally:
+        conn.close()
+
+    for script, error in current["errors"].items():
+        print(f"{script}: {error}", file=sys.stderr)
+    if args.update:
+        with open(args.snapshot, "w") as file:
+            json.dump(current, file, indent=1, sort_keys=True)
+        print(f"{len(current['plans'])} plans written to {args.snapshot}",
+              file=sys.stderr)
+        return
+    try:
+        regressions = compare(baseline, current, args.cost_ratio,
+                              args.rows_ratio, args.large_rows)
+    except ValueError as ex:
+        parser.exit(2, f"{ex}\n")
+    for regression in regressions:
+        print(regression, file=sys.stderr)
+    print(f"{len(current['plans'])} plans, {len(regressions)} regressions",
+          file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Part3 of csc343 A2: server-side prepared statements for the recommender.
+
+A statement is prepared (parsed, and eventually planned once) on the server
+the first time a connection runs it, and executed by name from then on.
+Connections made with PreparingConnection remember which statements they
+have prepared, so a new connection, e.g., after a reconnect, prepares them
+again.
+"""
+import re
+from typing import Any, Optional
+
+import psycopg2.errors as pg_errors
+import psycopg2.extensions as pg_ext
+
+# A named psycopg2 placeholder, such as %(k)s.
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+
+
+class PreparingConnection(pg_ext.connection):
+    """A psycopg2 connection that keeps track of the statements prepared in
+    its session. Pass it as the connection_factory of psycopg2.connect.
+
+    === Instance Attributes ===
+    prepared: The names of the statements prepared in this session.
+    """
+    prepared: set[str]
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class PreparedStatement:
+    """A statement that uses named placeholders, such as %(k)s, and can be
+    run either as a server-side prepared statement or as plain SQL.
+
+    === Instance Attributes ===
+    name: The name of the statement on the server.
+    query: The statement, with psycopg2 named placeholders.
+    params: The names of the placeholders, in the order of their $n
+        parameters in the prepared statement.
+    """
+    name: str
+    query: str
+    params: list[str]
+    _prepare: str
+    _execute: str
+
+    def __init__(self, name: str, query: str) -> None:
+        """Initialize a statement called <name> that runs <query>.
+        """
+        self.name, self.query, self.params = name, query, []
+
+        def number(match: re.Match) -> str:
+            if match.group(1) not in self.params:
+                self.params.append(match.group(1))
+            return f"${self.params.index(match.group(1)) + 1}"
+
+        body = _PLACEHOLDER.sub(number, query).strip().rstrip(";")
+        self._prepare = f"PREPARE {name} AS {body};"
+        self._execute = f"EXECUTE {name} " \
+            f"({', '.join(['%s'] * len(self.params))});" if self.params \
+            else f"EXECUTE {name};"
+
+    def execute(self, cur: pg_ext.cursor, params: Optional[dict[str, Any]],
+                prepared: bool = True) -> None:
+        """Run this statement with <params> on <cur>.
+
+        If <prepared> is True and the connection of <cur> is a
+        PreparingConnection, run it by name, preparing it first if this is
+        the first time that connection runs it. Otherwise, send the whole
+        statement, as cur.execute would.
+        """
+        conn = cur.connection
+        if not prepared or not isinstance(conn, PreparingConnection):
+            cur.execute(self.query, params)
+            return
+        if self.name not in conn.prepared:
+            cur.execute(self._prepare)
+            conn.prepared.add(self.name)
+        args = [params[name] for name in self.params]
+        try:
+            cur.execute(self._execute, args)
+        except pg_errors.InvalidSqlStatementName:
+            # Someone ran DEALLOCATE or DISCARD in this session. The error
+            # aborted the transaction, so it is up to the caller to retry.
+            conn.prepared.discard(self.name)
+            raise
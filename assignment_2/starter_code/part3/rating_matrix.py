@@ -0,0 +1,395 @@
+"""
+Part3 of csc343 A2: an in-memory engine for the recommender.
+
+A RatingMatrix holds the data that Recommender.recommend reads in compact
+NumPy arrays, so that recommendations can be computed without a round trip
+to the database. It requires NumPy, which Recommender only imports when the
+in-memory engine is enabled.
+
+A RatingMatrix can also be saved to a flat binary file, which other
+processes map read-only instead of querying the database: the arrays are
+used where they lie in the file, with no parsing, and all the processes
+that map the same file share one copy of it in the page cache.
+
+    rec = Recommender(backend=MappedBackend("matrix.bin"))
+"""
+import mmap
+import os
+import struct
+import threading
+from typing import Optional
+
+import numpy as np
+import psycopg2.extensions as pg_ext
+
+# The number of rows fetched at a time from the server-side cursors.
+_FETCH_SIZE = 50000
+
+# The layout of a saved RatingMatrix: a header with the magic number, the
+# format, the snapshot version and the number of arrays; then, for each
+# array, its name, dtype, number of rows, number of columns (-1 for a 1-D
+# array) and offset in the file; then the arrays, each starting at a
+# multiple of _ALIGNMENT bytes. All numbers are little-endian.
+_MAGIC = b"A2RATMAT"
+_FORMAT = 1
+_HEADER = struct.Struct("<8sIqI")
+_ENTRY = struct.Struct("<16s4sqqq")
+_ALIGNMENT = 64
+
+# The arrays of a RatingMatrix, in the order in which they are saved.
+_ARRAYS = ("items", "generic", "elites", "elite_ratings", "customers",
+           "rating_ptr", "rating_cols", "rating_vals", "ranked_ptr",
+           "ranked_items", "bought_ptr", "bought_items")
+
+
+class RatingMatrix:
+    """A snapshot of PopularItem, EliteRating and the parts of Review,
+    Purchase and LineItem that Recommender.recommend depends on.
+
+    The ratings of customers are stored as a sparse customer x popular item
+    matrix in CSR form: the ratings of customer customers[c] are in
+    positions rating_ptr[c] to rating_ptr[c + 1] - 1 of rating_cols and
+    rating_vals. The other per-customer and per-elite lists use the same
+    layout.
+
+    === Instance Attributes ===
+    version: The SnapshotState version of the derived tables it was built
+        from.
+    items: The IDs of the popular items, in increasing order. Column j of
+        the rating matrices refers to item items[j].
+    generic: The IDs of the popular items in the order in which
+        Recommender.recommend_generic ranks them.
+    elites: The IDs of the elite members who rated a popular item, in
+        increasing order.
+    elite_ratings: elite_ratings[e, j] is the rating elites[e] gave to
+        items[j], or 0 if they did not rate it.
+    customers: The IDs of the customers who rated a popular item, in
+        increasing order.
+    rating_ptr, rating_cols, rating_vals: The CSR rows of the ratings of
+        <customers>, as column indices into <items>.
+    ranked_ptr, ranked_items: For each of <elites>, all the items they
+        rated, from highest to lowest rating and then by increasing ID.
+    bought_ptr, bought_items: For each of <customers>, the items rated by
+        one of <elites> that they bought, in increasing order.
+
+    Representation invariants:
+    - All IDs are int32, all ratings are int8 and all pointers are int64.
+    """
+    version: int
+    items: np.ndarray
+    generic: np.ndarray
+    elites: np.ndarray
+    elite_ratings: np.ndarray
+    customers: np.ndarray
+    rating_ptr: np.ndarray
+    rating_cols: np.ndarray
+    rating_vals: np.ndarray
+    ranked_ptr: np.ndarray
+    ranked_items: np.ndarray
+    bought_ptr: np.ndarray
+    bought_items: np.ndarray
+
+    @classmethod
+    def load(cls, connection: pg_ext.connection) -> "RatingMatrix":
+        """Return a RatingMatrix built from the database that <connection>
+        is connected to. All tables are read from one consistent snapshot.
+
+        Raise a psycopg2.Error if reading the database fails.
+        """
+        matrix = cls()
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+                cur.execute("SELECT version FROM SnapshotState;")
+                matrix.version = cur.fetchone()[0]
+            matrix.generic = _fetch(connection, """
+                SELECT IID FROM PopularItem
+                ORDER BY avg_rating DESC NULLS LAST, IID;
+            """, 1)[:, 0]
+            matrix.items = np.sort(matrix.generic)
+
+            elite_ratings = _fetch(connection, """
+                SELECT CID, IID, rating FROM EliteRating ORDER BY CID;
+            """, 3)
+            matrix.elites = np.unique(elite_ratings[:, 0])
+            matrix.elite_ratings = np.zeros(
+                (len(matrix.elites), len(matrix.items)), dtype=np.int8)
+            matrix.elite_ratings[
+                np.searchsorted(matrix.elites, elite_ratings[:, 0]),
+                np.searchsorted(matrix.items, elite_ratings[:, 1])
+            ] = elite_ratings[:, 2]
+
+            ratings = _fetch(connection, """
+                SELECT r.CID, r.IID, r.rating
+                FROM Review r JOIN PopularItem p ON p.IID = r.IID
+                ORDER BY r.CID, r.IID;
+            """, 3)
+            matrix.customers = np.unique(ratings[:, 0])
+            matrix.rating_ptr = _pointers(ratings[:, 0], matrix.customers)
+            matrix.rating_cols = np.searchsorted(
+                matrix.items, ratings[:, 1]).astype(np.int32)
+            matrix.rating_vals = ratings[:, 2].astype(np.int8)
+
+            ranked = _fetch(connection, """
+                SELECT CID, IID FROM Review
+                WHERE CID IN (SELECT CID FROM EliteRating)
+                ORDER BY CID, rating DESC, IID;
+            """, 2)
+            matrix.ranked_ptr = _pointers(ranked[:, 0], matrix.elites)
+            matrix.ranked_items = ranked[:, 1].copy()
+
+            bought = _fetch(connection, """
+                SELECT DISTINCT p.CID, l.IID
+                FROM Purchase p JOIN LineItem l ON l.PID = p.PID
+                WHERE l.IID IN (
+                        SELECT IID FROM Review
+                        WHERE CID IN (SELECT CID FROM EliteRating))
+                    AND p.CID IN (
+                        SELECT r.CID
+                        FROM Review r JOIN PopularItem i ON i.IID = r.IID)
+                ORDER BY p.CID, l.IID;
+            """, 2)
+            matrix.bought_ptr = _pointers(bought[:, 0], matrix.customers)
+            matrix.bought_items = bought[:, 1].copy()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return matrix
+
+    def save(self, path: str) -> None:
+        """Write this RatingMatrix to a binary file at <path>, which open
+        maps, replacing any file there.
+
+        The file is written next to <path> and moved into place once it is
+        complete, so that a process that opens <path> at any time gets
+        either the old file or the new one, whole. Processes that mapped
+        the old file keep reading it until they open <path> again.
+        Raise OSError if the file cannot be written.
+        """
+        arrays = [np.ascontiguousarray(getattr(self, name)) for name in
+                  _ARRAYS]
+        offset = _aligned(_HEADER.size + _ENTRY.size * len(arrays))
+        entries, offsets = [], []
+        for name, array in zip(_ARRAYS, arrays):
+            columns = array.shape[1] if array.ndim == 2 else -1
+            entries.append(_ENTRY.pack(
+                name.encode(), array.dtype.newbyteorder("<").str.encode(),
+                array.shape[0], columns, offset))
+            offsets.append(offset)
+            offset = _aligned(offset + array.nbytes)
+
+        building = path + ".building"
+        try:
+            with open(building, "wb") as out:
+                out.write(_HEADER.pack(_MAGIC, _FORMAT, self.version,
+                                       len(arrays)))
+                out.write(b"".join(entries))
+                for array, start in zip(arrays, offsets):
+                    out.seek(start)
+                    out.write(array.astype(array.dtype.newbyteorder("<"),
+                                           copy=False).tobytes())
+                out.truncate(offset)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(building, path)
+        except OSError:
+            if os.path.exists(building):
+                os.remove(building)
+            raise
+
+    @classmethod
+    def open(cls, path: str) -> "RatingMatrix":
+        """Return the RatingMatrix saved at <path>, whose arrays are
+        read-only views of the file mapped into memory.
+
+        Raise OSError if the file cannot be mapped, or ValueError if it is
+        not a saved RatingMatrix.
+        """
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, version, count = _HEADER.unpack_from(mapped, 0)
+        if magic != _MAGIC or fmt != _FORMAT:
+            raise ValueError(f"{path} is not a saved RatingMatrix")
+        matrix = cls()
+        matrix.version = version
+        for i in range(count):
+            name, dtype, rows, columns, offset = _ENTRY.unpack_from(
+                mapped, _HEADER.size + i * _ENTRY.size)
+            shape = (rows,) if columns < 0 else (rows, columns)
+            array = np.frombuffer(mapped, dtype=_text(dtype),
+                                  count=int(np.prod(shape)), offset=offset)
+            setattr(matrix, _text(name), array.reshape(shape))
+        return matrix
+
+    def analogous_rater(self, cust: int) -> Optional[int]:
+        """Return the CID of the elite analogous rater of customer <cust>, as
+        defined in Recommender.recommend, or None if they have none.
+        """
+        row = _find(self.customers, cust)
+        if row is None or len(self.elites) == 0:
+            return None
+        start, end = self.rating_ptr[row], self.rating_ptr[row + 1]
+        ratings = self.rating_vals[start:end].astype(np.int16)
+        elite = self.elite_ratings[:, self.rating_cols[start:end]].astype(
+            np.int16)
+
+        co_rated = elite != 0
+        counts = co_rated.sum(axis=1)
+        if not counts.any():
+            return None
+        sums = np.where(co_rated, np.abs(elite - ratings), 0).sum(axis=1)
+        # Elite members with no ratings in common have a NULL difference and
+        # are never chosen. Division is correctly rounded, so equal averages
+        # compare equal, and argmin picks the first, i.e., lowest, CID.
+        averages = np.where(counts > 0, sums / np.maximum(counts, 1), np.inf)
+        return int(self.elites[np.argmin(averages)])
+
+    def recommend_elite(self, cust: int, k: int) -> list[int]:
+        """Return the item IDs of the <k> items that the elite analogous
+        rater of customer <cust> recommends to them, as Recommender.recommend
+        defines them for this snapshot, or [] if there are none.
+        """
+        elite = self.analogous_rater(cust)
+        if elite is None:
+            return []
+        e = _find(self.elites, elite)
+        ranked = self.ranked_items[self.ranked_ptr[e]:self.ranked_ptr[e + 1]]
+        row = _find(self.customers, cust)
+        bought = self.bought_items[
+            self.bought_ptr[row]:self.bought_ptr[row + 1]]
+        return ranked[~np.isin(ranked, bought)][:k].tolist()
+
+    def recommend(self, cust: int, k: int) -> list[int]:
+        """Return the item IDs of the <k> items recommended for customer
+        <cust>, as Recommender.recommend would for this snapshot.
+        """
+        return self.recommend_elite(cust, k) or self.generic[:k].tolist()
+
+
+class MappedBackend:
+    """Answers the queries of recommend and recommend_generic from a
+    RatingMatrix saved at a path, e.g., by a Recommender with a
+    <matrix_path>, mapped read-only. Before each call, it checks whether
+    the file was replaced, and if so, maps the new one, so that a new
+    snapshot is picked up by the next call. Each call is answered from one
+    snapshot. It can be shared by many threads.
+
+    === Instance Attributes ===
+    path: The path of the saved RatingMatrix.
+    matrix: The RatingMatrix mapped from it.
+    """
+    path: str
+    matrix: RatingMatrix
+    _file_id: tuple[int, ...]
+    _lock: threading.Lock
+
+    def __init__(self, path: str) -> None:
+        """Initialize this backend to serve the RatingMatrix saved at
+        <path>.
+
+        Raise OSError or ValueError if it cannot be mapped (see
+        RatingMatrix.open).
+        """
+        self.path = path
+        self._file_id = ()
+        self._lock = threading.Lock()
+        self._current()
+
+    def _current(self) -> RatingMatrix:
+        """Return the RatingMatrix of the file now at <path>, mapping it if
+        it was replaced since it was last mapped.
+        """
+        stat = os.stat(self.path)
+        file_id = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        if file_id != self._file_id:
+            with self._lock:
+                if file_id != self._file_id:
+                    # If the file is replaced again in the meantime, the
+                    # next call maps it once more.
+                    self.matrix = RatingMatrix.open(self.path)
+                    self._file_id = file_id
+        return self.matrix
+
+    def recommend_generic(self, k: int) -> Optional[list[int]]:
+        """Return the item IDs of the <k> popular items with the highest
+        average ratings, as Recommender.recommend_generic defines them.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        try:
+            return self._current().generic[:k].tolist()
+        except (OSError, ValueError) as ex:
+            # raise ex
+            return None
+
+    def recommend_elite(self, customers: list[int], k: int
+                        ) -> Optional[dict[int, list[int]]]:
+        """Return the item IDs of the <k> items that the elite analogous
+        rater of each customer in <customers> recommends to them, as
+        Recommender.recommend defines them. Customers with no such
+        recommendation are left out.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        try:
+            matrix = self._current()
+        except (OSError, ValueError) as ex:
+            # raise ex
+            return None
+        recommended = {}
+        for cust in customers:
+            items = matrix.recommend_elite(cust, k)
+            if items:
+                recommended[cust] = items
+        return recommended
+
+
+def _fetch(connection: pg_ext.connection, query: str,
+           columns: int) -> np.ndarray:
+    """Return the result of <query>, which selects <columns> integer
+    columns, as an int32 array with one row per tuple.
+
+    The rows are streamed through a server-side cursor, so the result is
+    never held as Python tuples all at once.
+    """
+    chunks = [np.empty((0, columns), dtype=np.int32)]
+    with connection.cursor(name="rating_matrix") as cur:
+        cur.itersize = _FETCH_SIZE
+        cur.execute(query)
+        while True:
+            rows = cur.fetchmany(_FETCH_SIZE)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int32))
+    return np.concatenate(chunks)
+
+
+def _pointers(row_ids: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Return the CSR pointers of the sorted <row_ids>, with one row for
+    each of the sorted <keys>. Every ID in <row_ids> must be in <keys>.
+    """
+    return np.append(np.searchsorted(row_ids, keys),
+                     len(row_ids)).astype(np.int64)
+
+
+def _aligned(offset: int) -> int:
+    """Return the first multiple of _ALIGNMENT that is at least <offset>.
+    """
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def _text(field: bytes) -> str:
+    """Return the text of the NUL-padded <field> of a saved RatingMatrix.
+    """
+    return field.rstrip(b"\0").decode()
+
+
+def _find(ids: np.ndarray, target: int) -> Optional[int]:
+    """Return the position of <target> in the sorted array <ids>, or None
+    if it does not occur.
+    """
+    position = int(np.searchsorted(ids, target))
+    if position < len(ids) and ids[position] == target:
+        return position
+    return None
@@ -0,0 +1,238 @@
+"""
+Part3 of csc343 A2: scheduled refreshes of the report views.
+
+reports.ddl defines the reports of part 1 as materialized views. A
+ReportScheduler refreshes each of them on its own interval, with REFRESH
+MATERIALIZED VIEW CONCURRENTLY, so that readers of a report are never
+blocked, and records when each refresh started and how long it took in
+ReportRefresh. Since the schedule is kept in the database, schedulers that
+restart (or run in several processes) pick up where the last one left off.
+
+Usage:
+    python reports.py csc343h-username username "" --default 300 \\
+        --interval q4=60 --interval q6=3600
+"""
+import argparse
+import threading
+from time import perf_counter
+from typing import Optional
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+from psycopg2 import sql
+
+# The report view of each query of part 1.
+REPORTS = {
+    "q1": "UnratedProductsReport",
+    "q2": "HelpfulnessReport",
+    "q3": "CuratorsReport",
+    "q4": "CategorySalesReport",
+    "q5": "HyperconsumersReport",
+    "q6": "YearOverYearReport",
+}
+
+# Record the outcome of a refresh that started at %(started)s.
+_RECORD_SUCCESS = """
+    UPDATE ReportRefresh
+    SET refreshed_at = %(started)s, duration_s = %(duration)s,
+        refreshes = refreshes + 1, last_error = NULL
+    WHERE report = %(report)s;
+"""
+_RECORD_FAILURE = """
+    UPDATE ReportRefresh
+    SET failures = failures + 1, last_error = %(error)s
+    WHERE report = %(report)s;
+"""
+
+
+class ReportScheduler:
+    """Refreshes the report views, each on its own interval.
+
+    Call run_pending to refresh the reports that are due, or start to do so
+    from a background thread until stop is called.
+
+    === Instance Attributes ===
+    intervals: The number of seconds between refreshes of each report, by
+        view name. Reports that are not in it are never refreshed.
+    connection: The connection the refreshes run on, in autocommit mode.
+    """
+    intervals: dict[str, float]
+    connection: pg_ext.connection
+    _lock: threading.Lock
+    _stop: threading.Event
+    _thread: Optional[threading.Thread]
+
+    def __init__(self, intervals: dict[str, float], **kwargs) -> None:
+        """Initialize a scheduler for <intervals>, whose keys are view names
+        or the names of the part 1 queries in REPORTS, connecting to the
+        database with the psycopg2.connect arguments <kwargs>.
+
+        Raise psycopg2.Error if the connection cannot be made.
+        """
+        self.intervals = {REPORTS.get(name, name): seconds
+                          for name, seconds in intervals.items()}
+        self.connection = pg.connect(
+            options="-c search_path=recommender,public", **kwargs)
+        self.connection.autocommit = True
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self, report: str) -> bool:
+        """Refresh the view <report> now, without blocking its readers, and
+        record the refresh in ReportRefresh.
+
+        If another session is refreshing <report> already, do nothing.
+        Return True if the refresh was successful or skipped, False
+        otherwise.
+        """
+        report = REPORTS.get(report, report)
+        with self._lock, self.connection.cursor() as cur:
+            try:
+                cur.execute("SELECT pg_try_advisory_lock(hashtext(%s));",
+                            [report])
+                if not cur.fetchone()[0]:
+                    return True
+            except pg.Error as ex:
+                # raise ex
+                return False
+            try:
+                cur.execute("SELECT clock_timestamp();")
+                started = cur.fetchone()[0]
+                start = perf_counter()
+                cur.execute(sql.SQL(
+                    "REFRESH MATERIALIZED VIEW CONCURRENTLY {};").format(
+                    sql.Identifier(report.lower())))
+                cur.execute(_RECORD_SUCCESS, {
+                    "started": started, "duration": perf_counter() - start,
+                    "report": report})
+                return True
+            except pg.Error as ex:
+                # raise ex
+                try:
+                    cur.execute(_RECORD_FAILURE, {"error": str(ex).strip(),
+                                                  "report": report})
+                except pg.Error:
+                    pass
+                return False
+            finally:
+                try:
+                    cur.execute("SELECT pg_advisory_unlock(hashtext(%s));",
+                                [report])
+                except pg.Error:
+                    pass
+
+    def stats(self) -> Optional[dict[str, dict]]:
+        """Return, for each report, the time its data is from
+        (refreshed_at), how many seconds old that is (staleness_s), how long
+        its last refresh took, and its numbers of refreshes and failures.
+
+        Return None if an error occurs.
+        """
+        try:
+            with self._lock, self.connection.cursor() as cur:
+                cur.execute("""
+                    SELECT report, refreshed_at,
+                        EXTRACT(EPOCH FROM now() - refreshed_at)::FLOAT,
+                        duration_s, refreshes, failures, last_error
+                    FROM ReportRefresh ORDER BY report;
+                """)
+                return {row[0]: {"refreshed_at": row[1],
+                                 "staleness_s": row[2],
+                                 "duration_s": row[3], "refreshes": row[4],
+                                 "failures": row[5], "last_error": row[6]}
+                        for row in cur.fetchall()}
+        except pg.Error as ex:
+            # raise ex
+            return None
+
+    def until_due(self) -> Optional[dict[str, float]]:
+        """Return the number of seconds until each scheduled report is due
+        for a refresh; 0 or less if it is due now.
+
+        Return None if an error occurs.
+        """
+        stats = self.stats()
+        if stats is None:
+            return None
+        return {report: seconds - stats[report]["staleness_s"]
+                if report in stats and stats[report]["refreshed_at"]
+                else 0.0
+                for report, seconds in self.intervals.items()}
+
+    def run_pending(self) -> list[str]:
+        """Refresh every scheduled report that is due, and return the names
+        of those whose refresh failed.
+        """
+        due = self.until_due() or {}
+        return [report for report, seconds in due.items()
+                if seconds <= 0 and not self.refresh(report)]
+
+    def start(self, poll: float = 60.0) -> None:
+        """Start refreshing the reports that are due from a background
+        thread. The thread sleeps until the next report is due, but for at
+        most <poll> seconds, so that refreshes made elsewhere are noticed.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def loop() -> None:
+            while not self._stop.is_set():
+                self.run_pending()
+                due = self.until_due()
+                wait = poll if not due else min(poll, max(min(due.values()),
+                                                          0.01))
+                self._stop.wait(wait)
+
+        self._thread = threading.Thread(target=loop, daemon=True,
+                                        name="report-scheduler")
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread, if it was started, waiting for the
+        refresh in progress, if any, to finish.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def close(self) -> None:
+        """Stop the background thread, and close <connection>.
+        """
+        self.stop()
+        self.connection.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Refresh the report views on a schedule.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--default", type=float, default=300,
+                        help="seconds between refreshes of each report")
+    parser.add_argument("--interval", action="append", default=[],
+                        metavar="REPORT=SECONDS",
+                        help="the interval of one report, e.g., q4=60")
+    args = parser.parse_args()
+
+    intervals = dict.fromkeys(REPORTS.values(), args.default)
+    for item in args.interval:
+        name, seconds = item.split("=")
+        intervals[REPORTS.get(name, name)] = float(seconds)
+    scheduler = ReportScheduler(intervals, dbname=args.dbname,
+                                user=args.user, password=args.password)
+    try:
+        scheduler.start()
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Part3 of csc343 A2: a cache for the results of the recommender.
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Hashable, Optional
+
+
+class ResultCache:
+    """A thread-safe cache of top-k recommendation lists, with LRU eviction
+    and an optional time to live.
+
+    Each entry maps a key to the answer for some k. Since answers are top-k
+    prefixes of one ranking, an entry also answers any smaller k, and any
+    larger k if it holds fewer than k items (there were no more to give).
+
+    Entries belong to a snapshot version. Changing the version, which
+    Recommender does whenever it sees that another snapshot was published,
+    by its own repopulate or when it reads the published version on a
+    cache miss, drops all of them.
+
+    === Instance Attributes ===
+    max_entries: The maximum number of entries held at once.
+    ttl: The number of seconds an entry stays valid, or None if entries
+        stay valid until their version changes.
+    version: The snapshot version the entries belong to, or None if it is
+        not known yet.
+    """
+    max_entries: int
+    ttl: Optional[float]
+    version: Optional[int]
+    _entries: OrderedDict
+    _lock: threading.Lock
+    _stats: dict[str, int]
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None) -> None:
+        """Initialize this cache to be empty.
+
+        Precondition:
+            - <max_entries> > 0
+        """
+        self.max_entries, self.ttl, self.version = max_entries, ttl, None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0,
+                       "expirations": 0, "invalidations": 0}
+
+    def get(self, key: Hashable, k: int) -> Optional[list[int]]:
+        """Return the cached answer for <key> and <k>, or None if there is
+        none.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None \
+                    and monotonic() - entry[2] > self.ttl:
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None or (k > entry[0] and len(entry[1]) == entry[0]):
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1][:k]
+
+    def put(self, key: Hashable, k: int, items: list[int],
+            version: Optional[int] = None) -> None:
+        """Record that <items> is the answer for <key> and <k>, as computed
+        from snapshot <version>. Nothing is recorded if <version> is no
+        longer current, or if an answer for a larger k is already cached.
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= k:
+                return
+            self._entries[key] = (k, list(items), monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """Drop the entry for <key>, if there is one.
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def set_version(self, version: int) -> None:
+        """Make <version> the current snapshot version, dropping all entries
+        if it changed.
+        """
+        with self._lock:
+            if version != self.version:
+                self._stats["invalidations"] += len(self._entries)
+                self._entries.clear()
+                self.version = version
+
+    def stats(self) -> dict[str, int]:
+        """Return a snapshot of the counters of this cache, and its current
+        number of entries.
+        """
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
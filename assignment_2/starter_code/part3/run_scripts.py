@@ -0,0 +1,356 @@
+"""
+Part3 of csc343 A2: run the scripts of part 1 and part 2 side by side.
+
+Each script runs on a connection of its own, in a schema of its own that
+comes first on its search_path, so that its views (and the result table of
+a query) never clash with those of another script, while the tables of
+Recommender are still found through the search_path. The script's own
+"SET SEARCH_PATH TO Recommender;" is dropped for this, and the views and
+tables it drops "IF EXISTS" are looked for in its own schema only. When a
+script succeeds, the tables it created (e.g., q1) replace those of the same
+name in Recommender, and its schema is dropped.
+
+Scripts that read or change the same tables still run in the order given:
+one that changes a table (directly, through the triggers of schema.ddl or
+through cascading foreign keys) waits for the earlier scripts that read or
+change it, and vice versa. The rest run at once, up to --jobs at a time.
+
+Usage:
+    python run_scripts.py csc343h-username username "" --jobs 4
+    python run_scripts.py csc343h-username username "" --jobs 1 \\
+        ../part1/q1.sql ../part2/u1.sql
+"""
+import argparse
+import itertools
+import os
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
+from typing import Any
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+from psycopg2 import sql
+
+# The scripts of parts 1 and 2, in the order they are meant to be run.
+SCRIPTS = tuple(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", part, name)
+    for part, names in (("part1", ("q1", "q2", "q3", "q4", "q5", "q6")),
+                        ("part2", ("u1", "u2", "u3")))
+    for name in (f"{n}.sql" for n in names))
+
+_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_SET_PATH = re.compile(r"\bSET\s+SEARCH_PATH\s+TO\s+Recommender\s*;",
+                       re.IGNORECASE)
+_DROP = re.compile(r"(\bDROP\s+(?:MATERIALIZED\s+VIEW|VIEW|TABLE)\s+"
+                   r"IF\s+EXISTS\s+)(\w+)", re.IGNORECASE)
+_CREATE = re.compile(r"\bCREATE\s+(?:TABLE|VIEW|MATERIALIZED\s+VIEW)\s+"
+                     r"(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.IGNORECASE)
+_WRITE = re.compile(r"\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|"
+                    r"TRUNCATE(?:\s+TABLE)?)\s+(?:ONLY\s+)?(\w+)",
+                    re.IGNORECASE)
+_WORD = re.compile(r"\w+")
+
+# Distinguishes the schemas of the runs made by this process.
+_runs = itertools.count()
+
+# The tables and views of Recommender.
+_RELATIONS = """
+    SELECT c.relname
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'recommender' AND c.relkind IN ('r', 'p', 'v', 'm');
+"""
+
+# The relations each view of Recommender is defined on.
+_VIEW_SOURCES = """
+    SELECT DISTINCT v.relname, t.relname
+    FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        JOIN pg_class t ON t.oid = d.refobjid
+        JOIN pg_namespace n ON n.oid = v.relnamespace
+    WHERE n.nspname = 'recommender' AND t.oid <> v.oid;
+"""
+
+# The source of each function of Recommender.
+_FUNCTIONS = """
+    SELECT p.proname, p.prosrc
+    FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace
+    WHERE n.nspname = 'recommender';
+"""
+
+# The function of each trigger on a table of Recommender.
+_TRIGGERS = """
+    SELECT c.relname, p.proname
+    FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_proc p ON p.oid = t.tgfoid
+    WHERE n.nspname = 'recommender' AND NOT t.tgisinternal;
+"""
+
+# The tables whose rows a change to another table updates or deletes through
+# a foreign key.
+_CASCADES = """
+    SELECT parent.relname, child.relname
+    FROM pg_constraint k
+        JOIN pg_class child ON child.oid = k.conrelid
+        JOIN pg_class parent ON parent.oid = k.confrelid
+        JOIN pg_namespace n ON n.oid = child.relnamespace
+    WHERE n.nspname = 'recommender' AND k.contype = 'f'
+        AND (k.confupdtype IN ('c', 'n', 'd')
+             OR k.confdeltype IN ('c', 'n', 'd'));
+"""
+
+
+def _closure(start: set[str], edges: dict[str, set[str]]) -> set[str]:
+    """Return <start> and everything reachable from it along <edges>.
+    """
+    reached, frontier = set(start), list(start)
+    while frontier:
+        for name in edges.get(frontier.pop(), ()):
+            if name not in reached:
+                reached.add(name)
+                frontier.append(name)
+    return reached
+
+
+class Catalog:
+    """The relations of Recommender, and how reading or changing one reads or
+    changes others.
+
+    === Instance Attributes ===
+    relations: The (lower-case) names of the tables and views.
+    sources: The relations each view is defined on.
+    effects: The tables that the triggers (and the functions they call) and
+        the cascading foreign keys of each table change when it changes.
+    """
+    relations: set[str]
+    sources: dict[str, set[str]]
+    effects: dict[str, set[str]]
+
+    def __init__(self, conn: pg_ext.connection) -> None:
+        """Initialize this catalog from the database of <conn>.
+        """
+        with conn.cursor() as cur:
+            cur.execute(_RELATIONS)
+            self.relations = {row[0] for row in cur.fetchall()}
+            cur.execute(_VIEW_SOURCES)
+            self.sources = {}
+            for view, source in cur.fetchall():
+                self.sources.setdefault(view, set()).add(source)
+
+            cur.execute(_FUNCTIONS)
+            bodies = dict(cur.fetchall())
+            writes, calls = {}, {}
+            for name, body in bodies.items():
+                body = _COMMENT.sub(" ", body)
+                writes[name] = {target.lower()
+                                for target in _WRITE.findall(body)
+                                } & self.relations
+                calls[name] = {word.lower() for word in _WORD.findall(body)
+                               } & bodies.keys() - {name}
+            cur.execute(_TRIGGERS)
+            self.effects = {}
+            for table, function in cur.fetchall():
+                for called in _closure({function}, calls):
+                    self.effects.setdefault(table, set()).update(
+                        writes[called])
+            cur.execute(_CASCADES)
+            for parent, child in cur.fetchall():
+                self.effects.setdefault(parent, set()).add(child)
+        conn.rollback()
+
+    def reads(self, text: str) -> set[str]:
+        """Return the relations that SQL <text> reads, including the ones
+        read through views.
+        """
+        named = {word.lower() for word in _WORD.findall(text)}
+        return _closure(named & self.relations, self.sources)
+
+    def writes(self, text: str) -> set[str]:
+        """Return the tables that SQL <text> changes, including the ones
+        changed by triggers and cascading foreign keys.
+        """
+        targets = {target.lower() for target in _WRITE.findall(text)}
+        return _closure(targets & self.relations, self.effects)
+
+
+class Script:
+    """A script of part 1 or part 2.
+
+    === Instance Attributes ===
+    name: The name of the script, e.g., q1.
+    text: The SQL of the script, without comments.
+    reads: The relations of Recommender it reads.
+    writes: The tables of Recommender it changes.
+    """
+    name: str
+    text: str
+    reads: set[str]
+    writes: set[str]
+
+    def __init__(self, path: str, catalog: Catalog) -> None:
+        """Initialize this script from the file at <path>.
+        """
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as file:
+            self.text = _COMMENT.sub(" ", file.read())
+        # The relations the script makes itself live in its own schema, even
+        # if Recommender has some of the same name, e.g., from an older run.
+        created = {name.lower() for name in _CREATE.findall(self.text)}
+        self.reads = catalog.reads(self.text) - created
+        self.writes = catalog.writes(self.text) - created
+
+    def conflicts(self, other: "Script") -> bool:
+        """Return whether this script and <other> must not run at once: one
+        changes a relation that the other reads or changes.
+        """
+        return bool(self.writes & (other.reads | other.writes)
+                    or other.writes & self.reads)
+
+    def isolated(self, schema: str) -> str:
+        """Return the text of this script, to be run with <schema> first on
+        the search_path: it neither sets the search_path nor drops anything
+        outside of <schema>.
+        """
+        text = _SET_PATH.sub("", self.text)
+        return _DROP.sub(lambda match: f"{match.group(1)}{schema}."
+                                       f"{match.group(2)}", text)
+
+
+def plan(scripts: list[Script]) -> dict[str, list[str]]:
+    """Return the names of the scripts that each script in <scripts> must
+    wait for: the earlier ones in <scripts> that it conflicts with.
+    """
+    return {script.name: [earlier.name for earlier in scripts[:i]
+                          if script.conflicts(earlier)]
+            for i, script in enumerate(scripts)}
+
+
+def run_script(script: Script, schema: str,
+               connect_kwargs: dict[str, Any]) -> dict[str, Any]:
+    """Run <script> in a new schema called <schema>, on a new connection made
+    with <connect_kwargs>, in a single transaction. If it succeeds, move
+    the tables it created into Recommender, replacing any of the same name,
+    and drop <schema>.
+
+    Return whether it succeeded, the error if not, and when (by
+    perf_counter) it started and ended.
+    """
+    started = perf_counter()
+    error = None
+    conn = pg.connect(**connect_kwargs)
+    try:
+        with conn.cursor() as cur:
+            private = sql.Identifier(schema)
+            cur.execute(sql.SQL("CREATE SCHEMA {};").format(private))
+            cur.execute(sql.SQL("SET LOCAL search_path TO {}, recommender;")
+                        .format(private))
+            cur.execute(script.isolated(schema))
+            cur.execute("SELECT tablename FROM pg_tables "
+                        "WHERE schemaname = %s;", [schema])
+            for (table,) in cur.fetchall():
+                cur.execute(sql.SQL(
+                    "DROP TABLE IF EXISTS recommender.{0} CASCADE; "
+                    "ALTER TABLE {1}.{0} SET SCHEMA recommender;").format(
+                    sql.Identifier(table), private))
+            cur.execute(sql.SQL("DROP SCHEMA {} CASCADE;").format(private))
+        conn.commit()
+    except pg.Error as ex:
+        conn.rollback()
+        error = str(ex).strip()
+    finally:
+        conn.close()
+    return {"script": script.name, "ok": error is None, "error": error,
+            "started": started, "ended": perf_counter()}
+
+
+def run(paths: list[str], jobs: int = 4,
+        **connect_kwargs: Any) -> dict[str, Any]:
+    """Run the scripts at <paths>, up to <jobs> at a time, each on its own
+    connection made with <connect_kwargs>, in the order that their
+    conflicts require (see plan).
+
+    Return the outcome of each script, in the order of <paths>, with how
+    many seconds into the run it started, the seconds it took, and the
+    names of the scripts it waited for; the wall-clock seconds of the whole
+    run; and the sum of the seconds the scripts took. The scripts were timed
+    while running side by side, so that sum is not what running them one
+    after another would take: use <jobs> 1 to measure that.
+
+    Precondition:
+        - <jobs> > 0
+    """
+    conn = pg.connect(**connect_kwargs)
+    try:
+        catalog = Catalog(conn)
+    finally:
+        conn.close()
+    scripts = [Script(path, catalog) for path in paths]
+    waits_for = plan(scripts)
+    tag = f"run_{os.getpid()}_{next(_runs)}"
+
+    start = perf_counter()
+    outcomes, pending, running = {}, list(scripts), {}
+    with ThreadPoolExecutor(jobs) as executor:
+        while pending or running:
+            for script in [s for s in pending
+                           if set(waits_for[s.name]) <= outcomes.keys()]:
+                pending.remove(script)
+                running[executor.submit(run_script, script,
+                                        f"{tag}_{script.name}",
+                                        connect_kwargs)] = script
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                outcomes[running.pop(future).name] = future.result()
+    wall = perf_counter() - start
+
+    results = []
+    for script in scripts:
+        outcome = outcomes[script.name]
+        results.append({
+            "script": script.name, "ok": outcome["ok"],
+            "error": outcome["error"],
+            "started_s": outcome["started"] - start,
+            "seconds": outcome["ended"] - outcome["started"],
+            "waits_for": waits_for[script.name]})
+    return {"scripts": results, "wall_s": wall,
+            "script_s": sum(result["seconds"] for result in results)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run the SQL scripts of parts 1 and 2 side by side, "
+                    "each in a schema of its own.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("scripts", nargs="*", default=list(SCRIPTS),
+                        help="the scripts to run, in order (default: "
+                             "q1.sql to q6.sql, then u1.sql to u3.sql)")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="scripts run at once (1 runs them serially)")
+    args = parser.parse_args()
+
+    report = run(args.scripts, args.jobs, dbname=args.dbname,
+                 user=args.user, password=args.password)
+    for result in report["scripts"]:
+        status = "ok" if result["ok"] else "FAILED"
+        after = f" after {', '.join(result['waits_for'])}" \
+            if result["waits_for"] else ""
+        print(f"{result['script']:6} {status:6} at {result['started_s']:7.3f}"
+              f" s, took {result['seconds']:7.3f} s{after}",
+              file=sys.stderr)
+        if not result["ok"]:
+            print(f"       {result['error'].splitlines()[0]}",
+                  file=sys.stderr)
+    print(f"wall clock {report['wall_s']:.3f} s with {args.jobs} jobs; "
+          f"{report['script_s']:.3f} s in the scripts in total",
+          file=sys.stderr)
+    sys.exit(0 if all(result["ok"] for result in report["scripts"]) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Part3 of csc343 A2: an embedded SQLite backend for the recommender.
+
+write_snapshot copies the tables that recommend and recommend_generic read
+(Item, Purchase, LineItem, Review, EliteMember, PopularItem and
+EliteRating) from PostgreSQL into an SQLite file, with the indexes those
+queries need. An SQLiteBackend opened on that file answers them in
+process, with no server and no network round trip, e.g., on an edge node
+or in a batch job:
+
+    rec = Recommender(backend=SQLiteBackend("snapshot.sqlite"))
+    rec.recommend(1518, 5)
+
+The file is a snapshot: it reflects the database when it was written, like
+the RatingMatrix of Recommender(in_memory=True).
+
+Usage:
+    python sqlite_backend.py csc343h-username username "" snapshot.sqlite
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+from typing import Optional
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+# The number of rows fetched at a time from the server-side cursors.
+_FETCH_SIZE = 50000
+
+# The tables of the snapshot: for each, its definition in SQLite and the
+# columns copied from PostgreSQL.
+SNAPSHOT_TABLES = {
+    "Item": ("""
+        CREATE TABLE Item (
+            IID INTEGER PRIMARY KEY,
+            category TEXT NOT NULL,
+            description TEXT NOT NULL,
+            price REAL NOT NULL
+        );
+    """, "IID, category, description, price"),
+    "Purchase": ("""
+        CREATE TABLE Purchase (
+            PID INTEGER PRIMARY KEY,
+            CID INTEGER NOT NULL,
+            checkout_time TEXT NOT NULL,
+            card_pan TEXT NOT NULL,
+            card_type TEXT NOT NULL
+        );
+    """, "PID, CID, checkout_time::TEXT, card_pan, card_type"),
+    "LineItem": ("""
+        CREATE TABLE LineItem (
+            PID INTEGER,
+            IID INTEGER,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (PID, IID)
+        ) WITHOUT ROWID;
+    """, "PID, IID, quantity"),
+    "Review": ("""
+        CREATE TABLE Review (
+            CID INTEGER,
+            IID INTEGER,
+            rating INTEGER NOT NULL,
+            comment TEXT,
+            PRIMARY KEY (CID, IID)
+        ) WITHOUT ROWID;
+    """, "CID, IID, rating, comment"),
+    "EliteMember": ("""
+        CREATE TABLE EliteMember (
+            CID INTEGER PRIMARY KEY
+        );
+    """, "CID"),
+    "PopularItem": ("""
+        CREATE TABLE PopularItem (
+            IID INTEGER PRIMARY KEY,
+            avg_rating REAL
+        );
+    """, "IID, avg_rating"),
+    "EliteRating": ("""
+        CREATE TABLE EliteRating (
+            CID INTEGER,
+            IID INTEGER,
+            rating INTEGER NOT NULL,
+            PRIMARY KEY (CID, IID)
+        ) WITHOUT ROWID;
+    """, "CID, IID, rating"),
+}
+
+# The indexes that ELITE_RECOMMENDATIONS needs, besides the primary keys:
+# the elite ratings of an item, and the purchases of a customer.
+SNAPSHOT_INDEXES = (
+    "CREATE INDEX EliteRating_item ON EliteRating (IID, CID, rating);",
+    "CREATE INDEX Purchase_customer ON Purchase (CID, PID);",
+)
+
+# The statements of a2.py, in SQLite. The snapshot has no AnalogousRater,
+# so the analogous raters are computed as analogous_raters in schema.ddl
+# does. SQLite has no DISTINCT ON, so the analogous rater is picked with
+# ROW_NUMBER, and the customers are passed as a JSON array. AVG over
+# integers is a correctly rounded division in both databases, so ties
+# between elite members are broken the same way.
+GENERIC_RECOMMENDATIONS = """
+    SELECT IID FROM PopularItem
+    ORDER BY avg_rating DESC NULLS LAST, IID
+    LIMIT :k;
+"""
+
+ELITE_RECOMMENDATIONS = """
+    WITH Requested AS (
+        SELECT value AS CID FROM json_each(:cids)
+    ), RatingDifference AS (
+        SELECT r.CID, er.CID AS elite,
+               AVG(ABS(r.rating - er.rating)) AS avg_diff
+        FROM Requested q
+            JOIN Review r ON r.CID = q.CID
+            JOIN EliteRating er ON er.IID = r.IID
+        GROUP BY r.CID, er.CID
+    ), AnalogousRater AS (
+        SELECT CID, elite FROM (
+            SELECT CID, elite, ROW_NUMBER() OVER (
+                PARTITION BY CID ORDER BY avg_diff, elite
+            ) AS place
+            FROM RatingDifference
+        )
+        WHERE place = 1
+    ), Candidate AS (
+        SELECT a.CID, r.IID, ROW_NUMBER() OVER (
+            PARTITION BY a.CID ORDER BY r.rating DESC, r.IID
+        ) AS position
+        FROM AnalogousRater a
+            JOIN Review r ON r.CID = a.elite
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM Purchase p JOIN LineItem l ON l.PID = p.PID
+            WHERE p.CID = a.CID AND l.IID = r.IID)
+    )
+    SELECT CID, IID FROM Candidate
+    WHERE position <= :k
+    ORDER BY CID, position;
+"""
+
+
+def write_snapshot(connection: pg_ext.connection,
+                   path: str) -> dict[str, int]:
+    """Copy the snapshot tables from the database that <connection> is
+    connected to into a new SQLite database at <path>, replacing any file
+    there, and return the number of rows copied into each table.
+
+    All tables are read from one consistent snapshot, through server-side
+    cursors, and the file is only moved into place once it is complete.
+    Raise a psycopg2.Error if reading the database fails, or sqlite3.Error
+    if writing the file fails.
+    """
+    building = path + ".building"
+    if os.path.exists(building):
+        os.remove(building)
+    counts = {}
+    target = sqlite3.connect(building)
+    try:
+        target.execute("PRAGMA journal_mode = OFF;")
+        target.execute("PRAGMA synchronous = OFF;")
+        with connection.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, "
+                        "READ ONLY;")
+        for table, (definition, columns) in SNAPSHOT_TABLES.items():
+            target.execute(definition)
+            insert = f"INSERT INTO {table} VALUES " \
+                     f"({', '.join(['?'] * len(columns.split(',')))});"
+            with connection.cursor(name=f"snapshot_{table.lower()}") as cur:
+                cur.itersize = _FETCH_SIZE
+                cur.execute(f"SELECT {columns} FROM {table};")
+                counts[table] = 0
+                while rows := cur.fetchmany(_FETCH_SIZE):
+                    target.executemany(insert, rows)
+                    counts[table] += len(rows)
+        connection.commit()
+        for index in SNAPSHOT_INDEXES:
+            target.execute(index)
+        target.execute("ANALYZE;")
+        target.commit()
+    except Exception:
+        connection.rollback()
+        target.close()
+        os.remove(building)
+        raise
+    target.close()
+    os.replace(building, path)
+    return counts
+
+
+class SQLiteBackend:
+    """Answers the queries of recommend and recommend_generic from an SQLite
+    snapshot written by write_snapshot. It can be shared by many threads:
+    each opens its own read-only connection to the file.
+
+    === Instance Attributes ===
+    path: The path of the snapshot.
+    """
+    path: str
+    _local: threading.local
+
+    def __init__(self, path: str) -> None:
+        """Initialize this backend to read the snapshot at <path>.
+
+        Raise sqlite3.Error if there is no snapshot at <path>.
+        """
+        self.path = path
+        self._local = threading.local()
+        self._connection()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the connection of this thread to the snapshot, opening it
+        if need be.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            conn.execute("SELECT 1 FROM PopularItem LIMIT 1;")
+            self._local.conn = conn
+        return conn
+
+    def recommend_generic(self, k: int) -> Optional[list[int]]:
+        """Return the item IDs of the <k> popular items with the highest
+        average ratings, as Recommender.recommend_generic defines them.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        try:
+            rows = self._connection().execute(GENERIC_RECOMMENDATIONS,
+                                              {"k": k}).fetchall()
+        except sqlite3.Error as ex:
+            # raise ex
+            return None
+        return [row[0] for row in rows]
+
+    def recommend_elite(self, customers: list[int], k: int
+                        ) -> Optional[dict[int, list[int]]]:
+        """Return the item IDs of the <k> items that the elite analogous
+        rater of each customer in <customers> recommends to them, as
+        Recommender.recommend defines them. Customers with no such
+        recommendation are left out.
+
+        Return None if an error occurs i.e., do NOT throw an error.
+        """
+        recommended = {}
+        try:
+            rows = self._connection().execute(ELITE_RECOMMENDATIONS, {
+                "cids": json.dumps(customers), "k": k}).fetchall()
+        except sqlite3.Error as ex:
+            # raise ex
+            return None
+        for cust, item in rows:
+            recommended.setdefault(cust, []).append(item)
+        return recommended
+
+    def close(self) -> None:
+        """Close the connection of this thread to the snapshot, if any.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Write an SQLite snapshot for SQLiteBackend.")
+    parser.add_argument("dbname")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    conn = pg.connect(dbname=args.dbname, user=args.user,
+                      password=args.password,
+                      options="-c search_path=recommender,public")
+    try:
+        counts = write_snapshot(conn, args.path)
+    finally:
+        conn.close()
+    for table, count in counts.items():
+        print(f"{table:12} {count:>10,} rows", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,26 @@ expressly prohibited.
 --------------------------------------------------------------------------------
 """
 import pytest
+import asyncio
+import datetime as dt
+import hashlib
+import io
+import json
+import os
+import psycopg2.extensions as pg_ext
 from a2 import *
+from async_recommender import AsyncRecommender
+from benchmark import find_regressions, latency_summary
+from datagen import DataConfig, DataGenerator, TABLES, load
+from loadgen import LatencyHistogram, run as run_load
+from metrics import MetricsRegistry
+from plan_snapshots import (PLANS_FILE, capture, compare, major_version,
+                            prepare)
+from rating_matrix import MappedBackend
+from reports import ReportScheduler
+from run_scripts import run
+from sqlite_backend import SQLiteBackend
+from concurrent.futures import ThreadPoolExecutor
 from psycopg2 import sql
 from psycopg2.extras import execute_values
 
@@ -25,89 +44,201 @@ PASSWORD = ""
 # files to use for testing.
 SCHEMA_FILE = "../schema.ddl"
 SAMPLE_DATA = "../data.sql"
+REPORTS_FILE = "../reports.ddl"
+PARTITIONED_FILE = "../partitioned.ddl"
 
 
-def setup(schema_path: str, data_path: str) -> None:
-    """Set up the testing environment by importing the schema file
-    at <schema_path> and the file containing the data at <data_path>.
+# Each pytest-xdist worker (or the only process, without xdist) runs its
+# tests against its own database, TEST_DB_NAME, which setup recreates from a
+# template of the schema and data. If USER may not create databases, the
+# tests run against DB_NAME and setup loads the files into it every time.
+WORKER = os.environ.get("PYTEST_XDIST_WORKER", "main")
+TEST_DB_NAME = DB_NAME
 
-    <schema_path> and <data_path> are the relative/absolute paths to the files
-    containing the schema and the data respectively.
+# Open connections to the test databases, reused by the helpers below.
+_connections: dict[str, pg_ext.connection] = {}
+
+
+def _connection(dbname: str) -> pg_ext.connection:
+    """Return an open connection to <dbname>, reusing one made earlier if
+    there is one.
     """
-    connection, cursor, schema_file, data_file = None, None, None, None
-    try:
-        connection = pg.connect(
-            dbname=DB_NAME, user=USER, password=PASSWORD,
+    conn = _connections.get(dbname)
+    if conn is None or conn.closed:
+        conn = pg.connect(
+            dbname=dbname, user=USER, password=PASSWORD,
             options="-c search_path=recommender"
         )
-        cursor = connection.cursor()
+        _connections[dbname] = conn
+    return conn
+
+
+def _close_connection(dbname: str) -> None:
+    """Close the connection to <dbname> made by _connection, if any.
+    """
+    conn = _connections.pop(dbname, None)
+    if conn is not None and not conn.closed:
+        conn.close()
+
 
-        with open(schema_path, "r") as schema_file:
-            cursor.execute(schema_file.read())
+def _admin(statements: list[sql.Composable]) -> None:
+    """Run <statements>, which cannot run inside a transaction (such as
+    CREATE DATABASE), on DB_NAME.
+    """
+    conn = pg.connect(dbname=DB_NAME, user=USER, password=PASSWORD)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement)
+    finally:
+        conn.close()
 
-        with open(data_path, "r") as info_file:
-            cursor.execute(info_file.read())
 
-        connection.commit()
+def _recreate(dbname: str, template: Optional[str] = None) -> None:
+    """Drop <dbname>, if it exists, and create it again as a copy of
+    <template>, or empty if <template> is None.
+    """
+    _close_connection(dbname)
+    create = sql.SQL("CREATE DATABASE {}").format(sql.Identifier(dbname))
+    if template is not None:
+        create = sql.SQL("{} TEMPLATE {}").format(
+            create, sql.Identifier(template))
+    _admin([sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE)").format(
+        sql.Identifier(dbname)), create])
+
+
+def _load_files(conn: pg_ext.connection, schema_path: str,
+                data_path: str) -> None:
+    """Run the schema file at <schema_path>, then the data file at
+    <data_path>, on <conn>, and commit.
+    """
+    try:
+        with conn.cursor() as cursor:
+            with open(schema_path, "r") as schema_file:
+                cursor.execute(schema_file.read())
+            with open(data_path, "r") as data_file:
+                cursor.execute(data_file.read())
+        conn.commit()
     except Exception as ex:
-        connection.rollback()
+        conn.rollback()
         raise Exception(f"Couldn't set up environment for tests: \n{ex}")
+
+
+def _template(schema_path: str, data_path: str) -> str:
+    """Return the name of a database holding the schema at <schema_path>
+    and the data at <data_path>, building it unless an earlier run did.
+
+    The name depends on the contents of both files, so templates of stale
+    files are never used, and are dropped when a new one is built.
+    """
+    digest = hashlib.sha1()
+    for path in (schema_path, data_path):
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    prefix = f"{TEST_DB_NAME}_"
+    name = prefix + digest.hexdigest()[:12]
+
+    conn = _connection(DB_NAME)
+    with conn.cursor() as cur:
+        cur.execute("SELECT datname FROM pg_database "
+                    "WHERE starts_with(datname, %s);", [prefix])
+        existing = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    if name in existing:
+        return name
+
+    # Build under another name and rename at the end, so that a run that
+    # is interrupted half-way never leaves a broken template behind.
+    building = prefix + "building"
+    _recreate(building)
+    try:
+        _load_files(_connection(building), schema_path, data_path)
+    finally:
+        _close_connection(building)
+    _admin([sql.SQL("DROP DATABASE {} WITH (FORCE)").format(
+        sql.Identifier(stale)) for stale in existing - {building}]
+        + [sql.SQL("ALTER DATABASE {} RENAME TO {}").format(
+            sql.Identifier(building), sql.Identifier(name))])
+    return name
+
+
+@pytest.fixture(scope="session", autouse=True)
+def isolated_database() -> Iterator[None]:
+    """Give this worker a database of its own for the session, if USER may
+    create databases, and close the connections of the helpers at the end.
+    """
+    global TEST_DB_NAME
+    conn = _connection(DB_NAME)
+    with conn.cursor() as cur:
+        cur.execute("SELECT rolcreatedb OR rolsuper FROM pg_roles "
+                    "WHERE rolname = current_user;")
+        may_create = cur.fetchone()[0]
+    conn.commit()
+    if may_create:
+        TEST_DB_NAME = f"{DB_NAME}_{WORKER}"
+        _recreate(TEST_DB_NAME)
+    try:
+        yield
     finally:
-        if cursor and not cursor.closed:
-            cursor.close()
-        if connection and not connection.closed:
-            connection.close()
+        for dbname in list(_connections):
+            _close_connection(dbname)
+        if TEST_DB_NAME != DB_NAME:
+            _admin([sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE)").format(
+                sql.Identifier(TEST_DB_NAME))])
+            TEST_DB_NAME = DB_NAME
+
+
+def setup(schema_path: str, data_path: str) -> None:
+    """Set up the testing environment by importing the schema file
+    at <schema_path> and the file containing the data at <data_path>.
+
+    <schema_path> and <data_path> are the relative/absolute paths to the files
+    containing the schema and the data respectively.
+
+    If this worker has a database of its own, it is recreated from a template
+    holding both files, which is only built the first time they are used.
+    """
+    if TEST_DB_NAME == DB_NAME:
+        _load_files(_connection(DB_NAME), schema_path, data_path)
+    else:
+        _recreate(TEST_DB_NAME, _template(schema_path, data_path))
 
 
 def get_rows(table_name: str) -> Optional[set[tuple]]:
     """Return the contents of the table <table_name> under our recommender
     schema.
     """
-    conn, cur = None, None
+    conn = _connection(TEST_DB_NAME)
     try:
-        conn = pg.connect(
-            dbname=DB_NAME, user=USER, password=PASSWORD,
-            options="-c search_path=recommender"
-        )
-        cur = conn.cursor()
-        cur.execute(sql.SQL("SELECT * FROM {}").format(
-            sql.Identifier(table_name.lower())))
-        return set(elem for elem in cur.fetchall())
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("SELECT * FROM {}").format(
+                sql.Identifier(table_name.lower())))
+            return set(elem for elem in cur.fetchall())
     except pg.Error as ex:
-        conn.rollback()
         raise Exception(f"Couldn't retrieve data from table {table_name}")
     finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+        # End the transaction, so that its locks do not block the code
+        # under test.
+        conn.rollback()
 
 
 def insert_rows(table_name: str, rows: set[tuple]) -> bool:
     """Insert the tuples <rows> in table <table_name> under our recommender
     schema. Return False if an error occurs.
     """
-    conn, cur = None, None
+    conn = _connection(TEST_DB_NAME)
     try:
-        conn = pg.connect(
-            dbname=DB_NAME, user=USER, password=PASSWORD,
-            options="-c search_path=recommender"
-        )
-        cur = conn.cursor()
-        insert_query = sql.SQL("INSERT INTO {} VALUES %s").format(
-            sql.Identifier(table_name.lower()))
-        execute_values(cur, insert_query, list(rows))
+        with conn.cursor() as cur:
+            insert_query = sql.SQL("INSERT INTO {} VALUES %s").format(
+                sql.Identifier(table_name.lower()))
+            execute_values(cur, insert_query, list(rows))
     except pg.Error:
         conn.rollback()
         raise Exception(f"Couldn't populate table {table_name}")
     else:
         conn.commit()
         return True
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
 
 
 def test_repopulate_basic() -> None:
@@ -121,7 +252,7 @@ def test_repopulate_basic() -> None:
         # and call the same function to load them into your database.
         setup(SCHEMA_FILE, SAMPLE_DATA)
 
-        connected = a2.connect(DB_NAME, USER, PASSWORD)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
 
         # The following is an assert statement. It checks that the value for
         # connected is True. The message after the comma will be printed if
@@ -191,7 +322,7 @@ def test_recommend_generic_basic() -> None:
         # and call the same function to load them into your database.
         setup(SCHEMA_FILE, SAMPLE_DATA)
 
-        connected = a2.connect(DB_NAME, USER, PASSWORD)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
 
         # The following is an assert statement. It checks that the value for
         # connected is True. The message after the comma will be printed if
@@ -244,7 +375,7 @@ def test_recommend_basic() -> None:
         # and call the same function to load them into your database.
         setup(SCHEMA_FILE, SAMPLE_DATA)
 
-        connected = a2.connect(DB_NAME, USER, PASSWORD)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
 
         # The following is an assert statement. It checks that the value for
         # connected is True. The message after the comma will be printed if
@@ -280,5 +411,1307 @@ def test_recommend_basic() -> None:
         a2.disconnect()
 
 
+def test_repopulate_incremental() -> None:
+    """Test that an incremental repopulate produces the same snapshot as a
+    full rebuild, and only touches the categories that changed.
+    """
+    a2 = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        insert_rows("EliteMember", {(1518,)})
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        assert get_rows("DirtyCategory") == set(), \
+            "[Repopulate] DirtyCategory should be empty after repopulate."
+
+        # TEST: New sales make item 4 popular in 'Book'; a new review of
+        # item 3 changes its average rating.
+        insert_rows("Purchase", {(103, 1599, '2025-01-01', '1', 'Visa')})
+        insert_rows("LineItem", {(103, 4, 20)})
+        insert_rows("Review", {(1518, 3, 2, None), (1599, 4, 4, None)})
+        assert get_rows("DirtyCategory") == {('Book',)}, \
+            "[Repopulate] Only 'Book' should be marked as dirty."
+
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        incremental = get_rows("PopularItem"), get_rows("EliteRating")
+        expected_popular_items = {(4, 14 / 3), (3, 2.0), (5, None)}
+        assert incremental[0] == expected_popular_items, \
+            "[Repopulate] PopularItem content is incorrect."
+        assert incremental[1] == {(1518, 4, 5), (1518, 3, 2)}, \
+            "[Repopulate] EliteRating content is incorrect."
+
+        # TEST: A full rebuild agrees with the incremental one.
+        repopulated = a2.repopulate(full=True)
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        full = get_rows("PopularItem"), get_rows("EliteRating")
+        assert incremental == full, \
+            f"[Repopulate] Expected {full} | Got {incremental}."
+    finally:
+        a2.disconnect()
+
+
+def test_repopulate_snapshots() -> None:
+    """Test that repopulate publishes a new snapshot without blocking or
+    emptying readers, and that rollback_snapshot goes back to a kept one.
+    """
+    a2 = Recommender(keep_snapshots=1)
+    reader = None
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        insert_rows("EliteMember", {(1518,)})
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        first = get_rows("PopularItem"), get_rows("EliteRating")
+
+        # TEST: A reader in the middle of a transaction neither blocks
+        # repopulate nor sees the new snapshot, or part of it, until it
+        # starts a new one.
+        reader = pg.connect(dbname=TEST_DB_NAME, user=USER,
+                            password=PASSWORD,
+                            options="-c search_path=recommender,public")
+        reader.set_session(isolation_level="REPEATABLE READ")
+        with reader.cursor() as cur:
+            cur.execute("SELECT * FROM PopularItem;")
+            seen = set(cur.fetchall())
+        insert_rows("Purchase", {(103, 1599, '2025-01-01', '1', 'Visa')})
+        insert_rows("LineItem", {(103, 4, 20)})
+        insert_rows("Review", {(1518, 3, 2, None), (1599, 4, 4, None)})
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        second = get_rows("PopularItem"), get_rows("EliteRating")
+        assert second != first, "[Repopulate] Expected a new snapshot."
+        with reader.cursor() as cur:
+            cur.execute("SELECT * FROM PopularItem;")
+            still = set(cur.fetchall())
+            cur.execute("SELECT * FROM EliteRating;")
+            elite = set(cur.fetchall())
+        assert seen == still == first[0] and elite == first[1], \
+            f"[Repopulate] Expected {first} | Got {(still, elite)}."
+        reader.rollback()
+        with reader.cursor() as cur:
+            cur.execute("SELECT * FROM PopularItem;")
+            now = set(cur.fetchall())
+        assert now == second[0], \
+            f"[Repopulate] Expected {second[0]} | Got {now}."
+
+        # TEST: Only one replaced snapshot is kept.
+        kept = {row[0] for row in get_rows("Snapshot")}
+        assert len(kept) == 2, f"[Repopulate] Expected 2 snapshots | " \
+                               f"Got {kept}."
+
+        # TEST: Rolling back publishes the previous snapshot, and there is
+        # nothing older to roll back to.
+        rolled_back = a2.rollback_snapshot()
+        assert rolled_back, f"[Rollback] Expected True | Got {rolled_back}."
+        actual = get_rows("PopularItem"), get_rows("EliteRating")
+        assert actual == first, f"[Rollback] Expected {first} | Got {actual}."
+        rolled_back = a2.rollback_snapshot()
+        assert not rolled_back, \
+            f"[Rollback] Expected False | Got {rolled_back}."
+        rolled_back = a2.rollback_snapshot(max(kept))
+        assert rolled_back, f"[Rollback] Expected True | Got {rolled_back}."
+        actual = get_rows("PopularItem"), get_rows("EliteRating")
+        assert actual == second, \
+            f"[Rollback] Expected {second} | Got {actual}."
+
+        # TEST: After a rollback, nothing is dirty, yet the next repopulate
+        # rebuilds everything rather than keeping the stale snapshot.
+        rolled_back = a2.rollback_snapshot(min(kept))
+        assert rolled_back, f"[Rollback] Expected True | Got {rolled_back}."
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        actual = get_rows("PopularItem"), get_rows("EliteRating")
+        assert actual == second, \
+            f"[Repopulate] Expected {second} | Got {actual}."
+    finally:
+        if reader is not None:
+            reader.close()
+        a2.disconnect()
+
+
+def test_analogous_raters() -> None:
+    """Test that AnalogousRater is computed by repopulate, refreshed when a
+    customer's reviews change, and agrees with an on-the-fly computation.
+    """
+    a2 = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        insert_rows("EliteMember", {(1518,)})
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        actual = get_rows("AnalogousRater")
+        assert actual == set(), f"[Analogous] Expected set() | Got {actual}."
+
+        # TEST: Elite members get no analogous rater, and the changed
+        # reviewers are marked for the next repopulate.
+        insert_rows("Purchase", {(103, 1599, '2025-01-01', '1', 'Visa')})
+        insert_rows("LineItem", {(103, 4, 20)})
+        insert_rows("Review", {(1518, 3, 2, None), (1599, 4, 4, None)})
+        actual = get_rows("DirtyCustomer")
+        assert actual == {(1518,), (1599,)}, \
+            f"[Analogous] Expected 1518 and 1599 to be dirty | Got {actual}."
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        expected = {(1515, 1518, 0), (1599, 1518, 1)}
+        actual = get_rows("AnalogousRater")
+        assert actual == expected, \
+            f"[Analogous] Expected {expected} | Got {actual}."
+        assert get_rows("DirtyCustomer") == set(), \
+            "[Analogous] DirtyCustomer should be empty after repopulate."
+
+        # TEST: A new review refreshes its author's tuple right away.
+        insert_rows("Review", {(1599, 3, 5, None)})
+        expected = {(1515, 1518, 0), (1599, 1518, 2)}
+        actual = get_rows("AnalogousRater")
+        assert actual == expected, \
+            f"[Analogous] Expected {expected} | Got {actual}."
+        mismatched = a2.check_analogous_raters()
+        assert mismatched == [], f"[Analogous] Expected [] | Got {mismatched}."
+
+        # TEST: So does a change to the published EliteRating, and the
+        # tuples still agree after an incremental and a full repopulate.
+        insert_rows("EliteRating", {(1518, 5, 1)})
+        insert_rows("Review", {(1515, 5, 1, None)})
+        mismatched = a2.check_analogous_raters()
+        assert mismatched == [], f"[Analogous] Expected [] | Got {mismatched}."
+        for full in (False, True):
+            repopulated = a2.repopulate(full)
+            assert repopulated, \
+                f"[Repopulate] Expected True | Got {repopulated}."
+            mismatched = a2.check_analogous_raters()
+            assert mismatched == [], \
+                f"[Analogous] Expected [] | Got {mismatched}."
+        recommended = a2.recommend(1599, 2)
+        assert recommended == [3], \
+            f"[Recommend] Expected [3] | Got {recommended}."
+    finally:
+        a2.disconnect()
+
+
+def test_repopulate_sharded() -> None:
+    """Test that a repopulate sharded over several connections builds the
+    same snapshot as a serial one, and leaves nothing behind if it fails.
+    """
+    sharded = Recommender(repopulate_workers=3)
+    serial = Recommender()
+    try:
+        for rec in (sharded, serial):
+            connected = rec.connect(TEST_DB_NAME, USER, PASSWORD)
+            assert connected, f"[Connect] Expected True | Got {connected}."
+        with serial.connection.cursor() as cur, open(SCHEMA_FILE) as schema:
+            cur.execute(schema.read())
+        load(serial.connection, DataConfig.scaled(5000, seed=5, categories=7))
+        tables = ("PopularItem", "EliteRating", "AnalogousRater")
+
+        # TEST: Full and incremental sharded builds match a serial rebuild.
+        for change in (None, {(10, 1, 1, None), (11, 2, 5, None)}):
+            if change is not None:
+                insert_rows("Review", change - get_rows("Review"))
+            repopulated = sharded.repopulate()
+            assert repopulated, \
+                f"[Sharded] Expected True | Got {repopulated}."
+            actual = [get_rows(table) for table in tables]
+            repopulated = serial.repopulate(full=True)
+            assert repopulated, \
+                f"[Sharded] Expected True | Got {repopulated}."
+            expected = [get_rows(table) for table in tables]
+            assert actual == expected and all(expected), \
+                "[Sharded] The snapshot differs from a serial rebuild."
+
+        # TEST: A failing shard leaves the published snapshot, the dirty
+        # categories and the list of snapshots as they were.
+        with serial.connection.cursor() as cur:
+            cur.execute("""
+                CREATE FUNCTION fail() RETURNS TRIGGER AS $$
+                BEGIN RAISE EXCEPTION 'shard failed'; END;
+                $$ LANGUAGE plpgsql;
+                CREATE TRIGGER fail BEFORE INSERT ON EliteRatingVersion
+                    FOR EACH STATEMENT EXECUTE FUNCTION fail();
+            """)
+        serial.connection.commit()
+        insert_rows("Review", {(12, 3, 4, None)} - get_rows("Review"))
+        before = [get_rows(table) for table in
+                  ("Snapshot", "DirtyCategory") + tables]
+        repopulated = sharded.repopulate(full=True)
+        assert not repopulated, \
+            f"[Sharded] Expected False | Got {repopulated}."
+        after = [get_rows(table) for table in
+                 ("Snapshot", "DirtyCategory") + tables]
+        assert after == before and before[1], \
+            "[Sharded] A failed repopulate should change nothing."
+    finally:
+        sharded.disconnect()
+        serial.disconnect()
+
+
+def test_item_stats_counters() -> None:
+    """Test that the ItemStats counters follow changes to LineItem, Review
+    and Item, and agree with a fresh aggregation.
+    """
+    a2 = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+
+        expected_stats = {(1, 'Book', 2, 0, 0), (2, 'Book', 4, 0, 0),
+                          (3, 'Book', 10, 0, 0), (4, 'Book', 1, 10, 2),
+                          (5, 'Toy', 1, 0, 0)}
+        assert get_rows("ItemStats") == expected_stats, \
+            "[ItemStats] Counters after loading the data are incorrect."
+
+        with a2.connection.cursor() as cur:
+            cur.execute("UPDATE LineItem SET quantity = quantity + 1;")
+            cur.execute("DELETE FROM LineItem WHERE PID = 101;")
+            cur.execute("UPDATE Review SET rating = 1 WHERE CID = 1515;")
+            cur.execute("INSERT INTO Review VALUES (1500, 5, 3, NULL);")
+            cur.execute("UPDATE Item SET category = 'Toy' WHERE IID = 4;")
+        a2.connection.commit()
+
+        expected_stats = {(1, 'Book', 3, 0, 0), (2, 'Book', 0, 0, 0),
+                          (3, 'Book', 11, 0, 0), (4, 'Toy', 2, 6, 2),
+                          (5, 'Toy', 2, 3, 1)}
+        assert get_rows("ItemStats") == expected_stats, \
+            "[ItemStats] Counters after the updates are incorrect."
+        mismatched = a2.check_item_stats()
+        assert mismatched == [], \
+            f"[ItemStats] Expected [] | Got {mismatched}."
+
+        # TEST: The checker reports counters that drifted.
+        with a2.connection.cursor() as cur:
+            cur.execute("UPDATE ItemStats SET units_sold = 7 WHERE IID = 3;")
+        a2.connection.commit()
+        mismatched = a2.check_item_stats()
+        assert mismatched == [3], \
+            f"[ItemStats] Expected [3] | Got {mismatched}."
+    finally:
+        a2.disconnect()
+
+
+def test_category_month_sales() -> None:
+    """Test that the CategoryMonthSales rollup follows new purchases,
+    changes of price and of checkout time, and deletions, and that q4 reads
+    it.
+    """
+    a2 = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        nov = dt.date(2024, 11, 1)
+        expected = {(nov, "Book", 116), (nov, "Toy", 99),
+                    (dt.date(2023, 1, 1), "Book", 220)}
+        actual = get_rows("CategoryMonthSales")
+        assert actual == expected, \
+            f"[Rollup] Expected {expected} | Got {actual}."
+
+        insert_rows("Purchase", {(103, 1599, "2024-11-20", "1", "Visa")})
+        insert_rows("LineItem", {(103, 5, 2), (103, 3, 1)})
+        with a2.connection.cursor() as cur:
+            cur.execute("UPDATE Item SET price = 100 WHERE IID = 5;")
+            cur.execute("UPDATE Purchase SET checkout_time = '2024-12-05' "
+                        "WHERE PID = 101;")
+            cur.execute("DELETE FROM LineItem WHERE PID = 100 AND IID = 1;")
+        a2.connection.commit()
+        expected = {(nov, "Book", 18 + 22), (nov, "Toy", 300),
+                    (dt.date(2024, 12, 1), "Book", 56),
+                    (dt.date(2023, 1, 1), "Book", 220)}
+        actual = {row for row in get_rows("CategoryMonthSales") if row[2]}
+        assert actual == expected, \
+            f"[Rollup] Expected {expected} | Got {actual}."
+        mismatched = a2.check_category_sales()
+        assert mismatched == [], \
+            f"[Rollup] Expected [] | Got {mismatched}."
+
+        with a2.connection.cursor() as cur, open("../part1/q4.sql") as q4:
+            cur.execute(q4.read())
+        a2.connection.commit()
+        actual = {row for row in get_rows("q4") if row[0] in ("11", "12")}
+        expected = {("11", "Toy", 300.0, "Book", 40.0),
+                    ("12", "Book", 56.0, "Toy", 0.0)}
+        assert actual == expected, \
+            f"[q4] Expected {expected} | Got {actual}."
+    finally:
+        a2.disconnect()
+
+
+def test_recommend_many() -> None:
+    """Test that recommend_many agrees with calling recommend for each
+    customer.
+    """
+    a2 = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+
+        insert_rows("Customer", {(1600, 'l@l.com', 'Lovegood', 'Luna', 'Ms')})
+        insert_rows("Purchase", {(104, 1600, '2025-01-01', '1', 'Visa')})
+        insert_rows("LineItem", {(104, 2, 1)})
+        insert_rows("EliteMember", {(1518,), (1500,)})
+        insert_rows("Review", {(1518, 3, 4, None), (1518, 1, 3, None),
+                               (1518, 5, 2, None), (1500, 2, 5, None),
+                               (1500, 3, 1, None), (1599, 3, 2, None),
+                               (1600, 2, 5, None)})
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+
+        # 1599's rating of item 3 differs by 2 from 1518's and by 1 from
+        # 1500's, so 1500 is their analogous rater. 1515 only rated item 4,
+        # which is not popular, so they get generic recommendations. 1600
+        # matches 1500 on item 2, but already bought it.
+        expected = {1599: [2, 3], 1515: [2, 3], 1600: [3]}
+        for cust, items in expected.items():
+            actual = a2.recommend(cust, 2)
+            assert actual == items, \
+                f"[Recommend] Expected {items} | Got {actual}."
+
+        # TEST: The batch agrees with the loop, whatever the chunk size.
+        for chunk_size in (1, 2, 10):
+            actual = a2.recommend_many([1599, 1515, 1600], 2, chunk_size)
+            assert actual == expected, \
+                f"[Recommend Many] Expected {expected} | Got {actual}."
+    finally:
+        a2.disconnect()
+
+
+def test_recommend_in_memory() -> None:
+    """Test that the in-memory engine gives the same recommendations as the
+    database.
+    """
+    pytest.importorskip("numpy")
+    a2, in_memory = Recommender(), Recommender(in_memory=True)
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        for rec in (a2, in_memory):
+            connected = rec.connect(TEST_DB_NAME, USER, PASSWORD)
+            assert connected, f"[Connect] Expected True | Got {connected}."
+
+        insert_rows("Customer", {(1600, 'l@l.com', 'Lovegood', 'Luna', 'Ms'),
+                                 (1601, 'n@n.com', 'Longbottom', 'N', 'Mr')})
+        insert_rows("Purchase", {(104, 1600, '2025-01-01', '1', 'Visa')})
+        insert_rows("LineItem", {(104, 2, 1)})
+        insert_rows("EliteMember", {(1518,), (1500,)})
+        insert_rows("Review", {(1518, 3, 4, None), (1518, 1, 3, None),
+                               (1518, 5, 2, None), (1500, 2, 5, None),
+                               (1500, 3, 1, None), (1599, 3, 2, None),
+                               (1600, 2, 5, None), (1601, 5, 3, None),
+                               (1601, 2, 4, None)})
+        repopulated = in_memory.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        assert in_memory.rating_matrix is not None, \
+            "[Repopulate] The rating matrix was not loaded."
+
+        # 1601 differs by 1 from both elite members: 1500 has the lower CID.
+        assert in_memory.rating_matrix.analogous_rater(1601) == 1500, \
+            "[Recommend] Ties should go to the elite member with lower CID."
+        for cust in (1599, 1515, 1600, 1601):
+            for k in (1, 2, 5):
+                expected = a2.recommend(cust, k)
+                actual = in_memory.recommend(cust, k)
+                assert actual == expected, \
+                    f"[Recommend] Expected {expected} | Got {actual}."
+    finally:
+        a2.disconnect()
+        in_memory.disconnect()
+
+
+def test_connect_pool_concurrent() -> None:
+    """Test that one pooled Recommender serves many threads at once, with
+    the same answers as a single connection.
+    """
+    a2, pooled = Recommender(), Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        connected = pooled.connect_pool(TEST_DB_NAME, USER, PASSWORD, 1, 8)
+        assert connected, f"[Connect Pool] Expected True | Got {connected}."
+
+        insert_rows("EliteMember", {(1518,)})
+        insert_rows("Review", {(1518, 3, 4, None), (1599, 3, 3, None),
+                               (1518, 2, 1, None)})
+        repopulated = pooled.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        expected = {cust: a2.recommend(cust, 2) for cust in (1599, 1515)}
+        expected_generic = a2.recommend_generic(2)
+
+        def serve(i: int) -> bool:
+            cust = (1599, 1515)[i % 2]
+            return pooled.recommend(cust, 2) == expected[cust] \
+                and pooled.recommend_generic(2) == expected_generic
+
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            results = list(executor.map(serve, range(256)))
+        assert all(results), "[Connect Pool] Some threads got wrong answers."
+
+        stats = pooled.pool_stats()
+        assert stats["checkouts"] >= 1 + 2 * 256, \
+            f"[Connect Pool] Too few checkouts | Got {stats['checkouts']}."
+        assert stats["in_use"] == 0 and stats["max_in_use"] <= 8, \
+            f"[Connect Pool] Connections leaked or over the limit: {stats}."
+    finally:
+        a2.disconnect()
+        pooled.disconnect()
+
+
+def test_connect_pool_reuses_connections() -> None:
+    """Test that a pool keeps the connections it opened, instead of opening
+    new ones, when many more threads than <maxconn> use it.
+    """
+    pooled = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = pooled.connect_pool(TEST_DB_NAME, USER, PASSWORD, 1, 8)
+        assert connected, f"[Connect Pool] Expected True | Got {connected}."
+        expected = pooled.recommend_generic(2)
+
+        def serve(i: int) -> tuple[int, bool]:
+            with pooled.pool.connection() as conn:
+                pid = conn.info.backend_pid
+            return pid, pooled.recommend_generic(2) == expected
+
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            results = list(executor.map(serve, range(512)))
+        assert all(ok for _, ok in results), \
+            "[Connect Pool] Some threads got wrong answers."
+        backends = {pid for pid, _ in results}
+        stats = pooled.pool_stats()
+        assert len(backends) <= 8 and stats["opened"] <= 8, \
+            f"[Connect Pool] Expected at most 8 connections | Got " \
+            f"{len(backends)} backends, {stats['opened']} opened."
+    finally:
+        pooled.disconnect()
+
+
+def test_async_recommender_matches_sync() -> None:
+    """Test that AsyncRecommender gives the same answers as Recommender,
+    including when many of its calls run concurrently.
+    """
+    a2, async_a2 = Recommender(), AsyncRecommender(size=3)
+
+    async def run_async() -> tuple:
+        connected = await async_a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        try:
+            repopulated = await async_a2.repopulate()
+            generic = await async_a2.recommend_generic(2)
+            recommended = await asyncio.gather(
+                *(async_a2.recommend(cust, k)
+                  for cust in (1599, 1515, 1600) for k in (1, 2, 3)))
+            return repopulated, generic, recommended
+        finally:
+            await async_a2.disconnect()
+
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        insert_rows("Customer", {(1600, 'l@l.com', 'Lovegood', 'Luna', 'Ms')})
+        insert_rows("EliteMember", {(1518,), (1500,)})
+        insert_rows("Review", {(1518, 3, 4, None), (1518, 1, 3, None),
+                               (1518, 5, 2, None), (1500, 2, 5, None),
+                               (1500, 3, 1, None), (1599, 3, 2, None),
+                               (1600, 2, 5, None)})
+        repopulated, generic, recommended = asyncio.run(run_async())
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        expected_popular_items = {(2, 5.0), (3, 7 / 3), (5, 2.0)}
+        assert get_rows("PopularItem") == expected_popular_items, \
+            "[Repopulate] PopularItem content is incorrect."
+
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        expected_generic = a2.recommend_generic(2)
+        assert generic == expected_generic, \
+            f"[Recommend Generic] Expected {expected_generic} | Got {generic}."
+        expected = [a2.recommend(cust, k)
+                    for cust in (1599, 1515, 1600) for k in (1, 2, 3)]
+        assert recommended == expected, \
+            f"[Recommend] Expected {expected} | Got {recommended}."
+    finally:
+        a2.disconnect()
+
+
+def test_recommend_cache() -> None:
+    """Test that cached answers are reused for smaller k, dropped when the
+    snapshot changes or the customer is invalidated, and evicted LRU.
+    """
+    a2 = Recommender(cache_size=2)
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+
+        assert a2.recommend_generic(5) == [2, 3, 5]
+        # TEST: Smaller and larger k are served from the cached answer for
+        # k = 5, which held fewer than 5 items, so there are no more.
+        insert_rows("PopularItem", {(4, 1.0)})
+        assert a2.recommend_generic(2) == [2, 3]
+        assert a2.recommend_generic(10) == [2, 3, 5]
+        stats = a2.cache_stats()
+        assert (stats["hits"], stats["misses"]) == (2, 1), \
+            f"[Cache] Expected 2 hits and 1 miss | Got {stats}."
+
+        # TEST: Customers' answers are cached, and evicted LRU.
+        assert a2.recommend(1599, 1) == [2]
+        assert a2.recommend(1515, 1) == [2]
+        assert a2.cache_stats()["evictions"] == 1, \
+            "[Cache] The answer for 1599 should have been evicted."
+
+        # TEST: Invalidating a customer drops their cached answer.
+        assert a2.recommend(1599, 1) == [2]
+        insert_rows("EliteMember", {(1518,)})
+        insert_rows("Review", {(1599, 3, 5, None), (1518, 3, 4, None),
+                               (1518, 1, 5, None)})
+        insert_rows("EliteRating", {(1518, 3, 4)})
+        a2.invalidate_customer(1599)
+        assert a2.recommend(1599, 1) == [1]
+        assert a2.recommend(1515, 1) == [2]
+
+        # TEST: A repopulate that changes the snapshot drops everything.
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        assert a2.cache_stats()["entries"] == 0, \
+            "[Cache] Repopulate should drop all the cached answers."
+        assert a2.recommend_generic(3) == [3, 2, 5]
+
+        # TEST: So does a repopulate through another Recommender, at the
+        # next cache miss, which reads the published version.
+        insert_rows("Review", {(1515, 5, 5, None)})
+        other = Recommender()
+        try:
+            connected = other.connect(TEST_DB_NAME, USER, PASSWORD)
+            assert connected, f"[Connect] Expected True | Got {connected}."
+            repopulated = other.repopulate()
+            assert repopulated, \
+                f"[Repopulate] Expected True | Got {repopulated}."
+        finally:
+            other.disconnect()
+        invalidations = a2.cache_stats()["invalidations"]
+        assert a2.recommend(1515, 1) is not None
+        assert a2.cache_stats()["invalidations"] > invalidations, \
+            "[Cache] The miss should drop the cached answers."
+        actual = a2.recommend_generic(3)
+        assert actual == [5, 3, 2], \
+            f"[Cache] Expected [5, 3, 2] | Got {actual}."
+    finally:
+        a2.disconnect()
+
+
+def test_prepared_statements() -> None:
+    """Test that prepared and unprepared statements give the same answers,
+    and that statements are prepared again after a reconnect.
+    """
+    prepared, unprepared = Recommender(), Recommender(prepared=False)
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        for rec in (prepared, unprepared):
+            connected = rec.connect(TEST_DB_NAME, USER, PASSWORD)
+            assert connected, f"[Connect] Expected True | Got {connected}."
+        insert_rows("EliteMember", {(1518,)})
+        insert_rows("Review", {(1599, 3, 5, None), (1518, 3, 4, None),
+                               (1518, 1, 5, None)})
+        repopulated = prepared.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+
+        for _ in range(2):
+            for k in (1, 2, 3):
+                expected = unprepared.recommend_generic(k)
+                actual = prepared.recommend_generic(k)
+                assert actual == expected, \
+                    f"[Recommend Generic] Expected {expected} | Got {actual}."
+                for cust in (1599, 1515):
+                    expected = unprepared.recommend(cust, k)
+                    actual = prepared.recommend(cust, k)
+                    assert actual == expected, \
+                        f"[Recommend] Expected {expected} | Got {actual}."
+            assert prepared.connection.prepared == {"recommend_generic",
+                                                    "recommend_elite"}, \
+                "[Prepared] Both hot statements should be prepared."
+            assert unprepared.connection.prepared == set(), \
+                "[Prepared] Nothing should be prepared when disabled."
+            # TEST: After a reconnect, the statements are prepared again.
+            prepared.disconnect()
+            prepared.connect(TEST_DB_NAME, USER, PASSWORD)
+    finally:
+        prepared.disconnect()
+        unprepared.disconnect()
+
+
+def test_metrics() -> None:
+    """Test that an instrumented Recommender records its calls, statements,
+    errors and slow plans, without changing its answers, and that the
+    records can be dumped for Prometheus.
+    """
+    plain = Recommender()
+    instrumented = Recommender(metrics=MetricsRegistry(explain_threshold=0.0))
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        for rec in (plain, instrumented):
+            connected = rec.connect(TEST_DB_NAME, USER, PASSWORD)
+            assert connected, f"[Connect] Expected True | Got {connected}."
+        assert plain.metrics_stats() is None, \
+            "[Metrics] Nothing should be recorded when disabled."
+        insert_rows("EliteMember", {(1518,)})
+        repopulated = instrumented.repopulate(full=True)
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        for cust in (1599, 1515):
+            expected = plain.recommend(cust, 2)
+            actual = instrumented.recommend(cust, 2)
+            assert actual == expected, \
+                f"[Recommend] Expected {expected} | Got {actual}."
+        # TEST: A swallowed error is still counted, with its message.
+        report = instrumented.bulk_ingest("LineItem", [(999, 1, 1)])
+        assert report is None, f"[Ingest] Expected None | Got {report}."
+
+        stats = instrumented.metrics_stats()
+        methods, statements = stats["methods"], stats["statements"]
+        recommend = methods["recommend"]
+        assert recommend["calls"] == 2 and recommend["errors"] == 0 \
+            and recommend["round_trips"] >= 4 \
+            and 0 < recommend["db_seconds"] <= recommend["seconds"], \
+            f"[Metrics] Unexpected recommend counters {recommend}."
+        assert methods["recommend_many"]["calls"] == 2, \
+            "[Metrics] Nested calls should be recorded too."
+        assert statements["recommend_elite"]["calls"] == 2 \
+            and statements["recommend_generic"]["rows"] >= 2, \
+            f"[Metrics] Unexpected statements {statements}."
+        # TEST: Statements are labelled by name, not by their text.
+        assert "RECOMPUTE_CATEGORIES[1]" in statements \
+            and all(len(label.split()) <= 2 for label in statements), \
+            f"[Metrics] Expected named statements | Got {list(statements)}."
+        failed = [text for text, counters in statements.items()
+                  if counters["errors"]]
+        assert methods["bulk_ingest"]["errors"] == 1 and len(failed) == 1 \
+            and "lineitem_pid_fkey" in statements[failed[0]]["last_error"], \
+            f"[Metrics] Expected the failed COPY | Got {failed}."
+
+        plans = list(instrumented.metrics.plans)
+        assert stats["plans"] == len(plans) > 0 \
+            and any(plan["statement"] == "recommend_elite"
+                    and "Buffers" in plan["plan"] for plan in plans), \
+            "[Metrics] Expected EXPLAIN ANALYZE plans of slow statements."
+        # TEST: Explaining a statement runs it again, which must not change
+        # what it changed.
+        assert any(plan["statement"] == "PRUNE_SNAPSHOTS"
+                   for plan in plans), "[Metrics] Expected DML plans too."
+        expected = get_rows("PopularItem")
+        plain.repopulate(full=True)
+        actual = get_rows("PopularItem")
+        assert actual == expected, \
+            f"[Metrics] Expected {expected} | Got {actual}."
+
+        # TEST: The statements of the shards of a repopulate are recorded
+        # as part of its call.
+        sharded = Recommender(metrics=MetricsRegistry(),
+                              repopulate_workers=2)
+        try:
+            connected = sharded.connect(TEST_DB_NAME, USER, PASSWORD)
+            assert connected, f"[Connect] Expected True | Got {connected}."
+            repopulated = sharded.repopulate(full=True)
+            assert repopulated, \
+                f"[Repopulate] Expected True | Got {repopulated}."
+            stats = sharded.metrics_stats()
+        finally:
+            sharded.disconnect()
+        recomputed = sum(counters["calls"] for label, counters
+                         in stats["statements"].items()
+                         if label.startswith("RECOMPUTE_CATEGORIES"))
+        assert recomputed >= len(RECOMPUTE_CATEGORIES) \
+            and stats["methods"]["repopulate"]["round_trips"] \
+            >= recomputed, \
+            f"[Metrics] Expected the shards' statements | Got {stats}."
+
+        text = instrumented.metrics.prometheus()
+        assert 'recommender_method_calls_total{method="recommend"} 2' \
+            in text \
+            and 'recommender_method_seconds_bucket{method="recommend",' \
+                'le="+Inf"} 2' in text \
+            and 'recommender_statement_calls_total{statement=' \
+                '"recommend_elite"} 2' in text, \
+            f"[Metrics] Unexpected Prometheus dump:\n{text}"
+    finally:
+        plain.disconnect()
+        instrumented.disconnect()
+
+
+def test_export() -> None:
+    """Test that tables are exported, row by row or with COPY, exactly as
+    they are stored, and that bad tables are reported.
+    """
+    a2 = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        insert_rows("EliteMember", {(1518,)})
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        with open("../part1/q1.sql") as q1:
+            a2.connection.cursor().execute(q1.read())
+        a2.connection.commit()
+
+        for table in ("PopularItem", "q1"):
+            expected = get_rows(table)
+            for itersize in (1, 2000):
+                rows = a2.export_rows(table, itersize)
+                actual = list(rows)
+                assert len(actual) == len(expected) \
+                    and set(actual) == expected, \
+                    f"[Export] Expected {expected} | Got {actual}."
+        # TEST: An iterator that is not read to the end is cleaned up.
+        rows = a2.export_rows("popularitem", 1)
+        next(rows)
+        rows.close()
+        assert a2.export_rows("q3") is None, \
+            "[Export] Expected None for a table that does not exist."
+        with pytest.raises(ValueError):
+            a2.export_rows("Customer")
+
+        csv = io.StringIO()
+        written = a2.export_file("PopularItem", csv)
+        lines = csv.getvalue().splitlines()
+        assert written == len(get_rows("PopularItem")) \
+            and lines[0] == "iid,avg_rating" and len(lines) == written + 1, \
+            f"[Export] Unexpected CSV {lines}."
+        binary = io.BytesIO()
+        written = a2.export_file("EliteRating", binary, fmt="binary")
+        assert written == len(get_rows("EliteRating")) \
+            and binary.getvalue().startswith(b"PGCOPY\n\xff"), \
+            "[Export] Expected the binary COPY format."
+        with pytest.raises(ValueError):
+            a2.export_file("PopularItem", csv, fmt="json")
+    finally:
+        a2.disconnect()
+
+
+def test_run_scripts() -> None:
+    """Test that the scripts of parts 1 and 2 run side by side in schemas of
+    their own, that a script that changes what a report reads waits for it,
+    and that a failing script does not stop the others.
+    """
+    setup(SCHEMA_FILE, SAMPLE_DATA)
+    conn = _connection(TEST_DB_NAME)
+    # A view left behind by running q4.sql by hand must not be dropped.
+    with conn.cursor() as cur:
+        cur.execute("CREATE VIEW MonthExtreme AS SELECT 1 AS left_behind;")
+    conn.commit()
+    price = {row[0]: row[3] for row in get_rows("Item")}
+
+    report = run(["../part1/q1.sql", "../part1/q2.sql", "../part1/q4.sql",
+                  "../part2/u1.sql"], jobs=4, dbname=TEST_DB_NAME,
+                 user=USER, password=PASSWORD)
+    outcome = {result["script"]: result for result in report["scripts"]}
+    assert [name for name, result in outcome.items() if not result["ok"]] \
+        == ["q2"], f"[Run] Only the q2 stub should fail | Got {outcome}."
+    assert outcome["u1"]["waits_for"] == ["q1", "q4"] \
+        and outcome["u1"]["started_s"] >= outcome["q4"]["seconds"] \
+        and outcome["q4"]["waits_for"] == [], \
+        f"[Run] u1 should run after the reports it changes | Got {outcome}."
+    assert report["script_s"] >= max(result["seconds"]
+                                     for result in outcome.values()), \
+        f"[Run] Unexpected timing {report}."
+
+    actual = get_rows("q4")
+    assert len(actual) == 11 * 4 + 1 \
+        and ("11", "Book", 116.0, "Toy", 99.0) in actual, \
+        f"[Run] q4 should see the prices before u1 | Got {actual}."
+    actual = {row[0]: row[3] for row in get_rows("Item")}
+    assert actual[3] == pytest.approx(price[3] * 0.8) \
+        and actual[1] == price[1], \
+        f"[Run] Expected item 3 on sale | Got {actual}."
+    assert get_rows("MonthExtreme") == {(1,)}, \
+        "[Run] Views of Recommender should be left alone."
+    with conn.cursor() as cur:
+        cur.execute("SELECT nspname FROM pg_namespace "
+                    "WHERE nspname LIKE 'run\\_%';")
+        left = cur.fetchall()
+    conn.rollback()
+    assert left == [], f"[Run] Expected no schemas left | Got {left}."
+
+
+@pytest.mark.parametrize("data", ["sample", "generated"])
+def test_sqlite_backend_parity(data: str, tmp_path) -> None:
+    """Test that a Recommender backed by an SQLite snapshot gives the same
+    answers as one backed by the database, for the sample data and for
+    synthetic data.
+    """
+    postgres = Recommender()
+    try:
+        if data == "sample":
+            setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = postgres.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        if data == "sample":
+            insert_rows("EliteMember", {(1518,)})
+            insert_rows("Review", {(1599, 3, 5, None), (1518, 3, 4, None),
+                                   (1518, 1, 5, None)})
+        else:
+            with postgres.connection.cursor() as cur, \
+                    open(SCHEMA_FILE) as schema:
+                cur.execute(schema.read())
+            load(postgres.connection, DataConfig.scaled(5000, seed=3))
+        repopulated = postgres.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+
+        path = str(tmp_path / "snapshot.sqlite")
+        counts = postgres.export_sqlite(path)
+        for table in ("Review", "PopularItem", "EliteRating"):
+            expected = len(get_rows(table))
+            assert counts is not None and counts[table] == expected, \
+                f"[SQLite] Expected {expected} {table} rows | Got {counts}."
+        sqlite = Recommender(backend=SQLiteBackend(path))
+        customers = sorted({row[0] for row in get_rows("Customer")}
+                           - {row[0] for row in get_rows("EliteMember")})
+
+        for k in (1, 2, 5, 20):
+            expected = postgres.recommend_generic(k)
+            actual = sqlite.recommend_generic(k)
+            assert actual == expected, \
+                f"[SQLite] recommend_generic({k}): Expected {expected} | " \
+                f"Got {actual}."
+            expected = postgres.recommend_many(customers, k, chunk_size=64)
+            actual = sqlite.recommend_many(customers, k, chunk_size=64)
+            assert actual == expected, \
+                f"[SQLite] recommend_many(k={k}) differs for " \
+                f"{[c for c in customers if actual[c] != expected[c]]}."
+        cust = customers[0]
+        assert sqlite.recommend(cust, 3) == postgres.recommend(cust, 3), \
+            "[SQLite] recommend should match too."
+        elite_answers = sum(1 for items in expected.values()
+                            if items != postgres.recommend_generic(20))
+        assert data == "sample" or elite_answers > 0, \
+            "[SQLite] Expected some elite-based recommendations to compare."
+        sqlite.backend.close()
+    finally:
+        postgres.disconnect()
+
+
+def test_mapped_backend(tmp_path) -> None:
+    """Test that repopulate saves each snapshot to a file, and that a
+    Recommender mapping it gives the same answers as the database, and
+    moves to a new snapshot once the file is replaced.
+    """
+    path = str(tmp_path / "matrix.bin")
+    writer = Recommender(matrix_path=path)
+    try:
+        connected = writer.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        with writer.connection.cursor() as cur, open(SCHEMA_FILE) as schema:
+            cur.execute(schema.read())
+        load(writer.connection, DataConfig.scaled(5000, seed=7))
+        repopulated = writer.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+        postgres = Recommender()
+        postgres.connection = writer.connection
+        mapped = Recommender(backend=MappedBackend(path))
+        customers = sorted({row[0] for row in get_rows("Customer")}
+                           - {row[0] for row in get_rows("EliteMember")})
+
+        # TEST: The arrays are read-only views of the file, and the answers
+        # are those of the database.
+        matrix = mapped.backend.matrix
+        assert not matrix.rating_cols.flags.writeable \
+            and not matrix.rating_cols.flags.owndata, \
+            "[Mapped] Expected read-only views of the mapped file."
+        for version in (1, 2):
+            for k in (1, 5):
+                expected = postgres.recommend_generic(k)
+                actual = mapped.recommend_generic(k)
+                assert actual == expected, \
+                    f"[Mapped] recommend_generic({k}): Expected {expected} " \
+                    f"| Got {actual}."
+                expected = postgres.recommend_many(customers, k)
+                actual = mapped.recommend_many(customers, k)
+                assert actual == expected, \
+                    f"[Mapped] recommend_many(k={k}) differs for " \
+                    f"{[c for c in customers if actual[c] != expected[c]]}."
+            actual = mapped.backend.matrix.version
+            assert actual == version, \
+                f"[Mapped] Expected snapshot {version} | Got {actual}."
+            # TEST: A new snapshot replaces the file, which the next call
+            # maps, while the old matrix stays readable.
+            insert_rows("Review", {(customers[0], 1, 5, None),
+                                   (customers[1], 2, 1, None)}
+                        - get_rows("Review"))
+            repopulated = writer.repopulate()
+            assert repopulated, \
+                f"[Repopulate] Expected True | Got {repopulated}."
+        assert matrix.version == 1 and len(matrix.generic) > 0, \
+            "[Mapped] The old snapshot should still be readable."
+        assert not os.path.exists(path + ".building"), \
+            "[Mapped] The temporary file should be gone."
+    finally:
+        writer.disconnect()
+
+
+def test_datagen_load() -> None:
+    """Test that synthetic data is deterministic and satisfies the schema,
+    including the constraints only stated in its comments.
+    """
+    config = DataConfig.scaled(3000, seed=7)
+    rows = {table: list(DataGenerator(config).rows(table))
+            for table in TABLES}
+    assert rows == {table: list(DataGenerator(config).rows(table))
+                    for table in TABLES}, \
+        "[Datagen] The same seed should give the same rows."
+
+    a2 = Recommender()
+    try:
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        with a2.connection.cursor() as cur, open(SCHEMA_FILE) as schema:
+            cur.execute(schema.read())
+        counts = load(a2.connection, config)
+        assert counts == {table: len(rows[table]) for table in TABLES}, \
+            f"[Datagen] Unexpected row counts {counts}."
+        assert 2500 <= sum(counts.values()) <= 3500, \
+            f"[Datagen] Expected about 3000 rows | Got {counts}."
+
+        assert get_rows("Purchase") and not {
+            (pid,) for pid, *_ in get_rows("Purchase")
+        } - {(pid,) for pid, *_ in get_rows("LineItem")}, \
+            "[Datagen] Every purchase should have a line item."
+        mismatched = a2.check_item_stats()
+        assert mismatched == [], \
+            f"[ItemStats] Expected [] | Got {mismatched}."
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+    finally:
+        a2.disconnect()
+
+
+def test_plan_snapshots() -> None:
+    """Test that the plans of the scripts and of Recommender have not
+    regressed from those of PLANS_FILE, and that forcing worse plans is
+    flagged.
+    """
+    with open(PLANS_FILE) as file:
+        baseline = json.load(file)
+    a2 = Recommender()
+    try:
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        with a2.connection.cursor() as cur, open(SCHEMA_FILE) as schema:
+            cur.execute(schema.read())
+        prepare(a2.connection, DataConfig.scaled(baseline["rows"],
+                                                 seed=baseline["seed"]))
+        current = capture(a2.connection)
+        if major_version(current) != major_version(baseline):
+            pytest.skip(f"{PLANS_FILE} was captured on PostgreSQL "
+                        f"{major_version(baseline)}, not "
+                        f"{major_version(current)}.")
+        regressions = compare(baseline, current)
+        assert regressions == [], \
+            f"[Plans] Expected [] | Got {regressions}. If the plans are " \
+            f"meant to change, run plan_snapshots.py with --update."
+
+        # TEST: Without hash joins, the joins that used them are flagged.
+        with a2.connection.cursor() as cur:
+            cur.execute("SET enable_hashjoin = off;")
+        a2.connection.commit()
+        regressions = compare(baseline, capture(a2.connection))
+        assert any("Hash Join ->" in regression
+                   for regression in regressions), \
+            f"[Plans] Expected a changed hash join | Got {regressions}."
+    finally:
+        a2.disconnect()
+
+
+def test_bulk_ingest() -> None:
+    """Test that bulk_ingest loads rows in chunks, rejects rows that break
+    the domain rules before sending anything, keeps ItemStats right, and
+    can replay a load when merging.
+    """
+    a2 = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+
+        purchases = [(200 + i, 1599, f"2025-01-{i + 1:02} 10:00", "4242",
+                      "Visa") for i in range(5)]
+        report = a2.bulk_ingest("Purchase", purchases, chunk_size=2)
+        assert report is not None and report["rows"] == 5 \
+            and report["inserted"] == 5 and report["chunks"] == 3 \
+            and report["rows_per_s"] > 0, \
+            f"[Ingest] Unexpected report {report}."
+        line_items = [(200 + i, 1 + i % 5, 1 + i) for i in range(5)]
+        report = a2.bulk_ingest("lineitem", iter(line_items))
+        assert report is not None and report["inserted"] == 5, \
+            f"[Ingest] Unexpected report {report}."
+
+        reviews = [(1599, 1, 3, "tab\tand \\ and\nnewline"),
+                   (1599, 2, 0, None)]
+        with pytest.raises(ValueError):
+            a2.bulk_ingest("Review", reviews)
+        with pytest.raises(ValueError):
+            a2.bulk_ingest("LineItem", [(200, 3, 0)])
+        assert (1599, 1, 3, "tab\tand \\ and\nnewline") \
+            not in get_rows("Review"), \
+            "[Ingest] Nothing should be loaded if a row is invalid."
+
+        reviews[1] = (1599, 2, 4, None)
+        report = a2.bulk_ingest("Review", reviews)
+        assert report is not None and report["inserted"] == 2, \
+            f"[Ingest] Unexpected report {report}."
+        assert {(1599, 1, 3, "tab\tand \\ and\nnewline"),
+                (1599, 2, 4, None)} <= get_rows("Review"), \
+            "[Ingest] Values should be loaded exactly as given."
+        report = a2.bulk_ingest("Review", reviews)
+        assert report is None, f"[Ingest] Expected None | Got {report}."
+
+        report = a2.bulk_ingest("Review", reviews + [(1500, 3, 2, "ok")],
+                                merge=True)
+        assert report is not None and report["rows"] == 3 \
+            and report["inserted"] == 1, \
+            f"[Ingest] Unexpected report {report}."
+        mismatched = a2.check_item_stats()
+        assert mismatched == [], \
+            f"[ItemStats] Expected [] | Got {mismatched}."
+    finally:
+        a2.disconnect()
+
+
+def test_reports() -> None:
+    """Test that the report views hold the answers to the part 1 queries,
+    and that the scheduler refreshes them without blocking readers.
+    """
+    scheduler, reader = None, None
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        conn = pg.connect(dbname=TEST_DB_NAME, user=USER, password=PASSWORD,
+                          options="-c search_path=recommender")
+        with conn.cursor() as cur, open(REPORTS_FILE) as reports, \
+                open("../part1/q1.sql") as q1:
+            cur.execute(reports.read())
+            cur.execute(q1.read())
+        conn.commit()
+        conn.close()
+
+        assert get_rows("UnratedProductsReport") == get_rows("q1"), \
+            "[Reports] UnratedProductsReport should match part1/q1.sql."
+        expected = {(1599, "Hermione Granger", "not helpful"),
+                    (1518, "Harry Potter", "very helpful"),
+                    (1515, "Ron Weasley", "very helpful"),
+                    (1500, "Albus Dumbledor", "not helpful")}
+        actual = get_rows("HelpfulnessReport")
+        assert actual == expected, \
+            f"[Reports] Expected {expected} | Got {actual}."
+        actual = get_rows("CategorySalesReport")
+        assert len(actual) == 11 * 4 + 1 \
+            and ("11", "Book", 116.0, "Toy", 99.0) in actual, \
+            f"[Reports] Unexpected CategorySalesReport {actual}."
+        expected = {("2023", "Harry Potter", "p@p.com", 10),
+                    ("2024", "Ron Weasley", "w@w.com", 4),
+                    ("2024", "Albus Dumbledor", "albus@w.com", 4)}
+        actual = get_rows("HyperconsumersReport")
+        assert actual == expected, \
+            f"[Reports] Expected {expected} | Got {actual}."
+        actual = get_rows("YearOverYearReport")
+        assert (3, 2023, 10 / 12, 2024, 0.0, -100.0) in actual \
+            and (1, 2023, 0.0, 2024, 2 / 12, float("inf")) in actual, \
+            f"[Reports] Unexpected YearOverYearReport {actual}."
+        assert get_rows("CuratorsReport") == set(), \
+            "[Reports] Expected no curators."
+
+        insert_rows("Review", {(1515, 5, 4, "Worth it")})
+        scheduler = ReportScheduler({"q3": 0, "q4": 3600},
+                                    dbname=TEST_DB_NAME, user=USER,
+                                    password=PASSWORD)
+        # A reader in the middle of a transaction must not block a refresh.
+        reader = pg.connect(dbname=TEST_DB_NAME, user=USER,
+                            password=PASSWORD,
+                            options="-c search_path=recommender")
+        with reader.cursor() as cur:
+            cur.execute("SELECT * FROM CuratorsReport;")
+        with scheduler.connection.cursor() as cur:
+            cur.execute("SET lock_timeout = '5s';")
+        failed = scheduler.run_pending()
+        assert failed == [], f"[Reports] Expected [] | Got {failed}."
+        actual = get_rows("CuratorsReport")
+        assert actual == {(1515, "Toy")}, \
+            f"[Reports] Expected {{(1515, 'Toy')}} | Got {actual}."
+
+        stats = scheduler.stats()
+        assert stats["CuratorsReport"]["refreshes"] == 1 \
+            and stats["CuratorsReport"]["duration_s"] >= 0 \
+            and stats["CategorySalesReport"]["refreshes"] == 0, \
+            f"[Reports] Only q3 should have been due | Got {stats}."
+        assert stats["CategorySalesReport"]["staleness_s"] >= 0, \
+            f"[Reports] Unexpected staleness {stats}."
+    finally:
+        if reader is not None:
+            reader.close()
+        if scheduler is not None:
+            scheduler.close()
+
+
+def test_partitioned_layout() -> None:
+    """Test that partitioned.ddl migrates Purchase and LineItem with their
+    rows and triggers, and that loading, u2 and the year-scoped reports work
+    on the new layout.
+    """
+    a2 = Recommender()
+    try:
+        setup(SCHEMA_FILE, SAMPLE_DATA)
+        before = get_rows("LineItem")
+        conn = _connection(TEST_DB_NAME)
+        with conn.cursor() as cur, open(PARTITIONED_FILE) as partitioned:
+            cur.execute(partitioned.read())
+            cur.execute("SELECT relname FROM pg_class "
+                        "WHERE relname IN ('purchase', 'lineitem') "
+                        "AND relkind = 'p';")
+            kinds = {row[0] for row in cur.fetchall()}
+        conn.commit()
+        assert kinds == {"purchase", "lineitem"}, \
+            f"[Partitioned] Expected both tables partitioned | Got {kinds}."
+        after = {row[:3] for row in get_rows("LineItem")}
+        assert after == before, \
+            f"[Partitioned] Expected {before} | Got {after}."
+        expected = {("2024", "Ron Weasley", "w@w.com", 4),
+                    ("2024", "Albus Dumbledor", "albus@w.com", 4)}
+        with conn.cursor() as cur:
+            cur.execute("SELECT * FROM hyperconsumers(2024);")
+            actual = set(cur.fetchall())
+            assert actual == expected, \
+                f"[Partitioned] Expected {expected} | Got {actual}."
+            cur.execute("SELECT * FROM year_over_year(2023);")
+            actual = set(cur.fetchall())
+        conn.rollback()
+        assert (3, 2023, 10 / 12, 2024, 0.0, -100.0) in actual, \
+            f"[Partitioned] Unexpected year_over_year {actual}."
+
+        connected = a2.connect(TEST_DB_NAME, USER, PASSWORD)
+        assert connected, f"[Connect] Expected True | Got {connected}."
+        now = dt.datetime.now().replace(microsecond=0)
+        purchases = [(200 + i, 1599, now - dt.timedelta(minutes=i), "4242",
+                      "Visa") for i in range(7)]
+        report = a2.bulk_ingest("Purchase", purchases)
+        assert report is not None and report["inserted"] == 7, \
+            f"[Partitioned] Unexpected report {report}."
+        report = a2.bulk_ingest("LineItem",
+                                [(200 + i, 3, 1) for i in range(7)])
+        assert report is not None and report["inserted"] == 7, \
+            f"[Partitioned] Unexpected report {report}."
+        loaded = {row for row in get_rows("LineItem") if row[0] >= 200}
+        assert {(row[0], row[3]) for row in loaded} \
+            == {(row[0], row[2]) for row in purchases}, \
+            "[Partitioned] LineItem should get the time of its purchase."
+
+        # A new connection, since the counts of pg_stat_xact_user_tables may
+        # still include scans from earlier transactions of the session.
+        fraud = pg.connect(dbname=TEST_DB_NAME, user=USER, password=PASSWORD,
+                           options="-c search_path=recommender")
+        try:
+            with fraud.cursor() as cur, open("../part2/u2.sql") as u2:
+                cur.execute(u2.read())
+                # TEST: Only the LineItem partition of the last 24 hours is
+                # read.
+                cur.execute("SELECT relname FROM pg_stat_xact_user_tables "
+                            "WHERE relname LIKE 'lineitem%%' "
+                            "AND seq_scan + COALESCE(idx_scan, 0) > 0;")
+                scanned = {row[0] for row in cur.fetchall()}
+            fraud.commit()
+        finally:
+            fraud.close()
+        assert scanned == {f"lineitem_{now.year}"}, \
+            f"[u2] Expected only lineitem_{now.year} read | Got {scanned}."
+        remaining = {row[0] for row in get_rows("Purchase")}
+        assert remaining == {100, 101, 102, 202, 203, 204, 205, 206}, \
+            f"[u2] Expected the 5 oldest of 7 purchases kept | " \
+            f"Got {remaining}."
+        remaining = {row[0] for row in get_rows("LineItem")}
+        assert not remaining & {200, 201}, \
+            f"[u2] Expected the line items of 200 and 201 deleted | " \
+            f"Got {remaining}."
+        for check in (a2.check_item_stats, a2.check_category_sales):
+            mismatched = check()
+            assert mismatched == [], \
+                f"[Partitioned] Expected [] | Got {mismatched}."
+        repopulated = a2.repopulate()
+        assert repopulated, f"[Repopulate] Expected True | Got {repopulated}."
+    finally:
+        a2.disconnect()
+
+
+def test_benchmark_regressions() -> None:
+    """Test that the benchmark summarizes latencies and flags only the
+    results that got slower than the threshold allows.
+    """
+    summary = latency_summary([0.001 * i for i in range(1, 101)], 2.0)
+    assert summary["calls"] == 100 and summary["throughput_per_s"] == 50, \
+        f"[Benchmark] Unexpected summary {summary}."
+    assert 49 <= summary["p50_ms"] <= 51 \
+        and 94 <= summary["p95_ms"] <= 96, \
+        f"[Benchmark] Unexpected percentiles {summary}."
+
+    def report(*p95s: float) -> dict:
+        return {"results": [{"scale": 1000, "name": "recommend", "k": k,
+                             "p95_ms": p95} for k, p95 in enumerate(p95s)]}
+
+    regressions = find_regressions(report(1.0, 1.0, 1.0),
+                                   report(1.1, 1.5, 0.5), 0.2)
+    assert len(regressions) == 1 and "k=1" in regressions[0], \
+        f"[Benchmark] Expected one regression, for k=1 | Got {regressions}."
+
+
+def test_loadgen_histogram() -> None:
+    """Test that a LatencyHistogram gives percentiles to within the width of
+    its buckets, and that merging histograms is the same as recording into
+    one.
+    """
+    latencies = [0.00001 * i for i in range(1, 10001)]
+    whole, halves = LatencyHistogram(), [LatencyHistogram(),
+                                         LatencyHistogram()]
+    for i, latency in enumerate(latencies):
+        whole.record(latency)
+        halves[i % 2].record(latency)
+    for percentile in (50, 99, 99.9):
+        expected = latencies[round(len(latencies) * percentile / 100) - 1]
+        actual = whole.percentile(percentile)
+        assert expected * 1000 <= actual <= expected * 1000 * 1.04, \
+            f"[Histogram] p{percentile}: Expected {expected * 1000} ms " \
+            f"| Got {actual}."
+    halves[0].merge(halves[1])
+    assert halves[0].counts == whole.counts \
+        and halves[0].total == whole.total == len(latencies), \
+        "[Histogram] Expected merged halves to equal the whole."
+    actual = LatencyHistogram().percentile(50)
+    assert actual is None, f"[Histogram] Expected None | Got {actual}."
+
+
+def test_loadgen_run() -> None:
+    """Test that the load generator drives recommend and recommend_generic
+    from several processes while repopulating, and reports the calls, the
+    repopulates and the connections.
+    """
+    setup(SCHEMA_FILE, SAMPLE_DATA)
+    report = run_load(TEST_DB_NAME, USER, PASSWORD, processes=2, threads=2,
+                      duration=1.5, interval=0.5, repopulate_every=0.5,
+                      mix={"recommend": 3, "recommend_generic": 1})
+    for call in ("recommend", "recommend_generic"):
+        summary = report["calls"][call]
+        assert summary["calls"] > 0 and summary["errors"] == 0, \
+            f"[Load] {call}: Expected calls and no errors | Got {summary}."
+        assert summary["p50_ms"] <= summary["p99_ms"] <= summary["max_ms"], \
+            f"[Load] {call}: Unordered percentiles {summary}."
+    assert report["repopulates"] \
+        and all(run["ok"] for run in report["repopulates"]), \
+        f"[Load] Expected repopulates | Got {report['repopulates']}."
+    connections = [sum(point["connections"].values())
+                   for point in report["timeline"]]
+    assert connections and max(connections) >= 4, \
+        f"[Load] Expected the 4 connections of the callers | Got " \
+        f"{connections}."
+
+
 if __name__ == "__main__":
     pytest.main()